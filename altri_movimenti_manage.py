@@ -8,6 +8,9 @@ import pandas as pd
 from altri_movimenti_config import altri_movimenti_config
 from altri_movimenti_utils import render_movimenti_crud_page
 
+# All shown in the Sommario tab.
+MONTHLY_SUMMARY_DISPLAY_COLUMNS = ['tipo_movimento', 'gennaio', 'febbraio', 'marzo', 'aprile', 'maggio', 'giugno',
+                                   'luglio', 'agosto', 'settembre', 'ottobre', 'novembre', 'dicembre']
 
 # TODO: The problem here is that I add a lot of complexity
 #  because I have to stop the streamlit execution when the
@@ -157,7 +160,8 @@ def main():
     if page_can_render:
 
         with (sommario):
-            result = supabase_client.table('monthly_altri_movimenti_summary').select('*').execute()
+            result = supabase_client.table('monthly_altri_movimenti_summary') \
+                                    .select(','.join(MONTHLY_SUMMARY_DISPLAY_COLUMNS)).execute()
 
             if not result.data:
                 st.warning("Nessun dato disponibile per il periodo selezionato")
@@ -209,19 +213,20 @@ def main():
                 avvisi = []
                 today_iso = date.today().isoformat()
 
-                different_year_attivi = supabase_client.table('movimenti_attivi').select('*') \
+                # Only the count, no rows are returned.
+                different_year_attivi = supabase_client.table('movimenti_attivi').select('id', count = 'exact', head = True) \
                     .or_('ma_data.lt.2025-01-01,ma_data.gt.2025-12-31').execute()
-                different_year_passivi = supabase_client.table('movimenti_passivi').select('*') \
+                different_year_passivi = supabase_client.table('movimenti_passivi').select('id', count = 'exact', head = True) \
                     .or_('mp_data.lt.2025-01-01,mp_data.gt.2025-12-31').execute()
 
-                if any([different_year_attivi.data, different_year_passivi.data]):
+                if any([different_year_attivi.count, different_year_passivi.count]):
                     avvisi.append("""Sono caricati movimenti con data diversa dall'anno 2025.
                      Nel TAB Sommario saranno mostrati solo i dati relativi all'anno corrente.""")
 
-                attivi_in_attesa = supabase_client.table('rate_movimenti_attivi').select('*') \
+                attivi_in_attesa = supabase_client.table('rate_movimenti_attivi').select('rma_numero', 'rma_data_scadenza') \
                                     .eq('rma_fattura_attesa','In Attesa') \
                                     .lt('rma_data_scadenza', today_iso).execute()
-                passivi_in_attesa = supabase_client.table('rate_movimenti_passivi').select('*') \
+                passivi_in_attesa = supabase_client.table('rate_movimenti_passivi').select('rmp_numero', 'rmp_data_scadenza') \
                                     .eq('rmp_fattura_attesa','In Attesa') \
                                     .lt('rmp_data_scadenza', today_iso).execute()
 
@@ -8,12 +8,29 @@ from decimal import Decimal, getcontext, ROUND_HALF_UP
 from dateutil.relativedelta import relativedelta
 from config import uppercase_prefixes, technical_fields, ma_tipo_options, mp_tipo_options
 from invoice_utils import render_field_widget
-from utils import extract_prefixed_field_names, get_standard_column_config, \
+from sql_schema import get_prefixed_field_names
+from db_serialization import to_json_payload
+from terms_delta import diff_terms, rescale_terms
+import terms_buffer
+import record_cache
+import query_cache
+from request_metrics import track_action
+from bulk_terms import render_bulk_terms_expander, render_bulk_cassa_expander
+from payment_schedule import split_document, render_schedule_options
+from utils import get_standard_column_config, \
     fetch_all_records_from_view, \
     fetch_record_from_id, to_money, are_all_required_fields_present, remove_prefix, \
     fetch_all_records, \
     format_italian_currency, text_input, date_input, money_input, selectbox
 
+# Columns of the <table_name>_overview views, in the order of the view, all shown in the table of the movimenti.
+OVERVIEW_DISPLAY_COLUMNS = {
+    'movimenti_attivi': ['id', 'ma_data', 'ma_numero', 'v_cliente', 'ma_tipo',
+                         'ma_importo_totale', 'v_incassato', 'v_saldo'],
+    'movimenti_passivi': ['id', 'mp_data', 'mp_numero', 'v_fornitore', 'mp_tipo',
+                          'mp_importo_totale', 'v_pagato', 'v_saldo'],
+}
+
 
 #
 #
@@ -53,46 +70,6 @@ def validate_payment_terms(payment_terms, total_amount, term_prefix):
     return len(errors) == 0, errors
 
 
-def auto_split_payment_movimenti(importo_totale_documento, num_installments, start_date, term_prefix, interval_days = 30):
-    # Precision 28 is different from decimal places!
-    # I need to keep high precision to be able to handle float conversion
-    # correctly. Then I can use quantize to force decimal places to two.
-    getcontext().prec = 28
-    MONEY_QUANTIZE = Decimal('0.01')  # 2 decimal places
-    CURRENCY_ROUNDING = ROUND_HALF_UP
-
-    def format_money(amount):
-        decimal_amount = Decimal(str(amount))
-        return decimal_amount.quantize(MONEY_QUANTIZE, rounding=CURRENCY_ROUNDING)
-
-    if num_installments <= 0:
-        return []
-
-    total_decimal = format_money(importo_totale_documento)
-    amount_per_installment = format_money(total_decimal / num_installments)
-
-    terms = []
-    total_allocated = Decimal('0.00')
-
-    for i in range(num_installments):
-        # Last installment gets the remainder to avoid rounding errors
-        if i == num_installments - 1:
-            installment_amount = total_decimal - total_allocated
-        else:
-            installment_amount = amount_per_installment
-            total_allocated += installment_amount
-
-        term = {
-            term_prefix + 'data_scadenza': datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=interval_days * (i + 1)),
-            term_prefix + 'importo_pagamento': float(installment_amount),
-            term_prefix + 'nome_cassa': '',
-            term_prefix + 'notes': f'Rata {i + 1} di {num_installments}',
-            term_prefix + 'data_pagamento': None  # Not paid yet
-        }
-        terms.append(term)
-
-    return terms
-
 @st.dialog("Aggiungi movimento")
 def render_add_modal(supabase_client, table_name, fields_config, prefix):
 
@@ -102,7 +79,7 @@ def render_add_modal(supabase_client, table_name, fields_config, prefix):
 
         form_data = {}
         config_items = list(fields_config.items())
-        sql_table_fields_names = extract_prefixed_field_names('sql/02_create_tables.sql', prefix)
+        sql_table_fields_names = get_prefixed_field_names(prefix)
 
         # TODO: The use of i % 2 will make so that
         #  if I have two tables with uneven number of fields in the config,
@@ -143,9 +120,7 @@ def render_add_modal(supabase_client, table_name, fields_config, prefix):
                         st.error(error)
                         return
                 else:
-                    processed_data = {}
-                    for name, value in form_data.items():
-                        processed_data[name] = str(value)
+                    processed_data = dict(form_data)
 
                     # When using the rpc function, user_id is added automatically.
                     # processed_data['user_id'] = st.session_state.user.id
@@ -163,7 +138,7 @@ def render_add_modal(supabase_client, table_name, fields_config, prefix):
                             #
                             # factor out?
                             MONTHS_IN_ADVANCE = 1
-                            data_documento_date = datetime.fromisoformat(processed_data[prefix + 'data'])
+                            data_documento_date = processed_data[prefix + 'data']
                             first_day = datetime(data_documento_date.year, data_documento_date.month, 1)
                             last_day_next_X_months = first_day + relativedelta(months=MONTHS_IN_ADVANCE, days=-1)
                             # terms_due_date = [last_day_next_X_months.date().isoformat()]
@@ -190,15 +165,18 @@ def render_add_modal(supabase_client, table_name, fields_config, prefix):
                             # FROM information_schema.routines
                             # WHERE routine_name = 'insert_record_fixed';
 
-                            result = supabase_client.rpc('insert_record', {
+                            result = supabase_client.rpc('insert_record', to_json_payload({
                                 'table_name': table_name,
                                 'record_data': processed_data,
                                 'terms_table_name': 'rate_' + table_name,
                                 'terms_data': [term],
                                 'test_user_id': None
-                            }).execute()
+                            })).execute()
 
                             if result.data.get('success', False):
+                                # The rpc gives back the inserted rows, no need to refetch the tables.
+                                record_cache.merge_rows(table_name, [result.data.get('record')])
+                                record_cache.merge_rows('rate_' + table_name, result.data.get('terms'))
                                 st.success("Movimento salvato con successo")
                                 st.rerun()
                             else:
@@ -210,7 +188,12 @@ def render_add_modal(supabase_client, table_name, fields_config, prefix):
                 print(f'Error adding movimento manually: {e}')
 
 @st.dialog("Rimuovi movimento")
-def render_delete_modal(supabase_client, table_name, record_id):
+def render_delete_modal(supabase_client, table_name, record_ids):
+
+    if len(record_ids) == 1:
+        st.write("Verrà eliminato il movimento selezionato, con tutte le relative scadenze.")
+    else:
+        st.write(f"Verranno eliminati {len(record_ids)} movimenti, con tutte le relative scadenze.")
 
     col1, col2 = st.columns([1, 1])
     with col1:
@@ -219,23 +202,24 @@ def render_delete_modal(supabase_client, table_name, record_id):
             try:
                 with st.spinner("Eliminazione in corso..."):
 
-                    # Supabase delete always returns empty data, so we check for no exception
-                    result = supabase_client.table(table_name).delete() \
-                        .eq('user_id', st.session_state.user.id) \
-                        .eq('id', record_id).execute()
-
-                    has_errored = (hasattr(result, 'error') and result.error)
-
-                    if not has_errored:
-                        # To delete terms when I delete movements for now I'll use just the
-                        # CASCADE clause. In the future I might use an ad hoc transaction to
-                        # make the system more robust to sql definition errors.
-
-                        st.success("Dati eliminati con successo!")
+                    # One rpc for all the selected records. The terms are deleted by the
+                    # CASCADE clause, the rpc only counts them.
+                    with track_action('delete documents'):
+                        result = supabase_client.rpc('delete_documents', to_json_payload({
+                            'table_name': table_name,
+                            'document_ids': list(record_ids)
+                        })).execute()
+
+                    if result.data.get('success', False):
+                        record_cache.remove_rows(table_name, result.data.get('document_ids'))
+                        # The terms are deleted by the cascade, not returned.
+                        record_cache.invalidate('rate_' + table_name)
+                        st.success(f"Eliminati {result.data.get('documents')} movimenti "
+                                   f"e {result.data.get('terms')} scadenze")
                         st.rerun()
 
                     else:
-                        st.error(f"Errore rimozione movimento: {result.error.message}")
+                        st.error(f"Errore rimozione movimenti: {result.data.get('error')}")
                         return
 
             except Exception as e:
@@ -268,7 +252,7 @@ def render_modify_modal(supabase_client, table_name, fields_config, selected_id,
     # "updated_at":"2025-11-04T23:07:32.918678+01:00"
     # }
 
-    selected_row_parent_data = fetch_record_from_id(supabase_client, table_name, selected_id, st.session_state.user.id)
+    selected_row_parent_data = record_cache.get_record(supabase_client, table_name, selected_id, st.session_state.user.id)
     # st.write(selected_row_parent_data)
     with st.form(f"modify_{table_name}_form",
                  clear_on_submit=False,
@@ -279,7 +263,7 @@ def render_modify_modal(supabase_client, table_name, fields_config, selected_id,
         form_data = {}
 
         config_items = list(fields_config.items())
-        sql_table_fields_names = extract_prefixed_field_names('sql/02_create_tables.sql', prefix)
+        sql_table_fields_names = get_prefixed_field_names(prefix)
 
         # This is weird to manage. Right now, I'm passing the row taken from the view.
         # The result is that if the prefix are the same, then the value is displayed, else
@@ -455,6 +439,9 @@ def render_modify_modal(supabase_client, table_name, fields_config, selected_id,
         else:
             st.error('Wrong table. Only movimenti_attivi or movimenti_passivi allowed.')
 
+        rescale = st.checkbox("Se l'importo totale cambia, ricalcola in proporzione gli importi delle scadenze",
+                              value = True)
+
         col3, _col4 = st.columns([1, 1])
 
         with col3:
@@ -474,24 +461,36 @@ def render_modify_modal(supabase_client, table_name, fields_config, selected_id,
                     # From the code above, we know that form_data will hold either a value or None,
                     # and we know that if we pass None, the supabase API will convert to NONE or
                     # default value.
-                    for name, value in form_data.items():
-                        # All string otherwise 'Object of type date is not JSON serializable'
-                        processed_data[name] = str(value)
+                    processed_data.update(form_data)
+
+                    # The terms of the movement as it was before the changes.
+                    rate_prefix = 'r' + prefix
+                    terms_delta = None
+                    if rescale and to_money(processed_data[prefix + 'importo_totale']) \
+                            != to_money(selected_row_parent_data.get(prefix + 'importo_totale')):
+                        terms = [row for row in record_cache.get_records(supabase_client, 'rate_' + table_name, st.session_state.user.id)
+                                 if row[rate_prefix + 'numero'] == selected_row_parent_data[prefix + 'numero']
+                                 and row[rate_prefix + 'data'] == selected_row_parent_data[prefix + 'data']]
+                        terms_delta = rescale_terms(terms, rate_prefix + 'importo_pagamento',
+                                                    rate_prefix + 'data_scadenza',
+                                                    processed_data[prefix + 'importo_totale'])
 
                     with st.spinner("Salvataggio in corso..."):
-                        # The addition of .eq() with user_id, is for consistency and safety.
-                        # It should not be necessary since ids are unique in the table.
-                        result = supabase_client.table(table_name).update(processed_data)\
-                            .eq('user_id', st.session_state.user.id)\
-                            .eq('id', selected_id).execute()
-
-                        has_errored = (hasattr(result, 'error') and result.error)
-
-                        if not has_errored:
+                        # Movement and terms in one transaction, only if nobody modified the movement
+                        # after it was loaded in the page. Key changes reach the terms by ON UPDATE CASCADE.
+                        result = record_cache.save_document_with_terms(supabase_client, table_name, selected_id,
+                                                                       processed_data,
+                                                                       selected_row_parent_data.get('updated_at'),
+                                                                       terms_delta)
+
+                        if result.get('success', False):
+                            # The merge of the saved rows bumps the version of the rate table,
+                            # so the terms editor reloads the terms of the selected movement.
                             st.success("Dati modificati con successo!")
                             st.rerun()
                         else:
-                            st.error(f"Errore modifica dati: {result.error.message}")
+                            st.error(f"Errore modifica dati: {result.get('error')}. "
+                                     "Chiudere e riaprire la finestra per vedere i dati aggiornati.")
                             return
 
             except Exception as e:
@@ -499,8 +498,10 @@ def render_modify_modal(supabase_client, table_name, fields_config, selected_id,
                 raise
 
 def auto_split_payment_movement(importo_totale_documento: Decimal, num_installments, start_date,
-                                rate_prefix, interval_days = 30):
+                                rate_prefix, interval_days = 30, convention = 'giorni',
+                                day_of_month = None, splits = None):
     """
+    See payment_schedule.py for the conventions and the rounding.
     In theory this is for initializing a new set of terms, but since users will use this to add things fast
     to already initialized movements.
     I tried to preserve current_terms information as much as possible but it cannot be done since I will
@@ -508,164 +509,97 @@ def auto_split_payment_movement(importo_totale_documento: Decimal, num_installme
     """
 
 
-    # Precision 28 is different from decimal places!
-    # I need to keep high precision to be able to handle float conversion
-    # correctly. Then I can use quantize to force decimal places to two.
-
-    if num_installments <= 0:
-        return []
-
-    total_decimal = to_money(importo_totale_documento)
-    amount_per_installment = to_money(total_decimal / num_installments)
-
-    terms = []
-    total_allocated = Decimal('0.00')
-
-    for i in range(num_installments):
-        # Last installment gets the remainder to avoid rounding errors
-        if i == num_installments - 1:
-            installment_amount = total_decimal - total_allocated
-        else:
-            installment_amount = amount_per_installment
-            total_allocated += installment_amount
-        term = {
+    installments = split_document(importo_totale_documento, num_installments, start_date,
+                                  convention, interval_days, day_of_month, splits)
+    return [{
             'id':None,
-            rate_prefix + 'data_scadenza':  datetime.strptime(start_date, '%Y-%m-%d').date() + timedelta(days=interval_days * (i + 1)),
-            rate_prefix + 'importo_pagamento': installment_amount,
+            rate_prefix + 'data_scadenza': installment['data_scadenza'],
+            rate_prefix + 'importo_pagamento': installment['importo'],
             rate_prefix + 'display_cassa': '',
-            rate_prefix + 'notes': f'Rata {i + 1} di {num_installments}',
+            rate_prefix + 'notes': installment['notes'],
             rate_prefix + 'data_pagamento': None,  # Not paid yet
             rate_prefix + 'fattura_attesa': 'Nessuna'
-        }
-        terms.append(term)
-
-    return terms
+        } for installment in installments]
 
-def save_movement_terms(edited, terms_key, rate_prefix, importo_totale_movimento,
-                        config, movement_key, supabase_client, table_name,
-                        backup_terms_key, are_terms_updated):
+def stage_movement_terms(edited, rate_prefix, importo_totale_movimento,
+                         config, movement_key, table_name, document_id, label,
+                         backup_terms_key, versions_key):
+    """
+    Same as stage_invoice_terms() in invoice_manage.py: validates the terms of the editor
+    and puts their changes in the terms buffer (see terms_buffer.py), without saving them.
+    """
     if len(edited) == 0:
-        st.warning('Impossibile salvare un movimento senza scadenze di pagamento. '
+        message = ('Impossibile salvare un movimento senza scadenze di pagamento. '
                    'Inserire delle nuove scadenze o cliccare su Annulla per scartare '
                    'tutte le modifiche apportate')
-    else:
-        try:
-
-            _edited = edited.copy()
-            _edited.columns = [rate_prefix + col.replace(' ','_').lower() for col in _edited.columns]
-            _edited = _edited.rename(columns={rate_prefix + 'id': 'id'})
-            # are_all_ids_none = _edited['id'].isna().all()
-
-            up_to_date_terms = []
-            for k,v in _edited.T.to_dict().items():
-                up_to_date_terms.append(v)
-            terms = up_to_date_terms
-            
-            # Verify total configured
-            # TODO; This does not work at first try
-            total_configured = to_money(0)
-            for term in terms:
-                total_configured += to_money(term[rate_prefix + 'importo_pagamento'])
-            total_is_different = importo_totale_movimento != total_configured
-            if total_is_different:
-                # todo: better formatting of money
-                st.warning(f"Differenza di {total_configured - importo_totale_movimento} euro riscontrata tra la somma degli importi delle scadenze configurate e l'importo totale. "
-                           f"Correggere prima di proseguire")
-                return
-
-            # Avoid to insert the keys of the movement in
-            # the session state so I don't have to handle the keys in excess
-            # everywhere.
-            # Adding movement keys, if missing, for insert.
-            terms_to_save = []
-
-            # In order to pass all strings and avoid not JSON serializable
-            # objects like dates.
-            for term in terms:
-                new_term = {}
-                for k,v in term.items():
-                    if v is None:
-                        # Otherwise loading the string "None"
-                        new_term[k] = v
-                    else:
-                        new_term[k] = str(v)
-                terms_to_save.append(new_term)
-
-            # Adding movement keys, if missing, for insert.
-            for term in terms_to_save:
-                for k,v in movement_key.items():
-                    if k not in term:
-                        term[k] = v
-
-            # Verify that all required field are present
-            sql_table_fields_names = extract_prefixed_field_names(
-                'sql/02_create_tables.sql',
-                rate_prefix)
-            # NOTE: this is a hack! the prefix here is rm*_, but in the config there is only m*_
-            # type prefix.
-            # correct_sql_fields = [field[1:] for field in sql_table_fields_names]
-            # correct_terms = []
-            # for term in terms:
-            #     correct_term = {}
-            #     for k,v in term.items():
-            #         correct_term[k[1:]] = v
-            #     correct_terms.append(correct_term)
-
-            errors = []
-            for term in terms_to_save:
-                errors.append(are_all_required_fields_present(term,
-                                                         sql_table_fields_names,
-                                                         config))
-            if any(errors):
-                for error in errors:
-                    # todo: Better error message
-                    st.warning(f'{' '.join(error)}')
-                return
-
-            for i in range(len(terms_to_save)):
-                term = terms_to_save[i]
-
-                term.pop(rate_prefix + 'x', None)
-
-                row_id = term['id']
-                if row_id:
-                    result = supabase_client.table('rate_' + table_name).select('*') \
-                        .eq('id', row_id) \
-                        .eq('user_id', st.session_state.user.id).execute()
-                    
-                    nome = result.data[0].get(rate_prefix + 'nome_cassa')
-                    iban = result.data[0].get(rate_prefix + 'iban_cassa')
-                    term[rate_prefix + 'nome_cassa'] = nome
-                    term[rate_prefix + 'iban_cassa'] = iban
-
-            result = supabase_client.rpc('upsert_terms', {
-                'table_name': 'rate_' + table_name,
-                'delete_key': movement_key,
-                'terms': terms_to_save
-            }).execute()
-            
-            if result.data.get('success', False):
-                st.success("Modifiche eseguite con successo")
-
-                st.session_state[backup_terms_key] = terms
-
-                # TODO: if the above works, maybe i can just update the terms here instead of fetching them twice.
-                #  I have to just remove all the state are_terms_updated and assign the new terms to the current terms key
-                st.session_state[are_terms_updated] = True
-                
-                st.rerun()
-            else:
-                st.error(f'Errore nel salvataggio: {result}')
-                st.text("Stack trace:")
-                st.text(traceback.format_exc())
-
-        # todo: fix error management / logging.
-        #  Here is interesting because the above catches db error that are not
-        #  exceptions, the below only exceptions.
-        except Exception as e:
-            st.error(f"Eccezione nel salvataggio: {str(e)}")
-            st.text("Stack trace:")
-            st.text(traceback.format_exc())
+        st.warning(message)
+        delta = diff_terms(st.session_state[backup_terms_key], [])
+        terms_buffer.stage('rate_' + table_name, document_id, movement_key, delta, [],
+                           errors = [message], label = label)
+        return
+
+    try:
+
+        _edited = edited.copy()
+        _edited.columns = [rate_prefix + col.replace(' ','_').lower() for col in _edited.columns]
+        _edited = _edited.rename(columns={rate_prefix + 'id': 'id'})
+
+        up_to_date_terms = []
+        for k,v in _edited.T.to_dict().items():
+            up_to_date_terms.append(v)
+        terms = up_to_date_terms
+
+        errors = []
+
+        # Verify total configured
+        total_configured = to_money(0)
+        for term in terms:
+            total_configured += to_money(term[rate_prefix + 'importo_pagamento'])
+        total_is_different = importo_totale_movimento != total_configured
+        if total_is_different:
+            # todo: better formatting of money
+            errors.append(f"Differenza di {total_configured - importo_totale_movimento} euro riscontrata tra la somma degli importi delle scadenze configurate e l'importo totale. "
+                          f"Correggere prima di proseguire")
+
+        # Avoid to insert the keys of the movement in
+        # the session state so I don't have to handle the keys in excess
+        # everywhere.
+        #
+        # Avoid not JSON serializable objects like dates, and NaN from the data editor.
+        # This is also a copy, so terms are not modified below.
+        terms_to_save = to_json_payload(terms)
+
+        # Adding movement keys, if missing, for insert.
+        for term in terms_to_save:
+            for k,v in movement_key.items():
+                if k not in term:
+                    term[k] = v
+
+        # Verify that all required field are present
+        sql_table_fields_names = get_prefixed_field_names(rate_prefix)
+
+        for term in terms_to_save:
+            missing = are_all_required_fields_present(term, sql_table_fields_names, config)
+            if missing:
+                # todo: Better error message
+                errors.append(f'{' '.join(missing)}')
+
+        for error in errors:
+            st.warning(error)
+
+        # Only the changes with respect to the terms loaded in the editor are sent,
+        # so the terms not modified keep their row, id and cassa.
+        delta = diff_terms(st.session_state[backup_terms_key], terms_to_save,
+                           ignored_fields = [rate_prefix + 'x'],
+                           versions = st.session_state.get(versions_key))
+        terms_buffer.stage('rate_' + table_name, document_id, movement_key, delta, terms,
+                           errors = errors, label = label)
+
+    except Exception as e:
+        st.error(f"Eccezione nella validazione delle scadenze: {str(e)}")
+        st.text("Stack trace:")
+        st.text(traceback.format_exc())
+
 
 def render_movimenti_crud_page(supabase_client, user_id,
                                table_name, prefix,
@@ -706,8 +640,11 @@ def render_movimenti_crud_page(supabase_client, user_id,
     """
     terms_key = table_name + '_terms'
     backup_terms_key = table_name + '_backup_terms'
+    # updated_at of the loaded terms, for the optimistic concurrency of apply_terms_delta.
+    versions_key = table_name + '_terms_versions'
     selection_key = table_name + table_name + '_selected_movement'
-    are_terms_updated = table_name + '_are_terms_updated'
+    # Version of the rate table when the terms were loaded, see query_cache.py.
+    loaded_version_key = table_name + '_terms_loaded_version'
 
     # Selected movement is only used for knowing when to refetch data
     # from the terms table when the user changes selection.
@@ -729,9 +666,10 @@ def render_movimenti_crud_page(supabase_client, user_id,
         st.session_state[backup_terms_key] = None
 
     # This is for rerunning the piece of code that will update the terms that go into the
-    # terms df viewer after having saved them into the database.
-    if are_terms_updated not in st.session_state:
-        st.session_state[are_terms_updated] = False
+    # terms df viewer after having saved them into the database, or after any other write
+    # to the terms table: every write bumps its version.
+    if loaded_version_key not in st.session_state:
+        st.session_state[loaded_version_key] = None
 
 
 
@@ -762,7 +700,8 @@ def render_movimenti_crud_page(supabase_client, user_id,
 
 
 
-    movimenti_data = fetch_all_records_from_view(supabase_client, table_name + '_overview')
+    movimenti_data = fetch_all_records_from_view(supabase_client, table_name + '_overview',
+                                                 OVERVIEW_DISPLAY_COLUMNS[table_name])
 
     if not movimenti_data:
         st.warning("Nessun movimento trovato. Creare un movimento prima di proseguire.")
@@ -818,7 +757,8 @@ def render_movimenti_crud_page(supabase_client, user_id,
         df_vis = df_vis.sort_values(by = ['Data', 'Numero'])
 
         selection = st.dataframe(df_vis, use_container_width=True,
-                                 selection_mode = 'single-row',
+                                 # Multi row for the bulk delete, the other actions use the first selected row.
+                                 selection_mode = 'multi-row',
                                  on_select='rerun',
                                  hide_index = True,
                                  column_config=column_config,
@@ -835,7 +775,9 @@ def render_movimenti_crud_page(supabase_client, user_id,
         with col2:
             modify = st.button("Modifica Movimento", key = table_name + '_modify')
             if modify:
-                if selection.selection['rows']:
+                if len(selection.selection['rows']) > 1:
+                    st.warning('Seleziona un solo movimento da modificare')
+                elif selection.selection['rows']:
                     # BAD: Here I'm relying on the fact that the index in the df and
                     # in the movimenti_data state will always be in sync.
                     #
@@ -855,16 +797,15 @@ def render_movimenti_crud_page(supabase_client, user_id,
             delete = st.button("Rimuovi Movimento", key = table_name + '_delete')
             if delete:
                 if selection.selection['rows']:
-                    selected_index = selection.selection['rows'][0]
                     # This line below will not work since the index of selection is relative to
                     # df_vis and not movimenti_data.
                     # selected_row = movimenti_data[selected_index]
 
                     # So where I need the id, I can call .name but cannot do to_dict() because I lose the index
                     # if I don't reset the index before.
-                    record_id = df_vis.iloc[selected_index].name #.to_dict()
+                    record_ids = [df_vis.iloc[selected_index].name for selected_index in selection.selection['rows']]
 
-                    render_delete_modal(supabase_client, table_name, record_id)
+                    render_delete_modal(supabase_client, table_name, record_ids)
                 else:
                     st.warning('Seleziona un movimento da eliminare')
 
@@ -908,17 +849,15 @@ def render_movimenti_crud_page(supabase_client, user_id,
 
                 # I update the terms when: there are no terms (first page load), I've selected another term,
                 # I've saved and updated the terms.
-                # if st.session_state[terms_key] is None or st.session_state[selection_key] != selection \
-                #         or st.session_state[are_terms_updated] == True:
                 if st.session_state[terms_key] is None or st.session_state[selection_key] != numero_documento \
-                        or st.session_state[are_terms_updated] == True or st.session_state.force_update == True:
+                        or st.session_state[loaded_version_key] != query_cache.get_version('rate_' + table_name):
                     try:
-                        result = supabase_client.table('rate_' + table_name).select('*').eq('user_id', user_id) \
-                            .eq(rate_prefix + 'numero', numero_documento) \
-                            .eq(rate_prefix + 'data', data_documento).execute()
+                        document_rows = [row for row in record_cache.get_records(supabase_client, 'rate_' + table_name, user_id)
+                                         if row[rate_prefix + 'numero'] == numero_documento
+                                         and row[rate_prefix + 'data'] == str(data_documento)]
 
                         existing_terms = []
-                        for row in result.data:
+                        for row in document_rows:
                             term = {
                                 'id' : row['id'],
                                 rate_prefix + 'data_scadenza': datetime.strptime(row[rate_prefix + 'data_scadenza'], '%Y-%m-%d').date(),
@@ -929,14 +868,18 @@ def render_movimenti_crud_page(supabase_client, user_id,
                                 rate_prefix + 'notes': row[rate_prefix + 'notes'] or '',
                             }
                             existing_terms.append(term)
-                        st.session_state[terms_key] = existing_terms
+
+                        # The changes not saved yet of this movement are shown again,
+                        # and compared with the terms of the database.
+                        pending_terms = terms_buffer.get_pending_terms('rate_' + table_name, df_vis.index[selected_index])
+                        st.session_state[terms_key] = pending_terms if pending_terms is not None else existing_terms
                         st.session_state[selection_key] = numero_documento
-                        st.session_state[are_terms_updated] = False
-                        st.session_state.force_update = False
+                        st.session_state[loaded_version_key] = query_cache.get_version('rate_' + table_name)
 
                     # This try should be triggered only on the first loading or when I change selection
                         # so it should be safe to reset the existing terms here.
                         st.session_state[backup_terms_key] = existing_terms
+                        st.session_state[versions_key] = {row['id']: row.get('updated_at') for row in document_rows}
                     except Exception as e:
                         #
                         #
@@ -976,7 +919,7 @@ def render_movimenti_crud_page(supabase_client, user_id,
                                                            required_columns = required_columns,
                                                            )
 
-                options = fetch_all_records_from_view(supabase_client, 'casse_options')
+                options = fetch_all_records_from_view(supabase_client, 'casse_options', ['cassa'])
                 cleaned_options = [str(d.get('cassa')).strip() for d in options if d.get('cassa') is not None]
 
                 # Check for any mismatches
@@ -1022,36 +965,32 @@ def render_movimenti_crud_page(supabase_client, user_id,
                                           disabled=["Id"]
                                          )
 
+                stage_movement_terms(edited, rate_prefix, importo_totale_movimento,
+                                     config, movement_key, table_name, df_vis.index[selected_index],
+                                     f'Movimento {numero_documento}', backup_terms_key, versions_key)
 
                 c1, c2, c3 = st.columns([3,3,1], vertical_alignment='top')
 
                 with c1:
                     with st.expander("Configurazione Iniziale Rapida", width=500):
                         st.write("""La configurazione rapida permette di generare automaticamente il
-                                        numero desiderato di scadenze con importo diviso ugualmente.""")
+                                        numero desiderato di scadenze, con importo diviso ugualmente
+                                        o secondo le percentuali indicate.""")
                         st.write("""Attenzione: questa operazione sovrascriverà tutti i campi delle
                                         scadenze attualmente configurate.""")
-                        split_col1, split_col2, split_col3 = st.columns([1, 1, 1],
-                                                                        vertical_alignment='bottom')
-
-                        with split_col1:
-                            num_installments = st.number_input("Numero rate", min_value=1, max_value=12, value=1,
-                                                               key = table_name + '_num_installments')
-
-                        with split_col2:
-                            interval_days = st.number_input("Giorni tra rate", min_value=1, max_value=365, value=30, step=15,
-                                                            key = table_name + '_interval_days')
-
-                        with split_col3:
-                            # TODO; can I put an help message over the button
-                            #  so that I don't have to handle the complexity of a dialog?
-                            if st.button("Applica", key = table_name + '_apply_rapid_config'):
-
-                                up_to_date_terms = auto_split_payment_movement(
-                                    importo_totale_movimento, num_installments, data_documento, rate_prefix, interval_days
-                                )
-                                st.session_state[terms_key] = up_to_date_terms
-                                st.rerun()
+                        schedule_options = render_schedule_options(table_name)
+
+                        # TODO; can I put an help message over the button
+                        #  so that I don't have to handle the complexity of a dialog?
+                        if st.button("Applica", key = table_name + '_apply_rapid_config',
+                                     disabled = schedule_options is None):
+
+                            up_to_date_terms = auto_split_payment_movement(
+                                importo_totale_movimento, start_date = data_documento,
+                                rate_prefix = rate_prefix, **schedule_options
+                            )
+                            st.session_state[terms_key] = up_to_date_terms
+                            st.rerun()
                 with c2:
                     with st.expander("Divisione Automatica Importo", width=500):
 
@@ -1098,10 +1037,9 @@ def render_movimenti_crud_page(supabase_client, user_id,
                         cancel = st.button('Annulla', key = table_name + '_cancel_terms', use_container_width=True)
 
                 if save:
-                    save_movement_terms(edited, terms_key, rate_prefix, importo_totale_movimento,
-                                        config, movement_key, supabase_client, table_name,
-                                        backup_terms_key, are_terms_updated)
+                    terms_buffer.save_pending_changes(supabase_client)
                 if cancel:
+                    terms_buffer.discard('rate_' + table_name, df_vis.index[selected_index])
                     # NOTE IMPORTANT: for some reason, if I do
                     # st.session_state[terms_key] = st.session_state[backup_terms_key],
                     # the rerun() does not trigger the recomputing of the terms_df.
@@ -1111,4 +1049,11 @@ def render_movimenti_crud_page(supabase_client, user_id,
                     st.rerun()
 
             else:
-                st.warning('Seleziona un movimento per gestirne le rate')
\ No newline at end of file
+                st.warning('Seleziona un movimento per gestirne le rate')
+
+            # After the editor, so it counts the changes of this run too.
+            terms_buffer.render_pending_indicator(supabase_client)
+
+        terms = pd.DataFrame(record_cache.get_records(supabase_client, 'rate_' + table_name, user_id))
+        render_bulk_terms_expander(supabase_client, 'rate_' + table_name, terms)
+        render_bulk_cassa_expander(supabase_client, 'rate_' + table_name)
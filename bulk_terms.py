@@ -0,0 +1,255 @@
+"""
+Operations on many terms at once, shared by the invoices and the movimenti pages.
+
+The terms of all the documents of a table are listed together, filtered, multi-selected,
+and changed with ONE bulk_update_terms rpc (see sql/02_create_tables.sql):
+- mark as paid on a date,
+- mark as not paid,
+- shift the due dates by months and/or days.
+
+The cassa is assigned by filter instead of by selection, with ONE assign_cassa_bulk rpc,
+for example to all the terms of the received invoices of a supplier.
+"""
+
+import traceback
+from datetime import date
+import pandas as pd
+import streamlit as st
+from db_serialization import to_json_payload
+from utils import fetch_all_records_from_view
+import record_cache
+from request_metrics import track_action
+
+# The rate tables of invoices and movimenti have different names for the same fields.
+TERMS_FIELDS = {
+    'rate_fatture_emesse': {
+        'numero': 'rfe_numero_fattura', 'data': 'rfe_data_documento',
+        'scadenza': 'rfe_data_scadenza_pagamento', 'pagamento': 'rfe_data_pagamento_rata',
+        'importo': 'rfe_importo_pagamento_rata', 'cassa': 'rfe_display_cassa',
+    },
+    'rate_fatture_ricevute': {
+        'numero': 'rfr_numero_fattura', 'data': 'rfr_data_documento',
+        'scadenza': 'rfr_data_scadenza_pagamento', 'pagamento': 'rfr_data_pagamento_rata',
+        'importo': 'rfr_importo_pagamento_rata', 'cassa': 'rfr_display_cassa',
+    },
+    'rate_movimenti_attivi': {
+        'numero': 'rma_numero', 'data': 'rma_data',
+        'scadenza': 'rma_data_scadenza', 'pagamento': 'rma_data_pagamento',
+        'importo': 'rma_importo_pagamento', 'cassa': 'rma_display_cassa',
+    },
+    'rate_movimenti_passivi': {
+        'numero': 'rmp_numero', 'data': 'rmp_data',
+        'scadenza': 'rmp_data_scadenza', 'pagamento': 'rmp_data_pagamento',
+        'importo': 'rmp_importo_pagamento', 'cassa': 'rmp_display_cassa',
+    },
+}
+
+COLUMN_LABELS = {
+    'numero': 'Numero', 'data': 'Data Documento', 'scadenza': 'Data Scadenza',
+    'importo': 'Importo', 'pagamento': 'Data Pagamento', 'cassa': 'Cassa',
+}
+
+OPERATIONS = {
+    'mark_paid': 'Segna come pagate',
+    'mark_unpaid': 'Segna come non pagate',
+    'shift_due': 'Sposta scadenze',
+}
+
+
+def filter_terms(terms: pd.DataFrame, terms_table_name, only_unpaid = False,
+                 due_from = None, due_to = None) -> pd.DataFrame:
+    """
+    terms: records of terms_table_name, with the sql column names.
+    return: the terms that match the filters, sorted by due date.
+    """
+    fields = TERMS_FIELDS[terms_table_name]
+    if terms.empty:
+        return terms
+
+    due_dates = pd.to_datetime(terms[fields['scadenza']]).dt.date
+    mask = pd.Series(True, index=terms.index)
+    if only_unpaid:
+        mask &= terms[fields['pagamento']].isna()
+    if due_from is not None:
+        mask &= due_dates >= due_from
+    if due_to is not None:
+        mask &= due_dates <= due_to
+
+    return terms[mask].sort_values([fields['scadenza'], fields['numero']])
+
+
+def bulk_update_terms(supabase_client, terms_table_name, term_ids, operation,
+                      payment_date = None, shift_days = 0, shift_months = 0) -> dict:
+    """Thin wrapper of the bulk_update_terms rpc, returns its result."""
+    with track_action('bulk update terms'):
+        result = supabase_client.rpc('bulk_update_terms', to_json_payload({
+            'table_name': terms_table_name,
+            'term_ids': list(term_ids),
+            'operation': operation,
+            'payment_date': payment_date,
+            'shift_days': shift_days,
+            'shift_months': shift_months,
+        })).execute()
+    return result.data
+
+
+def render_bulk_terms_expander(supabase_client, terms_table_name, terms: pd.DataFrame):
+    """
+    terms: all the terms of terms_table_name of the user, as fetched with fetch_all_records().
+    """
+    fields = TERMS_FIELDS[terms_table_name]
+
+    with st.expander("Operazioni Multiple su Scadenze"):
+        if terms.empty:
+            st.warning('Nessuna scadenza disponibile')
+            return
+
+        col1, col2 = st.columns([1, 2], vertical_alignment='bottom')
+        with col1:
+            only_unpaid = st.checkbox('Solo non pagate', value=True, key = terms_table_name + '_bulk_only_unpaid')
+        with col2:
+            due_range = st.date_input('Scadenze tra', value=(), format='DD/MM/YYYY',
+                                      key = terms_table_name + '_bulk_due_range')
+
+        due_from = due_range[0] if len(due_range) > 0 else None
+        due_to = due_range[1] if len(due_range) > 1 else None
+        filtered = filter_terms(terms, terms_table_name, only_unpaid, due_from, due_to)
+
+        if filtered.empty:
+            st.info('Nessuna scadenza corrisponde ai filtri')
+            return
+
+        df_vis = filtered.set_index('id')[[fields[f] for f in COLUMN_LABELS]]
+        df_vis.columns = list(COLUMN_LABELS.values())
+
+        selection = st.dataframe(df_vis, use_container_width=True,
+                                 selection_mode = 'multi-row',
+                                 on_select='rerun',
+                                 hide_index = True,
+                                 key = terms_table_name + '_bulk_selection_df',
+                                 column_config = {
+                                     'Importo': st.column_config.NumberColumn(format='accounting'),
+                                     'Data Documento': st.column_config.DateColumn(format='DD/MM/YYYY'),
+                                     'Data Scadenza': st.column_config.DateColumn(format='DD/MM/YYYY'),
+                                     'Data Pagamento': st.column_config.DateColumn(format='DD/MM/YYYY'),
+                                 })
+
+        select_all = st.checkbox(f'Seleziona tutte le {len(df_vis)} scadenze filtrate',
+                                 key = terms_table_name + '_bulk_select_all')
+        if select_all:
+            selected_ids = list(df_vis.index)
+        else:
+            # Selection rows are positions in df_vis, regardless of the sorting done by the user.
+            selected_ids = [df_vis.index[i] for i in selection.selection['rows']]
+
+        operation = st.radio('Operazione', options=list(OPERATIONS), format_func=OPERATIONS.get,
+                             horizontal=True, key = terms_table_name + '_bulk_operation')
+
+        payment_date, shift_months, shift_days = None, 0, 0
+        if operation == 'mark_paid':
+            payment_date = st.date_input('Data pagamento', value=date.today(), format='DD/MM/YYYY',
+                                         key = terms_table_name + '_bulk_payment_date')
+        elif operation == 'shift_due':
+            col1, col2 = st.columns(2)
+            with col1:
+                shift_months = st.number_input('Mesi', min_value=-24, max_value=24, value=0,
+                                               key = terms_table_name + '_bulk_shift_months')
+            with col2:
+                shift_days = st.number_input('Giorni', min_value=-365, max_value=365, value=0,
+                                             key = terms_table_name + '_bulk_shift_days')
+
+        if not st.button(f'Applica a {len(selected_ids)} scadenze', type='primary',
+                         disabled = not selected_ids, key = terms_table_name + '_bulk_apply'):
+            return
+
+        try:
+            result = bulk_update_terms(supabase_client, terms_table_name, selected_ids, operation,
+                                       payment_date, shift_days, shift_months)
+            if result.get('success', False):
+                record_cache.merge_rpc_result(result)
+                st.success(f"Scadenze aggiornate: {result.get('updated')}")
+                st.rerun()
+            else:
+                st.error(f'Errore nel salvataggio: {result}')
+        except Exception as e:
+            st.error(f"Eccezione nel salvataggio: {str(e)}")
+            st.text("Stack trace:")
+            st.text(traceback.format_exc())
+
+
+def assign_cassa_bulk(supabase_client, terms_table_name, display_cassa, counterparty = None,
+                      due_from = None, due_to = None, only_unassigned = True, preview = False) -> dict:
+    """Thin wrapper of the assign_cassa_bulk rpc, returns its result."""
+    # The preview is done at every rerun of the expander, so it has its own budget.
+    with track_action('count cassa terms' if preview else 'assign cassa'):
+        result = supabase_client.rpc('assign_cassa_bulk', to_json_payload({
+            'table_name': terms_table_name,
+            'display_cassa': display_cassa,
+            'counterparty': counterparty or None,
+            'due_from': due_from,
+            'due_to': due_to,
+            'only_unassigned': only_unassigned,
+            'preview': preview,
+        })).execute()
+    return result.data
+
+
+def render_bulk_cassa_expander(supabase_client, terms_table_name):
+    """
+    Assigns a cassa to all the terms of terms_table_name that match the filters.
+    The filtering is done by the rpc, so the count shown before applying is the
+    one of the database, not of the terms loaded in the page.
+    """
+    with st.expander("Assegnazione Cassa Multipla"):
+        options = [d.get('cassa') for d in fetch_all_records_from_view(supabase_client, 'casse_options', ['cassa'])]
+        if not options:
+            st.warning('Nessuna cassa disponibile, aggiungile in Anagrafica Azienda')
+            return
+
+        col1, col2 = st.columns(2)
+        with col1:
+            display_cassa = st.selectbox('Cassa da assegnare', options=options, index=None,
+                                         placeholder='Seleziona una cassa',
+                                         key = terms_table_name + '_cassa_bulk_cassa')
+            counterparty = st.text_input('Controparte (nome o partita iva)',
+                                         key = terms_table_name + '_cassa_bulk_counterparty')
+        with col2:
+            due_range = st.date_input('Scadenze tra', value=(), format='DD/MM/YYYY',
+                                      key = terms_table_name + '_cassa_bulk_due_range')
+            only_unassigned = st.checkbox('Solo scadenze senza cassa', value=True,
+                                          key = terms_table_name + '_cassa_bulk_only_unassigned')
+
+        if display_cassa is None:
+            st.info('Seleziona la cassa da assegnare per vedere quante scadenze verranno modificate')
+            return
+
+        due_from = due_range[0] if len(due_range) > 0 else None
+        due_to = due_range[1] if len(due_range) > 1 else None
+        filters = dict(counterparty = counterparty.strip(), due_from = due_from, due_to = due_to,
+                       only_unassigned = only_unassigned)
+
+        try:
+            preview = assign_cassa_bulk(supabase_client, terms_table_name, display_cassa,
+                                        preview = True, **filters)
+            if not preview.get('success', False):
+                st.error(f'Errore nel conteggio delle scadenze: {preview}')
+                return
+
+            matched = preview.get('matched', 0)
+            st.write(f'Scadenze che verranno assegnate a **{display_cassa}**: {matched}')
+
+            if not st.button(f'Assegna cassa a {matched} scadenze', type='primary',
+                             disabled = matched == 0, key = terms_table_name + '_cassa_bulk_apply'):
+                return
+
+            result = assign_cassa_bulk(supabase_client, terms_table_name, display_cassa, **filters)
+            if result.get('success', False):
+                record_cache.merge_rpc_result(result)
+                st.success(f"Scadenze aggiornate: {result.get('matched')}")
+                st.rerun()
+            else:
+                st.error(f'Errore nel salvataggio: {result}')
+        except Exception as e:
+            st.error(f"Eccezione nel salvataggio: {str(e)}")
+            st.text("Stack trace:")
+            st.text(traceback.format_exc())
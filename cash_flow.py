@@ -102,12 +102,24 @@ def get_cashflow_column_config(df_columns, months):
 
     return column_config
 
+# Columns read by are_terms_total_congruent(), without the prefix of the table.
+INVOICE_CHECK_COLUMNS = ['numero_fattura', 'data_documento', 'importo_totale_documento']
+INVOICE_TERMS_CHECK_COLUMNS = ['numero_fattura', 'data_documento', 'importo_pagamento_rata']
+MOVEMENT_CHECK_COLUMNS = ['numero', 'data', 'importo_totale']
+MOVEMENT_TERMS_CHECK_COLUMNS = ['numero', 'data', 'importo_pagamento']
+
 def are_terms_total_congruent(supabase_client, table_name, user_id, prefix):
 
-    # Here I fetch data to be sure to have the most up to date data,
-    # but in the future this might be simplified.
-    check_documents = fetch_all_records(supabase_client, table_name, user_id)
-    check_terms = pd.DataFrame(fetch_all_records(supabase_client, 'rate_' + table_name, user_id))
+    # Cached, and fetched again after the writes and the uploads, see query_cache.py.
+    if 'fatture' in table_name:
+        document_columns, terms_columns = INVOICE_CHECK_COLUMNS, INVOICE_TERMS_CHECK_COLUMNS
+    else:
+        document_columns, terms_columns = MOVEMENT_CHECK_COLUMNS, MOVEMENT_TERMS_CHECK_COLUMNS
+    check_documents = fetch_all_records(supabase_client, table_name, user_id,
+                                        [prefix + column for column in document_columns])
+    check_terms = pd.DataFrame(fetch_all_records(supabase_client, 'rate_' + table_name, user_id,
+                                                 ['r' + prefix + column for column in terms_columns]),
+                               columns = ['r' + prefix + column for column in terms_columns])
     errors = []
 
     if 'fatture' in table_name:
@@ -154,14 +166,25 @@ def are_terms_total_congruent(supabase_client, table_name, user_id, prefix):
         raise Exception("Check terms congruency: table name not supported")
 
 
+# Columns of the cashflow views, all shown in the tables. m11 and m12 are commented out in the views.
+ACTIVE_CASHFLOW_DISPLAY_COLUMNS = ['cassa', 'm1', 'm2', 'm3', 'm4', 'm5', 'm6', 'm7', 'm8', 'm9', 'm10',
+                                   'incassare_oltre', 'totale_da_incassare', 'scaduti_30gg', 'scaduti_60gg',
+                                   'scaduti_oltre', 'totale_scaduti', 'totale_attivi']
+PASSIVE_CASHFLOW_DISPLAY_COLUMNS = ['cassa', 'm1', 'm2', 'm3', 'm4', 'm5', 'm6', 'm7', 'm8', 'm9', 'm10',
+                                    'pagare_oltre', 'totale_da_pagare', 'scaduti_30gg', 'scaduti_60gg',
+                                    'scaduti_oltre', 'totale_scaduti', 'totale_passivi']
+
 def main():
 
     months = get_short_months()
 
     user_id, supabase_client, page_can_render = setup_page("Gestione Altri Movimenti")
 
-    active_result = supabase_client.table('active_cashflow_next_12_months_groupby_casse').select('*').execute()
-    passive_result = supabase_client.table('passive_cashflow_next_12_months_groupby_casse').select('*').execute()
+    # Selected in this order, because the columns are renamed by position below.
+    active_result = supabase_client.table('active_cashflow_next_12_months_groupby_casse') \
+                                   .select(','.join(ACTIVE_CASHFLOW_DISPLAY_COLUMNS)).execute()
+    passive_result = supabase_client.table('passive_cashflow_next_12_months_groupby_casse') \
+                                    .select(','.join(PASSIVE_CASHFLOW_DISPLAY_COLUMNS)).execute()
 
     active_columns = ['cassa'] + months[:10] + ['incassare_oltre',
                                                 'totale_da_incassare',
@@ -0,0 +1,64 @@
+"""
+Single place where the payloads sent to supabase (insert, update, rpc) are serialized.
+
+to_json_payload() converts the whole payload in one pass to json builtins:
+- date, datetime, pd.Timestamp -> ISO 8601 string
+- Decimal                      -> string, so no precision is lost before postgres numeric
+- numpy / pandas scalars       -> python int, float, bool
+- None, NaN, NaT, pd.NA        -> None (NULL in postgres)
+
+orjson is used if installed, otherwise the standard library json module.
+
+Usage:
+    supabase_client.rpc('upsert_terms', to_json_payload({...})).execute()
+"""
+
+import json
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    """Called by the encoder only for the values that it cannot serialize natively."""
+    if obj is None or obj is pd.NaT or obj is pd.NA:
+        return None
+    if isinstance(obj, Decimal):
+        return None if obj.is_nan() else str(obj)
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, np.generic):
+        value = obj.item()
+        if isinstance(value, float) and value != value:
+            return None
+        return value
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        # orjson already writes NaN as null and handles numpy with OPT_SERIALIZE_NUMPY.
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, allow_nan=True).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    # NaN, Infinity and -Infinity are not valid json values for postgres.
+    return json.loads(data, parse_constant=lambda constant: None)
+
+
+def to_json_payload(obj):
+    return loads(dumps(obj))
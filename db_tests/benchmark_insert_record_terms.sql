@@ -0,0 +1,124 @@
+-- Benchmark of the per-term cost of insert_record and upsert_terms,
+-- for invoices with 1, 12 and 60 installments.
+-- The timings are printed with diag(), the thresholds are generous, they are
+-- only meant to catch a regression to one statement per term.
+
+begin;
+
+select plan(4);
+
+delete from fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+
+create function pg_temp.benchmark_terms(n_terms int, n_invoices int) returns table (
+    n_terms_per_invoice int,
+    insert_ms_per_term numeric,
+    upsert_ms_per_term numeric
+) as $$
+declare
+    started timestamptz;
+    insert_ms numeric;
+    upsert_ms numeric;
+    result jsonb;
+    numero text;
+    terms jsonb[];
+begin
+    -- insert_record
+    started := clock_timestamp();
+    for i in 1..n_invoices loop
+        numero := format('BENCH-%s-%s', n_terms, i);
+        terms := array(
+            select jsonb_build_object(
+                'rfe_partita_iva_prestatore', '12345678900',
+                'rfe_numero_fattura', numero,
+                'rfe_data_documento', '2024-01-01',
+                'rfe_data_scadenza_pagamento', (date '2024-01-01' + t * 30)::text,
+                'rfe_importo_pagamento_rata', 10,
+                'rfe_notes', format('Rata %s di %s', t, n_terms))
+            from generate_series(1, n_terms) t);
+
+        result := insert_record(
+            'fatture_emesse',
+            jsonb_build_object(
+                'fe_partita_iva_prestatore', '12345678900',
+                'fe_numero_fattura', numero,
+                'fe_data_documento', '2024-01-01',
+                'fe_importo_totale_documento', 10 * n_terms),
+            'rate_fatture_emesse',
+            terms,
+            get_uuid('utest0@gmail.com')::text);
+        if result->>'success' = 'false' then
+            raise exception 'insert_record failed: %', result;
+        end if;
+    end loop;
+    insert_ms := extract(epoch from clock_timestamp() - started) * 1000;
+
+    -- upsert_terms, rewriting the same terms. It uses auth.uid(), so I impersonate the test user.
+    perform set_config('request.jwt.claims',
+                       jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                       true);
+    started := clock_timestamp();
+    for i in 1..n_invoices loop
+        numero := format('BENCH-%s-%s', n_terms, i);
+        terms := array(
+            select jsonb_build_object(
+                'rfe_partita_iva_prestatore', '12345678900',
+                'rfe_numero_fattura', numero,
+                'rfe_data_documento', '2024-01-01',
+                'rfe_data_scadenza_pagamento', (date '2024-01-01' + t * 15)::text,
+                'rfe_importo_pagamento_rata', 10)
+            from generate_series(1, n_terms) t);
+
+        result := upsert_terms(
+            'rate_fatture_emesse',
+            jsonb_build_object('rfe_numero_fattura', numero, 'rfe_data_documento', '2024-01-01'),
+            terms);
+        if result->>'success' = 'false' then
+            raise exception 'upsert_terms failed: %', result;
+        end if;
+    end loop;
+    upsert_ms := extract(epoch from clock_timestamp() - started) * 1000;
+
+    return query select n_terms,
+                        round(insert_ms / (n_terms * n_invoices), 4),
+                        round(upsert_ms / (n_terms * n_invoices), 4);
+end;
+$$ language plpgsql;
+
+create temp table benchmark as
+select b.* from (values (1), (12), (60)) v(n),
+                lateral pg_temp.benchmark_terms(v.n, 20) b;
+
+select diag(format('%s terms per invoice: insert_record %s ms/term, upsert_terms %s ms/term',
+                   n_terms_per_invoice, insert_ms_per_term, upsert_ms_per_term))
+from benchmark order by n_terms_per_invoice;
+
+select is(
+    (select count(*) from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com'))::int,
+    20 * (1 + 12 + 60),
+    'All the terms are saved'
+       );
+
+select cmp_ok(
+    (select insert_ms_per_term from benchmark where n_terms_per_invoice = 60),
+    '<=',
+    (select insert_ms_per_term from benchmark where n_terms_per_invoice = 1),
+    'insert_record: per-term cost does not grow with the number of terms'
+       );
+
+select cmp_ok(
+    (select upsert_ms_per_term from benchmark where n_terms_per_invoice = 60),
+    '<=',
+    (select upsert_ms_per_term from benchmark where n_terms_per_invoice = 1),
+    'upsert_terms: per-term cost does not grow with the number of terms'
+       );
+
+select cmp_ok(
+    (select max(insert_ms_per_term + upsert_ms_per_term) from benchmark),
+    '<',
+    50::numeric,
+    'Less than 50 ms per term in the worst case'
+       );
+
+select * from finish();
+rollback;
@@ -0,0 +1,106 @@
+begin;
+
+select plan(7);
+
+delete from fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+
+-- apply_terms_delta uses auth.uid(), so I impersonate the test user.
+select set_config('request.jwt.claims',
+                  jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                  true);
+
+insert into fatture_emesse (user_id, fe_partita_iva_prestatore, fe_numero_fattura, fe_data_documento, fe_importo_totale_documento)
+values (get_uuid('utest0@gmail.com'), '12345678900', 'DELTA-1', '2024-01-01', 300);
+
+insert into rate_fatture_emesse (user_id, rfe_partita_iva_prestatore, rfe_numero_fattura, rfe_data_documento,
+                                 rfe_data_scadenza_pagamento, rfe_importo_pagamento_rata, rfe_nome_cassa)
+values (get_uuid('utest0@gmail.com'), '12345678900', 'DELTA-1', '2024-01-01', '2024-02-01', 100, 'Cassa A'),
+       (get_uuid('utest0@gmail.com'), '12345678900', 'DELTA-1', '2024-01-01', '2024-03-01', 100, 'Cassa A'),
+       (get_uuid('utest0@gmail.com'), '12345678900', 'DELTA-1', '2024-01-01', '2024-04-01', 100, 'Cassa A');
+
+create temp table terms_before as
+select id, rfe_data_scadenza_pagamento, updated_at from rate_fatture_emesse
+where user_id = get_uuid('utest0@gmail.com');
+
+-- Mark the first term paid, delete the third, add a new one.
+select is(
+    (select apply_terms_delta(
+        'rate_fatture_emesse',
+        '{"rfe_numero_fattura": "DELTA-1", "rfe_data_documento": "2024-01-01"}'::jsonb,
+        '[{"rfe_partita_iva_prestatore": "12345678900", "rfe_data_scadenza_pagamento": "2024-05-01",
+           "rfe_importo_pagamento_rata": 100}]'::jsonb,
+        jsonb_build_array(jsonb_build_object(
+            'id', (select id from terms_before where rfe_data_scadenza_pagamento = '2024-02-01'),
+            'rfe_data_pagamento_rata', '2024-02-01')),
+        jsonb_build_array((select id from terms_before where rfe_data_scadenza_pagamento = '2024-04-01'))
+    )->>'success'),
+    'true',
+    'Delta applied'
+       );
+
+select is(
+    (select rfe_data_pagamento_rata from rate_fatture_emesse
+     where id = (select id from terms_before where rfe_data_scadenza_pagamento = '2024-02-01')),
+    '2024-02-01'::date,
+    'Updated term is paid'
+       );
+
+select is(
+    (select rfe_nome_cassa from rate_fatture_emesse
+     where id = (select id from terms_before where rfe_data_scadenza_pagamento = '2024-02-01')),
+    'Cassa A',
+    'Fields not in the delta keep their value'
+       );
+
+select set_eq(
+    'select rfe_data_scadenza_pagamento from rate_fatture_emesse where user_id = get_uuid(''utest0@gmail.com'')',
+    $$values ('2024-02-01'::date), ('2024-03-01'::date), ('2024-05-01'::date)$$,
+    'Third term deleted, new term inserted, second term untouched'
+       );
+
+-- A term of another document is never touched, and nothing is saved.
+select is(
+    (select apply_terms_delta(
+        'rate_fatture_emesse',
+        '{"rfe_numero_fattura": "OTHER", "rfe_data_documento": "2024-01-01"}'::jsonb,
+        '[]'::jsonb,
+        '[]'::jsonb,
+        jsonb_build_array((select id from terms_before where rfe_data_scadenza_pagamento = '2024-03-01'))
+    )->>'success'),
+    'false',
+    'Deleting a term of another document fails'
+       );
+
+-- A term modified after it was loaded is not overwritten.
+select is(
+    (select apply_terms_delta(
+        'rate_fatture_emesse',
+        '{"rfe_numero_fattura": "DELTA-1", "rfe_data_documento": "2024-01-01"}'::jsonb,
+        '[]'::jsonb,
+        jsonb_build_array(jsonb_build_object(
+            'id', (select id from terms_before where rfe_data_scadenza_pagamento = '2024-03-01'),
+            'rfe_notes', 'stale',
+            'updated_at', '2000-01-01T00:00:00+00:00'))
+    )->>'success'),
+    'false',
+    'Updating a term with an old updated_at fails'
+       );
+
+select is(
+    (select jsonb_array_length(apply_terms_delta(
+        'rate_fatture_emesse',
+        '{"rfe_numero_fattura": "DELTA-1", "rfe_data_documento": "2024-01-01"}'::jsonb,
+        '[]'::jsonb,
+        jsonb_build_array(jsonb_build_object(
+            'id', (select id from terms_before where rfe_data_scadenza_pagamento = '2024-03-01'),
+            'rfe_notes', 'current',
+            'updated_at', (select updated_at from rate_fatture_emesse
+                           where id = (select id from terms_before where rfe_data_scadenza_pagamento = '2024-03-01'))))
+    )->'rows')),
+    1,
+    'The updated term is returned'
+       );
+
+select * from finish();
+rollback;
@@ -0,0 +1,74 @@
+begin;
+
+select plan(4);
+
+delete from fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+
+-- apply_terms_deltas uses auth.uid(), so I impersonate the test user.
+select set_config('request.jwt.claims',
+                  jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                  true);
+
+insert into fatture_emesse (user_id, fe_partita_iva_prestatore, fe_numero_fattura, fe_data_documento, fe_importo_totale_documento)
+values (get_uuid('utest0@gmail.com'), '12345678900', 'BUFFER-1', '2024-01-01', 100),
+       (get_uuid('utest0@gmail.com'), '12345678900', 'BUFFER-2', '2024-01-01', 100);
+
+insert into rate_fatture_emesse (user_id, rfe_partita_iva_prestatore, rfe_numero_fattura, rfe_data_documento,
+                                 rfe_data_scadenza_pagamento, rfe_importo_pagamento_rata)
+values (get_uuid('utest0@gmail.com'), '12345678900', 'BUFFER-1', '2024-01-01', '2024-02-01', 100),
+       (get_uuid('utest0@gmail.com'), '12345678900', 'BUFFER-2', '2024-01-01', '2024-02-01', 100);
+
+create temp table terms_before as
+select id, rfe_numero_fattura from rate_fatture_emesse
+where user_id = get_uuid('utest0@gmail.com');
+
+-- The second document refers to a term of the first one, so it must fail.
+select is(
+    (select apply_terms_deltas(jsonb_build_array(
+        jsonb_build_object('table_name', 'rate_fatture_emesse',
+                           'document_key', '{"rfe_numero_fattura": "BUFFER-1", "rfe_data_documento": "2024-01-01"}'::jsonb,
+                           'updated', jsonb_build_array(jsonb_build_object(
+                               'id', (select id from terms_before where rfe_numero_fattura = 'BUFFER-1'),
+                               'rfe_data_pagamento_rata', '2024-02-01'))),
+        jsonb_build_object('table_name', 'rate_fatture_emesse',
+                           'document_key', '{"rfe_numero_fattura": "BUFFER-2", "rfe_data_documento": "2024-01-01"}'::jsonb,
+                           'deleted', jsonb_build_array((select id from terms_before where rfe_numero_fattura = 'BUFFER-1')))
+    ))->>'document')::int,
+    1,
+    'The failing document is reported'
+       );
+
+select is(
+    (select count(*)::int from rate_fatture_emesse
+     where user_id = get_uuid('utest0@gmail.com') and rfe_data_pagamento_rata is not null),
+    0,
+    'The changes of the other documents are rolled back'
+       );
+
+select is(
+    (select apply_terms_deltas(jsonb_build_array(
+        jsonb_build_object('table_name', 'rate_fatture_emesse',
+                           'document_key', '{"rfe_numero_fattura": "BUFFER-1", "rfe_data_documento": "2024-01-01"}'::jsonb,
+                           'updated', jsonb_build_array(jsonb_build_object(
+                               'id', (select id from terms_before where rfe_numero_fattura = 'BUFFER-1'),
+                               'rfe_data_pagamento_rata', '2024-02-01'))),
+        jsonb_build_object('table_name', 'rate_fatture_emesse',
+                           'document_key', '{"rfe_numero_fattura": "BUFFER-2", "rfe_data_documento": "2024-01-01"}'::jsonb,
+                           'updated', jsonb_build_array(jsonb_build_object(
+                               'id', (select id from terms_before where rfe_numero_fattura = 'BUFFER-2'),
+                               'rfe_data_pagamento_rata', '2024-02-01')))
+    ))->>'updated')::int,
+    2,
+    'Two documents saved with one call'
+       );
+
+select is(
+    (select count(*)::int from rate_fatture_emesse
+     where user_id = get_uuid('utest0@gmail.com') and rfe_data_pagamento_rata = '2024-02-01'),
+    2,
+    'Both documents are updated'
+       );
+
+select * from finish();
+rollback;
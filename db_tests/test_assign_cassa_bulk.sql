@@ -0,0 +1,66 @@
+begin;
+
+select plan(5);
+
+delete from fatture_ricevute where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com');
+
+-- assign_cassa_bulk uses auth.uid(), so I impersonate the test user.
+select set_config('request.jwt.claims',
+                  jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                  true);
+
+-- 100 invoices from ACME and 50 from another supplier, one term each in january.
+insert into fatture_ricevute (user_id, fr_partita_iva_prestatore, fr_denominazione_prestatore,
+                              fr_numero_fattura, fr_data_documento, fr_importo_totale_documento)
+select get_uuid('utest0@gmail.com'),
+       case when i <= 100 then '09876543210' else '01234567890' end,
+       case when i <= 100 then 'ACME S.r.l.' else 'Altro Fornitore' end,
+       format('CASSA-%s', i), '2024-01-01', 100
+from generate_series(1, 150) i;
+
+insert into rate_fatture_ricevute (user_id, rfr_partita_iva_prestatore, rfr_numero_fattura, rfr_data_documento,
+                                   rfr_data_scadenza_pagamento, rfr_importo_pagamento_rata)
+select get_uuid('utest0@gmail.com'),
+       case when i <= 100 then '09876543210' else '01234567890' end,
+       format('CASSA-%s', i), '2024-01-01', '2024-01-01'::date + (i % 31), 100
+from generate_series(1, 150) i;
+
+select is(
+    (select assign_cassa_bulk('rate_fatture_ricevute', 'Cassa Test', counterparty => 'acme', preview => true)->>'matched')::int,
+    100,
+    'The preview counts the terms of the counterparty, case insensitive'
+       );
+
+select is(
+    (select count(*)::int from rate_fatture_ricevute
+     where user_id = get_uuid('utest0@gmail.com') and rfr_display_cassa is not null),
+    0,
+    'The preview does not update'
+       );
+
+select is(
+    (select assign_cassa_bulk('rate_fatture_ricevute', 'Cassa Test', counterparty => '0987654',
+                              due_from => '2024-01-01', due_to => '2024-01-15')->>'matched')::int,
+    (select count(*)::int from rate_fatture_ricevute
+     where user_id = get_uuid('utest0@gmail.com') and rfr_partita_iva_prestatore = '09876543210'
+       and rfr_data_scadenza_pagamento <= '2024-01-15'),
+    'Filter by partita iva and due date range'
+       );
+
+select is(
+    (select assign_cassa_bulk('rate_fatture_ricevute', 'Altra Cassa')->>'matched')::int,
+    (select count(*)::int from rate_fatture_ricevute
+     where user_id = get_uuid('utest0@gmail.com') and rfr_display_cassa is null),
+    'Only the unassigned terms are updated by default'
+       );
+
+select is(
+    (select assign_cassa_bulk('rate_fatture_ricevute', 'Cassa Test', only_unassigned => false)->>'matched')::int,
+    (select count(*)::int from rate_fatture_ricevute
+     where user_id = get_uuid('utest0@gmail.com') and rfr_display_cassa <> 'Cassa Test'),
+    'Terms that already have the cassa are not rewritten'
+       );
+
+select * from finish();
+rollback;
@@ -0,0 +1,55 @@
+begin;
+
+select plan(4);
+
+delete from fatture_ricevute where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com');
+
+-- bulk_update_terms uses auth.uid(), so I impersonate the test user.
+select set_config('request.jwt.claims',
+                  jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                  true);
+
+insert into fatture_ricevute (user_id, fr_partita_iva_prestatore, fr_numero_fattura, fr_data_documento, fr_importo_totale_documento)
+select get_uuid('utest0@gmail.com'), '09876543210', format('BULK-%s', i), '2024-01-01', 100
+from generate_series(1, 200) i;
+
+insert into rate_fatture_ricevute (user_id, rfr_partita_iva_prestatore, rfr_numero_fattura, rfr_data_documento,
+                                   rfr_data_scadenza_pagamento, rfr_importo_pagamento_rata)
+select get_uuid('utest0@gmail.com'), '09876543210', format('BULK-%s', i), '2024-01-01', '2024-01-31', 100
+from generate_series(1, 200) i;
+
+select is(
+    (select bulk_update_terms('rate_fatture_ricevute',
+                              (select array_agg(id) from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com')),
+                              'mark_paid', '2024-01-31')->>'updated')::int,
+    200,
+    'All the terms marked paid with one call'
+       );
+
+select is(
+    (select bulk_update_terms('rate_fatture_ricevute',
+                              (select array_agg(id) from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com')),
+                              'mark_paid', '2024-01-31')->>'updated')::int,
+    0,
+    'Terms already paid on that date are not rewritten'
+       );
+
+select bulk_update_terms('rate_fatture_ricevute',
+                         (select array_agg(id) from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com')),
+                         'shift_due', shift_months => 1);
+
+select set_eq(
+    'select distinct rfr_data_scadenza_pagamento from rate_fatture_ricevute where user_id = get_uuid(''utest0@gmail.com'')',
+    $$values ('2024-02-29'::date)$$,
+    'Due dates shifted by one month, to the end of the shorter month'
+      );
+
+select is(
+    (select bulk_update_terms('rate_fatture_ricevute', array[gen_random_uuid()], 'delete')->>'success'),
+    'false',
+    'Unknown operations are refused'
+       );
+
+select * from finish();
+rollback;
@@ -0,0 +1,48 @@
+begin;
+
+select plan(3);
+
+delete from fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+
+-- delete_documents uses auth.uid(), so I impersonate the test user.
+select set_config('request.jwt.claims',
+                  jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                  true);
+
+insert into fatture_emesse (user_id, fe_partita_iva_prestatore, fe_numero_fattura, fe_data_documento, fe_importo_totale_documento)
+select get_uuid('utest0@gmail.com'), '12345678900', format('DEL-%s', i), '2024-01-01', 100
+from generate_series(1, 300) i;
+
+-- Two terms per invoice.
+insert into rate_fatture_emesse (user_id, rfe_partita_iva_prestatore, rfe_numero_fattura, rfe_data_documento,
+                                 rfe_data_scadenza_pagamento, rfe_importo_pagamento_rata)
+select get_uuid('utest0@gmail.com'), '12345678900', format('DEL-%s', i), '2024-01-01', date '2024-01-31' + t * 30, 50
+from generate_series(1, 300) i, generate_series(0, 1) t;
+
+create temp table delete_result as select delete_documents(
+    'fatture_emesse',
+    (select array_agg(id) from fatture_emesse
+     where user_id = get_uuid('utest0@gmail.com') and fe_numero_fattura <> 'DEL-1')
+) as result;
+
+select results_eq(
+    $$select (result->>'documents')::int, (result->>'terms')::int from delete_result$$,
+    $$values (299, 598)$$,
+    'Invoices and cascaded terms counted'
+       );
+
+select is(
+    (select count(*) from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com'))::int,
+    2,
+    'Only the terms of the invoice not deleted are left'
+       );
+
+select is(
+    (select delete_documents('rate_fatture_emesse', array[gen_random_uuid()])->>'success'),
+    'false',
+    'Only document tables are accepted'
+       );
+
+select * from finish();
+rollback;
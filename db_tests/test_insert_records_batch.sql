@@ -0,0 +1,82 @@
+begin;
+
+select plan(5);
+
+delete from fatture_ricevute where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com');
+
+-- A valid invoice with two terms, the same invoice repeated in the batch.
+select insert_records_batch(
+               'fatture_ricevute'::text,
+               'rate_fatture_ricevute'::text,
+               '[
+                 {"record": {"fr_partita_iva_prestatore": "12345678901", "fr_numero_fattura": "INV-2024-045",
+                             "fr_data_documento": "2024-08-20", "fr_importo_totale_documento": 2000},
+                  "terms": [{"rfr_partita_iva_prestatore": "12345678901", "rfr_numero_fattura": "INV-2024-045",
+                             "rfr_data_documento": "2024-08-20", "rfr_data_scadenza_pagamento": "2024-09-20",
+                             "rfr_importo_pagamento_rata": 1000, "rfr_nome_cassa": "Conto Corrente Principale"},
+                            {"rfr_partita_iva_prestatore": "12345678901", "rfr_numero_fattura": "INV-2024-045",
+                             "rfr_data_documento": "2024-08-20", "rfr_data_scadenza_pagamento": "2024-10-20",
+                             "rfr_importo_pagamento_rata": 1000, "rfr_nome_cassa": "Conto Corrente Principale"}]},
+                 {"record": {"fr_partita_iva_prestatore": "12345678901", "fr_numero_fattura": "INV-2024-045",
+                             "fr_data_documento": "2024-08-20", "fr_importo_totale_documento": 2000},
+                  "terms": []}
+               ]'::jsonb,
+               get_uuid('utest0@gmail.com')::text
+       );
+
+select is(
+    (select count(*) from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com'))::int,
+    2,
+    'Terms of the first copy inserted once'
+       );
+
+-- Uploading again: the first is a duplicate, the second is valid, the third has no importo (NOT NULL).
+create temp table batch_result as select insert_records_batch(
+               'fatture_ricevute'::text,
+               'rate_fatture_ricevute'::text,
+               '[
+                 {"record": {"fr_partita_iva_prestatore": "12345678901", "fr_numero_fattura": "INV-2024-045",
+                             "fr_data_documento": "2024-08-20", "fr_importo_totale_documento": 2000},
+                  "terms": []},
+                 {"record": {"fr_partita_iva_prestatore": "12345678901", "fr_numero_fattura": "INV-2024-046",
+                             "fr_data_documento": "2024-08-21", "fr_importo_totale_documento": 500},
+                  "terms": [{"rfr_partita_iva_prestatore": "12345678901", "rfr_numero_fattura": "INV-2024-046",
+                             "rfr_data_documento": "2024-08-21", "rfr_data_scadenza_pagamento": "2024-09-21",
+                             "rfr_importo_pagamento_rata": 500}]},
+                 {"record": {"fr_partita_iva_prestatore": "12345678901", "fr_numero_fattura": "INV-2024-047",
+                             "fr_data_documento": "2024-08-22"},
+                  "terms": []}
+               ]'::jsonb,
+               get_uuid('utest0@gmail.com')::text
+       ) as result;
+
+create temp table batch_outcome as
+select item->>'status' as status
+from batch_result r, jsonb_array_elements(r.result->'results') item;
+
+select results_eq(
+    'select status from batch_outcome',
+    $$values ('duplicate'), ('inserted'), ('error')$$,
+    'One outcome per invoice, in order'
+       );
+
+select is(
+    (select count(*) from fatture_ricevute where user_id = get_uuid('utest0@gmail.com'))::int,
+    2,
+    'The bad invoice did not abort the batch'
+       );
+
+select is(
+    (select count(*) from rate_fatture_ricevute where user_id = get_uuid('utest0@gmail.com'))::int,
+    3,
+    'Terms of the valid invoice inserted'
+       );
+
+select set_eq(
+    'select distinct rfr_nome_cassa from rate_fatture_ricevute where user_id = get_uuid(''utest0@gmail.com'')',
+    'select null::varchar',
+    'Cassa removed from the received invoices terms, same as insert_record'
+      );
+
+select * from finish();
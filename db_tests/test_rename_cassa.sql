@@ -0,0 +1,48 @@
+begin;
+
+select plan(4);
+
+delete from fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+delete from casse where user_id = get_uuid('utest0@gmail.com');
+
+-- rename_cassa uses auth.uid(), so I impersonate the test user.
+select set_config('request.jwt.claims',
+                  jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                  true);
+
+insert into fatture_emesse (user_id, fe_partita_iva_prestatore, fe_numero_fattura, fe_data_documento, fe_importo_totale_documento)
+values (get_uuid('utest0@gmail.com'), '12345678900', 'CASSA-1', '2024-01-01', 300);
+
+insert into rate_fatture_emesse (user_id, rfe_partita_iva_prestatore, rfe_numero_fattura, rfe_data_documento,
+                                 rfe_data_scadenza_pagamento, rfe_importo_pagamento_rata,
+                                 rfe_nome_cassa, rfe_iban_cassa, rfe_display_cassa)
+select get_uuid('utest0@gmail.com'), '12345678900', 'CASSA-1', '2024-01-01', date '2024-01-01' + t, 1,
+       'Banca', 'IT60X0542811101000000123456', 'Banca'
+from generate_series(1, 300) t;
+
+-- A cassa read from the fatture emesse: no row in casse yet.
+create temp table rename_result as select rename_cassa(
+    null,
+    '{"c_nome_cassa": "Banca", "c_iban_cassa": "IT60X0542811101000000123456", "c_descrizione_cassa": null}'::jsonb,
+    '{"c_nome_cassa": "Banca", "c_iban_cassa": "IT60X0542811101000000123456", "c_descrizione_cassa": "Conto principale"}'::jsonb
+) as result;
+
+select is((select result->>'success' from rename_result), 'true', 'Cassa renamed');
+
+select is((select (result->>'rate_fatture_emesse')::int from rename_result), 300, 'All the terms counted');
+
+select set_eq(
+    'select distinct rfe_display_cassa from rate_fatture_emesse where user_id = get_uuid(''utest0@gmail.com'')',
+    $$values ('Conto principale'::varchar)$$,
+    'Display cassa updated on all the terms'
+      );
+
+select is(
+    (select c_descrizione_cassa from casse where user_id = get_uuid('utest0@gmail.com') and c_nome_cassa = 'Banca'),
+    'Conto principale',
+    'Cassa inserted in casse'
+       );
+
+select * from finish();
+rollback;
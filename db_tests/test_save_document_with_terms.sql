@@ -0,0 +1,80 @@
+begin;
+
+select plan(5);
+
+delete from movimenti_attivi where user_id = get_uuid('utest0@gmail.com');
+delete from rate_movimenti_attivi where user_id = get_uuid('utest0@gmail.com');
+
+-- save_document_with_terms uses auth.uid(), so I impersonate the test user.
+select set_config('request.jwt.claims',
+                  jsonb_build_object('sub', get_uuid('utest0@gmail.com'), 'role', 'authenticated')::text,
+                  true);
+
+insert into movimenti_attivi (user_id, ma_numero, ma_data, ma_importo_totale, ma_tipo)
+values (get_uuid('utest0@gmail.com'), 'SAVE-1', '2024-01-01', 100, 'Altro');
+
+insert into rate_movimenti_attivi (user_id, rma_numero, rma_data, rma_data_scadenza, rma_importo_pagamento)
+values (get_uuid('utest0@gmail.com'), 'SAVE-1', '2024-01-01', '2024-01-31', 30),
+       (get_uuid('utest0@gmail.com'), 'SAVE-1', '2024-01-01', '2024-02-29', 70);
+
+create temp table before as
+select m.id, m.updated_at,
+       (select id from rate_movimenti_attivi where rma_numero = 'SAVE-1' and rma_data_scadenza = '2024-01-31') as term_id,
+       (select updated_at from rate_movimenti_attivi where rma_numero = 'SAVE-1' and rma_data_scadenza = '2024-01-31') as term_updated_at
+from movimenti_attivi m
+where m.user_id = get_uuid('utest0@gmail.com') and m.ma_numero = 'SAVE-1';
+
+-- New number and total, and the first term rescaled, in one call.
+select is(
+    (select jsonb_array_length(save_document_with_terms(
+        'movimenti_attivi',
+        (select id from before),
+        '{"ma_numero": "SAVE-2", "ma_importo_totale": 200}'::jsonb,
+        (select updated_at from before),
+        updated => jsonb_build_array(jsonb_build_object(
+            'id', (select term_id from before),
+            'rma_importo_pagamento', 130,
+            'updated_at', (select term_updated_at from before)))
+    )->'terms')),
+    2,
+    'Document saved, all its terms returned'
+       );
+
+select set_eq(
+    'select rma_numero, rma_importo_pagamento from rate_movimenti_attivi where user_id = get_uuid(''utest0@gmail.com'')',
+    $$values ('SAVE-2'::varchar, 130::numeric), ('SAVE-2'::varchar, 70::numeric)$$,
+    'The key change reached the terms, and the delta was applied to them'
+       );
+
+-- Same updated_at read before the first save: the document was modified in the meantime.
+select is(
+    (select save_document_with_terms(
+        'movimenti_attivi',
+        (select id from before),
+        '{"ma_importo_totale": 300}'::jsonb,
+        '2000-01-01T00:00:00+00:00'
+    )->>'success'),
+    'false',
+    'A stale document is not saved'
+       );
+
+-- A failing terms delta rolls back the document update too.
+select is(
+    (select save_document_with_terms(
+        'movimenti_attivi',
+        (select id from before),
+        '{"ma_importo_totale": 300}'::jsonb,
+        deleted => jsonb_build_array(gen_random_uuid())
+    )->>'success'),
+    'false',
+    'Deleting a term that does not exist fails'
+       );
+
+select is(
+    (select ma_importo_totale from movimenti_attivi where id = (select id from before)),
+    200::numeric,
+    'The document is unchanged after the failure'
+       );
+
+select * from finish();
+rollback;
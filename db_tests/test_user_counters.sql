@@ -0,0 +1,68 @@
+begin;
+
+select plan(6);
+
+delete from fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+delete from rate_fatture_emesse where user_id = get_uuid('utest0@gmail.com');
+
+-- Two invoices in one statement, terms only for the first one.
+insert into fatture_emesse (user_id, fe_partita_iva_prestatore, fe_numero_fattura, fe_data_documento, fe_importo_totale_documento)
+values (get_uuid('utest0@gmail.com'), '12345678900', 'CNT-1', '2024-01-01', 300),
+       (get_uuid('utest0@gmail.com'), '12345678900', 'CNT-2', '2024-01-02', 50);
+
+insert into rate_fatture_emesse (user_id, rfe_partita_iva_prestatore, rfe_numero_fattura, rfe_data_documento,
+                                 rfe_data_scadenza_pagamento, rfe_importo_pagamento_rata)
+values (get_uuid('utest0@gmail.com'), '12345678900', 'CNT-1', '2024-01-01', '2024-02-01', 100),
+       (get_uuid('utest0@gmail.com'), '12345678900', 'CNT-1', '2024-01-01', '2024-03-01', 200);
+
+select results_eq(
+    $$select fatture_emesse_count, fatture_emesse_total, fatture_emesse_with_terms_count,
+             rate_fatture_emesse_count, rate_fatture_emesse_unpaid_count, rate_fatture_emesse_unpaid_total
+      from user_counters where user_id = get_uuid('utest0@gmail.com')$$,
+    $$values (2, 350::numeric, 1, 2, 2, 300::numeric)$$,
+    'Counters after the inserts'
+       );
+
+update rate_fatture_emesse set rfe_data_pagamento_rata = '2024-02-01'
+where user_id = get_uuid('utest0@gmail.com') and rfe_importo_pagamento_rata = 100;
+
+select results_eq(
+    $$select rate_fatture_emesse_unpaid_count, rate_fatture_emesse_unpaid_total
+      from user_counters where user_id = get_uuid('utest0@gmail.com')$$,
+    $$values (1, 200::numeric)$$,
+    'A paid term is no longer unpaid'
+       );
+
+delete from rate_fatture_emesse
+where user_id = get_uuid('utest0@gmail.com') and rfe_importo_pagamento_rata = 100;
+
+select is(
+    (select fatture_emesse_with_terms_count from user_counters where user_id = get_uuid('utest0@gmail.com')),
+    1,
+    'The invoice still has one term'
+       );
+
+-- Cascade from the invoice to its last term.
+delete from fatture_emesse where user_id = get_uuid('utest0@gmail.com') and fe_numero_fattura = 'CNT-1';
+
+select results_eq(
+    $$select fatture_emesse_count, fatture_emesse_total, fatture_emesse_with_terms_count,
+             rate_fatture_emesse_count, rate_fatture_emesse_unpaid_count, rate_fatture_emesse_unpaid_total
+      from user_counters where user_id = get_uuid('utest0@gmail.com')$$,
+    $$values (1, 50::numeric, 0, 0, 0, 0::numeric)$$,
+    'Counters after the cascade delete'
+       );
+
+select lives_ok(
+    'select refresh_user_counters()',
+    'Counters can be recomputed from the tables'
+       );
+
+select is(
+    (select fatture_emesse_count from user_counters where user_id = get_uuid('utest0@gmail.com')),
+    1,
+    'Recomputed counters match the triggers ones'
+       );
+
+select * from finish();
+rollback;
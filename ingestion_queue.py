@@ -0,0 +1,344 @@
+"""
+SQLite job queue of the xml uploads, processed in background by WORKERS daemon threads.
+
+The uploader calls enqueue_job() and polls get_job() / list_jobs(), the workers run
+process_xml_list() -> extract_xml_records() -> insert_records_batch() on FILES_PER_STEP
+files at a time and save the outcome of every file in job_files.
+
+Job status:   'queued' -> 'running' -> 'done' | 'failed'
+File outcome: NULL (to do), 'inserted', 'duplicate', 'error', same as invoice_batch_insert.py
+
+The RPCs need the user session: every render of the uploader calls register_client(), and
+the workers take only the jobs of the users with a registered client. The clients are kept
+in memory, after a restart the jobs wait for the user to open the upload page again, and
+restart from the first file without outcome.
+
+Uploading again the same files (same batch_id, the hash of the file hashes) resumes the
+job of the batch: only the files without outcome or in 'error' are processed again.
+A batch already completed without errors is a new job.
+"""
+
+import hashlib
+import io
+import os
+import sqlite3
+from contextlib import contextmanager
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+from invoice_xml_processor import process_xml_list
+from invoice_record_creation import extract_xml_records
+from invoice_batch_insert import insert_records_batch, ERROR
+from request_metrics import track_action
+import shared_cache
+
+QUEUE_DB_PATH = os.environ.get('INGESTION_QUEUE_DB',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingestion_jobs.sqlite3'))
+WORKERS = 2
+FILES_PER_STEP = 100
+POLL_INTERVAL_SECONDS = 1.0
+# Written by insert_records_batch.
+UPLOAD_TABLES = ['fatture_emesse', 'rate_fatture_emesse', 'fatture_ricevute', 'rate_fatture_ricevute']
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    batch_id TEXT,
+    partita_iva_azienda TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total_files INTEGER NOT NULL,
+    processed_files INTEGER NOT NULL DEFAULT 0,
+    error_message TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_user_idx ON jobs (user_id, created_at);
+CREATE INDEX IF NOT EXISTS jobs_batch_idx ON jobs (user_id, batch_id, created_at);
+
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    file_hash TEXT,
+    content BLOB,
+    outcome TEXT,
+    error_message TEXT,
+    PRIMARY KEY (job_id, position)
+);
+"""
+
+_clients = {}
+_clients_lock = threading.Lock()
+# Paths of the dbs whose schema was already created by this process, see connect().
+_schema_ready = set()
+_schema_lock = threading.Lock()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def connect(db_path = None):
+    """
+    The schema is created at the first connection to a db, so the pages that only read
+    the jobs, like record_cache.get_records(), work before the workers are started.
+    """
+    db_path = db_path or QUEUE_DB_PATH
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA foreign_keys=ON')
+    with _schema_lock:
+        if db_path not in _schema_ready:
+            with connection:
+                _create_schema(connection)
+            _schema_ready.add(db_path)
+    return connection
+
+
+@contextmanager
+def transaction(db_path = None):
+    """Short lived connection: commit on success, rollback on error, always closed."""
+    connection = connect(db_path)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+# Columns added after the first version of the schema, for the dbs already created.
+MIGRATIONS = {
+    'jobs': {'batch_id': 'TEXT'},
+    'job_files': {'file_hash': 'TEXT'},
+}
+
+
+def _create_schema(connection):
+    for table, columns in MIGRATIONS.items():
+        existing = {row['name'] for row in connection.execute(f'PRAGMA table_info({table})')}
+        if existing:
+            for column, column_type in columns.items():
+                if column not in existing:
+                    connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    connection.executescript(SCHEMA)
+
+
+def init_db(db_path = None):
+    """Called once when the workers start, the schema itself is created by connect()."""
+    with transaction(db_path) as connection:
+        # Jobs interrupted by a restart go back to the queue, see module docstring.
+        connection.execute('UPDATE jobs SET status = ? WHERE status = ?', (QUEUED, RUNNING))
+
+
+def register_client(user_id, supabase_client):
+    """Called at every render of the uploader, so the client with the freshest token is used."""
+    with _clients_lock:
+        _clients[user_id] = supabase_client
+
+
+def file_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def batch_id(file_hashes) -> str:
+    """Same files in any order, same batch."""
+    return hashlib.sha256(''.join(sorted(file_hashes)).encode()).hexdigest()
+
+
+def enqueue_job(user_id, partita_iva_azienda, files, db_path = None) -> str:
+    """
+    files: list of (filename, bytes), or objects with .name and .getvalue() like the
+           Streamlit UploadedFile.
+    return: job id, of a new job or of the resumed job of the same batch.
+    """
+    rows = []
+    for position, file in enumerate(files):
+        filename, content = file if isinstance(file, tuple) else (file.name, file.getvalue())
+        rows.append((position, filename, file_hash(content), content))
+    current_batch_id = batch_id(row[2] for row in rows)
+
+    with transaction(db_path) as connection:
+        job = connection.execute('SELECT * FROM jobs WHERE user_id = ? AND batch_id = ? ORDER BY created_at DESC LIMIT 1',
+                                 (user_id, current_batch_id)).fetchone()
+        if job is not None and job['status'] in (QUEUED, RUNNING):
+            return job['id']
+        if job is not None and _count_files_to_retry(connection, job['id']) > 0:
+            _resume(connection, job['id'], rows)
+            return job['id']
+
+        job_id = str(uuid.uuid4())
+        connection.execute('INSERT INTO jobs (id, user_id, batch_id, partita_iva_azienda, status, total_files, created_at) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (job_id, user_id, current_batch_id, partita_iva_azienda, QUEUED, len(rows), _now()))
+        connection.executemany('INSERT INTO job_files (job_id, position, filename, file_hash, content) VALUES (?, ?, ?, ?, ?)',
+                               [(job_id,) + row for row in rows])
+    return job_id
+
+
+def _count_files_to_retry(connection, job_id) -> int:
+    return connection.execute('SELECT count(*) FROM job_files WHERE job_id = ? AND (outcome IS NULL OR outcome = ?)',
+                              (job_id, ERROR)).fetchone()[0]
+
+
+def _resume(connection, job_id, rows):
+    """Back to the queue, with the new content for the files to process again, matched by hash."""
+    connection.executemany('UPDATE job_files SET content = ?, outcome = NULL, error_message = NULL '
+                           'WHERE job_id = ? AND file_hash = ? AND (outcome IS NULL OR outcome = ?)',
+                           [(content, job_id, hash_, ERROR) for position, filename, hash_, content in rows])
+    connection.execute('UPDATE jobs SET status = ?, error_message = NULL, finished_at = NULL, '
+                       'processed_files = (SELECT count(*) FROM job_files WHERE job_id = ? AND outcome IS NOT NULL) '
+                       'WHERE id = ?', (QUEUED, job_id, job_id))
+
+
+def resume_job(job_id, db_path = None) -> bool:
+    """
+    Back to the queue, for a failed job. Only the files without outcome still have their content,
+    the files in error need a new upload of the same files, see enqueue_job().
+    return: False if there is nothing to resume.
+    """
+    with transaction(db_path) as connection:
+        to_do = connection.execute('SELECT count(*) FROM job_files WHERE job_id = ? AND outcome IS NULL',
+                                   (job_id,)).fetchone()[0]
+        if to_do == 0:
+            return False
+        _resume(connection, job_id, [])
+    return True
+
+
+def get_job(job_id, db_path = None) -> dict | None:
+    """Job row plus the count of every file outcome."""
+    with transaction(db_path) as connection:
+        job = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        counts = connection.execute('SELECT outcome, count(*) AS n FROM job_files WHERE job_id = ? '
+                                    'AND outcome IS NOT NULL GROUP BY outcome', (job_id,)).fetchall()
+    return dict(job) | {'outcomes': {row['outcome']: row['n'] for row in counts}}
+
+
+def list_jobs(user_id, limit = 10, db_path = None) -> list[dict]:
+    with transaction(db_path) as connection:
+        ids = [row['id'] for row in connection.execute('SELECT id FROM jobs WHERE user_id = ? '
+                                                       'ORDER BY created_at DESC LIMIT ?', (user_id, limit))]
+    return [get_job(job_id, db_path) for job_id in ids]
+
+
+def get_job_files(job_id, outcomes = None, db_path = None) -> list[dict]:
+    """Per-file outcomes of a job, without the file content."""
+    query = 'SELECT position, filename, outcome, error_message FROM job_files WHERE job_id = ?'
+    params = [job_id]
+    if outcomes:
+        query += f" AND outcome IN ({', '.join('?' * len(outcomes))})"
+        params += list(outcomes)
+    with transaction(db_path) as connection:
+        return [dict(row) for row in connection.execute(query + ' ORDER BY position', params)]
+
+
+def _claim_next_job(connection):
+    with _clients_lock:
+        user_ids = list(_clients)
+    if not user_ids:
+        return None
+
+    # BEGIN IMMEDIATE takes the write lock, so two workers cannot claim the same job.
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        job = connection.execute(f"SELECT * FROM jobs WHERE status = ? AND user_id IN ({', '.join('?' * len(user_ids))}) "
+                                 'ORDER BY created_at LIMIT 1', [QUEUED] + user_ids).fetchone()
+        if job is not None:
+            connection.execute('UPDATE jobs SET status = ?, started_at = coalesce(started_at, ?) WHERE id = ?',
+                               (RUNNING, _now(), job['id']))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return job
+
+
+def process_job(job, supabase_client, connection):
+    """Runs the upload pipeline on the files without outcome, FILES_PER_STEP at a time."""
+    while True:
+        rows = connection.execute('SELECT position, filename, content FROM job_files '
+                                  'WHERE job_id = ? AND outcome IS NULL ORDER BY position LIMIT ?',
+                                  (job['id'], FILES_PER_STEP)).fetchall()
+        if not rows:
+            return
+
+        files = []
+        for row in rows:
+            file = io.BytesIO(row['content'])
+            file.name = row['filename']
+            files.append(file)
+
+        parsing_results, error = process_xml_list(files)
+        if parsing_results:
+            xml_records = extract_xml_records(parsing_results, job['partita_iva_azienda'])
+            with track_action('upload batch'):
+                outcomes = insert_records_batch(supabase_client, xml_records, job['user_id'])
+            # The cached reads of all the sessions of the user are stale now.
+            shared_cache.bump_version(job['user_id'], *UPLOAD_TABLES)
+            # An outcome is always set, otherwise the file would be processed again forever.
+            results = [(o['outcome'] or ERROR, o['error_message']) for o in outcomes]
+        else:
+            results = [(ERROR, f'XML ERROR: {error}')] * len(rows)
+
+        # The content is not needed anymore, only the outcome is kept.
+        connection.executemany('UPDATE job_files SET outcome = ?, error_message = ?, content = NULL '
+                               'WHERE job_id = ? AND position = ?',
+                               [(outcome, message, job['id'], row['position'])
+                                for row, (outcome, message) in zip(rows, results)])
+        connection.execute('UPDATE jobs SET processed_files = processed_files + ? WHERE id = ?',
+                           (len(rows), job['id']))
+        connection.commit()
+
+
+def _worker_loop(db_path = None):
+    connection = connect(db_path)
+    while True:
+        job = None
+        try:
+            job = _claim_next_job(connection)
+            if job is None:
+                time.sleep(POLL_INTERVAL_SECONDS)
+                continue
+
+            with _clients_lock:
+                supabase_client = _clients[job['user_id']]
+
+            process_job(job, supabase_client, connection)
+            connection.execute('UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?', (DONE, _now(), job['id']))
+            connection.commit()
+        except Exception as e:
+            print(f'ERROR: ingestion job {job["id"] if job else None} failed: {e}')
+            traceback.print_exc()
+            connection.rollback()
+            if job is not None:
+                connection.execute('UPDATE jobs SET status = ?, finished_at = ?, error_message = ? WHERE id = ?',
+                                   (FAILED, _now(), str(e), job['id']))
+                connection.commit()
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def start_workers(n_workers = WORKERS, db_path = None):
+    """Idempotent, the workers are started only once per server process."""
+    with _workers_lock:
+        if _workers:
+            return
+        init_db(db_path)
+        for i in range(n_workers):
+            worker = threading.Thread(target=_worker_loop, args=(db_path,), name=f'ingestion-worker-{i}', daemon=True)
+            worker.start()
+            _workers.append(worker)
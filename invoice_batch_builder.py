@@ -0,0 +1,243 @@
+"""
+Columnar version of extract_xml_records() in invoice_record_creation.py, for big batches.
+
+extract_xml_records() builds the record and the terms of every invoice with nested
+dict loops, duplicated for emessa and ricevuta. Here the whole list of parsed invoices
+becomes two tables:
+- invoices: one row per parsed file, with filename, status, error_message, invoice_type
+            and all the UNPREFIXED parsed fields.
+- terms:    one row per term, obtained exploding the list-valued fields
+            data_scadenza_pagamento, importo_pagamento_rata, iban_cassa, nome_cassa.
+Both tables have a 'row' column, which is the position of the file in the input list,
+so results can always be matched back to the uploaded file.
+
+Same business rules as extract_xml_records():
+- data_scadenza_pagamento None -> [data_documento]
+- importo_pagamento_rata None -> [importo_totale_documento]
+- iban_cassa, nome_cassa None -> [None] * number of terms
+- all the term lists must have the same len(), otherwise the file is in error.
+Differently from extract_xml_records(), a wrong file does not raise an AssertionError
+but it is marked with status 'error', so one bad file does not stop the batch.
+
+Here I do NO CONVERSION, still all values in strings or None, same as extract_xml_records().
+
+get_prefixed_tables() selects the emesse or the ricevute and applies the table prefixes,
+keeping only the columns present in the sql tables (see sql_schema.py), so that
+the output can go straight to a bulk insert.
+
+BENCHMARK:
+Usage: python3 invoice_batch_builder.py [n_invoices]
+Times extract_xml_records() against build_record_tables() + get_prefixed_tables()
+on n_invoices synthetic parsed invoices, 10000 by default.
+"""
+
+import sys
+import time
+import tracemalloc
+from itertools import chain
+import numpy as np
+import pandas as pd
+from sql_schema import get_field_names
+
+TERM_LIST_FIELDS = ['data_scadenza_pagamento', 'importo_pagamento_rata', 'iban_cassa', 'nome_cassa']
+
+# Fields needed for the business logic, that could be missing in the data dict
+# of files in error.
+REQUIRED_COLUMNS = ['partita_iva_prestatore', 'partita_iva_committente',
+                    'numero_fattura', 'data_documento', 'importo_totale_documento'] + TERM_LIST_FIELDS
+
+INVOICE_TYPE_PREFIXES = {
+    'emessa': 'fe_',
+    'ricevuta': 'fr_',
+}
+
+
+def _to_list(value, default):
+    """Same as the isinstance() branches in extract_xml_records()."""
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        # Be sure to not do list('string') otherwise ['s' 't' 'r' 'i' 'n' 'g']
+        return [value]
+    if value is None:
+        return default
+    return None
+
+
+def _list_len(values: pd.Series) -> pd.Series:
+    # -1 for values that are not a list, i.e. wrong types.
+    return pd.Series([len(value) if isinstance(value, list) else -1 for value in values],
+                     index=values.index)
+
+
+def build_record_tables(parsing_results, partita_iva_azienda) -> (pd.DataFrame, pd.DataFrame):
+    """
+    parsing_results: output of process_xml_list().
+    return: invoices, terms tables, see module docstring.
+    """
+    if not parsing_results:
+        return pd.DataFrame(columns=['row', 'filename', 'status', 'error_message', 'invoice_type'] + REQUIRED_COLUMNS), \
+               pd.DataFrame(columns=['row', 'invoice_type', 'partita_iva_prestatore', 'numero_fattura', 'data_documento'] + TERM_LIST_FIELDS)
+
+    invoices = pd.DataFrame({
+        'row': range(len(parsing_results)),
+        'filename': [xml['filename'] for xml in parsing_results],
+        'status': [xml['status'] for xml in parsing_results],
+        'error_message': [xml['error_message'] or '' for xml in parsing_results],
+    })
+
+    data = pd.DataFrame.from_records([xml['data'] or {} for xml in parsing_results],
+                                     index=invoices.index)
+    data = data.reindex(columns=list(dict.fromkeys(list(data.columns) + REQUIRED_COLUMNS)))
+    # NaN from missing keys to None, so the output can be serialized as is.
+    data = data.astype(object).where(data.notna(), None)
+    invoices = pd.concat([invoices, data], axis=1)
+
+    ok = invoices['status'] != 'error'
+
+    # Invoice type
+    invoices['invoice_type'] = 'unknown'
+    is_emessa = invoices['partita_iva_prestatore'] == partita_iva_azienda
+    is_ricevuta = ~is_emessa & (invoices['partita_iva_committente'] == partita_iva_azienda)
+    invoices.loc[is_emessa, 'invoice_type'] = 'emessa'
+    invoices.loc[is_ricevuta, 'invoice_type'] = 'ricevuta'
+
+    unknown_type = ok & (invoices['invoice_type'] == 'unknown')
+    invoices.loc[unknown_type, 'error_message'] += ("RECORD CREATION: La fattura " + invoices.loc[unknown_type, 'filename'].astype(str)
+                                                    + f" non riguarda la partita IVA {partita_iva_azienda}")
+    ok &= ~unknown_type
+
+    # Terms defaulting
+    invoices['data_scadenza_pagamento'] = [_to_list(value, [default]) for value, default in
+                                           zip(invoices['data_scadenza_pagamento'], invoices['data_documento'])]
+    invoices['importo_pagamento_rata'] = [_to_list(value, [default]) for value, default in
+                                          zip(invoices['importo_pagamento_rata'], invoices['importo_totale_documento'])]
+
+    wrong_type = ok & (invoices['data_scadenza_pagamento'].isna() | invoices['importo_pagamento_rata'].isna())
+    invoices.loc[wrong_type, 'error_message'] += "RECORD CREATION: terms fields do not match desired types."
+    ok &= ~wrong_type
+
+    n_terms = _list_len(invoices['data_scadenza_pagamento'])
+    for field in ['iban_cassa', 'nome_cassa']:
+        invoices[field] = [_to_list(value, [None] * n) if n >= 0 else None for value, n in
+                           zip(invoices[field], n_terms)]
+
+    # Length validation
+    wrong_len = pd.Series(False, index=invoices.index)
+    for field in TERM_LIST_FIELDS[1:]:
+        wrong_len |= _list_len(invoices[field]) != n_terms
+    wrong_len &= ok
+    invoices.loc[wrong_len, 'error_message'] += "RECORD CREATION: Terms fields' len() does not match."
+    ok &= ~wrong_len
+
+    invoices.loc[~ok, 'status'] = 'error'
+
+    # Explode: scalar columns are repeated len(terms) times, list columns are flattened.
+    selected = invoices[ok]
+    repeats = n_terms[ok].to_numpy()
+    terms = pd.DataFrame({
+        column: np.repeat(selected[column].to_numpy(), repeats)
+        for column in ['row', 'invoice_type', 'partita_iva_prestatore', 'numero_fattura', 'data_documento']
+    })
+    for field in TERM_LIST_FIELDS:
+        terms[field] = list(chain.from_iterable(selected[field]))
+
+    return invoices, terms
+
+
+def get_prefixed_tables(invoices, terms, invoice_type) -> (pd.DataFrame, pd.DataFrame):
+    """
+    invoice_type: 'emessa' or 'ricevuta'
+    return: records and terms of invoice_type, with prefixed sql column names plus the 'row' column.
+    """
+    prefix = INVOICE_TYPE_PREFIXES[invoice_type]
+    rate_prefix = 'r' + prefix
+
+    selected = invoices[(invoices['status'] != 'error') & (invoices['invoice_type'] == invoice_type)]
+    record_fields = get_field_names(prefix)
+    records = selected[[c for c in selected.columns if c in record_fields]].add_prefix(prefix)
+    records.insert(0, 'row', selected['row'])
+
+    selected_terms = terms[terms['invoice_type'] == invoice_type]
+    term_fields = get_field_names(rate_prefix)
+    prefixed_terms = selected_terms[[c for c in selected_terms.columns if c in term_fields]].add_prefix(rate_prefix)
+    prefixed_terms.insert(0, 'row', selected_terms['row'])
+
+    return records.reset_index(drop=True), prefixed_terms.reset_index(drop=True)
+
+
+def to_record_payloads(records, terms) -> list[dict]:
+    """
+    From the output of get_prefixed_tables() to the {'row', 'record', 'terms'} dicts
+    used by the insert functions.
+    """
+    terms_by_row = {row: group.drop(columns='row').to_dict('records')
+                    for row, group in terms.groupby('row', sort=False)}
+
+    payloads = []
+    for record in records.to_dict('records'):
+        row = record.pop('row')
+        payloads.append({'row': row, 'record': record, 'terms': terms_by_row.get(row, [])})
+    return payloads
+
+
+def _synthetic_parsing_results(n_invoices, partita_iva_azienda):
+    parsing_results = []
+    for i in range(n_invoices):
+        is_emessa = i % 2 == 0
+        n_terms = i % 4
+        data = {
+            'numero_fattura': f'{i}/2025',
+            'data_documento': '2025-03-31',
+            'importo_totale_documento': '1200.00',
+            'partita_iva_prestatore': partita_iva_azienda if is_emessa else '09876543210',
+            'partita_iva_committente': '08498730723' if is_emessa else partita_iva_azienda,
+            'codice_fiscale_committente': None,
+            'denominazione_committente': 'Cliente S.r.l.',
+            'nome_committente': None,
+            'cognome_committente': None,
+            'denominazione_prestatore': None if is_emessa else 'Fornitore S.p.A.',
+            'data_scadenza_pagamento': None,
+            'importo_pagamento_rata': None,
+            'iban_cassa': None,
+            'nome_cassa': None,
+        }
+        if n_terms == 1:
+            data['data_scadenza_pagamento'] = '2025-04-30'
+            data['importo_pagamento_rata'] = '1200.00'
+        elif n_terms > 1:
+            data['data_scadenza_pagamento'] = [f'2025-0{4 + t}-30' for t in range(n_terms)]
+            data['importo_pagamento_rata'] = ['400.00'] * n_terms
+            data['iban_cassa'] = ['IT60X0542811101000000123456'] * n_terms
+        parsing_results.append({'filename': f'{i}.xml', 'data': data, 'status': 'success', 'error_message': ''})
+    return parsing_results
+
+
+if __name__ == '__main__':
+    from invoice_record_creation import extract_xml_records
+
+    n_invoices = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    partita_iva_azienda = '12345678900'
+    parsing_results = _synthetic_parsing_results(n_invoices, partita_iva_azienda)
+
+    start = time.perf_counter()
+    extract_xml_records(parsing_results, partita_iva_azienda)
+    per_dict_time = time.perf_counter() - start
+
+    # Memory: the records and terms built, plus what extract_xml_records() allocates on the way.
+    tracemalloc.start()
+    records = extract_xml_records(parsing_results, partita_iva_azienda)
+    per_dict_memory, per_dict_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+
+    start = time.perf_counter()
+    invoices, terms = build_record_tables(parsing_results, partita_iva_azienda)
+    for invoice_type in INVOICE_TYPE_PREFIXES:
+        get_prefixed_tables(invoices, terms, invoice_type)
+    columnar_time = time.perf_counter() - start
+
+    print(f'{n_invoices} invoices, {len(terms)} terms')
+    print(f'extract_xml_records:  {per_dict_time:.3f} s, '
+          f'{per_dict_memory / 2**20:.1f} MiB held, {per_dict_peak / 2**20:.1f} MiB peak')
+    print(f'build_record_tables:  {columnar_time:.3f} s')
@@ -0,0 +1,262 @@
+"""
+Python side of the insert_records_batch RPC (see sql/02_create_tables.sql): the output of
+extract_xml_records() is grouped by table and sent in chunks of BATCH_SIZE invoices.
+
+Every invoice gets an outcome, so one bad invoice does not abort the others:
+- 'inserted':  invoice and terms saved.
+- 'duplicate': already in the database, or repeated in the upload, see mark_duplicates().
+- 'error':     not saved, error_message has the reason.
+
+The calls run in a thread pool of MAX_IN_FLIGHT (map_concurrently()), each retried
+RETRIES times on network errors. Without insert_records_batch in the database,
+insert_records_concurrently() calls insert_record once per invoice.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from db_serialization import to_json_payload
+
+BATCH_SIZE = 200
+MAX_IN_FLIGHT = 8
+RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+
+# Connection errors and timeouts. Errors returned by postgres are not transient,
+# retrying them would give the same result.
+# NOTE: if a timeout happens after the insert is committed, the retry will find the
+# invoice already there, and the outcome will be 'duplicate' instead of 'inserted'.
+TRANSIENT_ERRORS = (httpx.TransportError,)
+
+# PostgREST error code for a function not found in the schema cache.
+FUNCTION_NOT_FOUND = 'PGRST202'
+
+INVOICE_TABLES = {
+    'emessa': 'fatture_emesse',
+    'ricevuta': 'fatture_ricevute',
+}
+
+INVOICE_PREFIXES = {
+    'emessa': 'fe_',
+    'ricevuta': 'fr_',
+}
+
+# Same columns of the unique constraints of fatture_emesse and fatture_ricevute, user_id apart.
+INVOICE_KEY_FIELDS = ('partita_iva_prestatore', 'numero_fattura', 'data_documento')
+
+INSERTED = 'inserted'
+DUPLICATE = 'duplicate'
+ERROR = 'error'
+
+
+def prepare_terms(xml_record):
+    """
+    This is for the casse manage flow: the first time that I insert a record I have to
+    assign a value to the display field.
+    For ricevute I force None, because I should not get any cassa at the beginning.
+    """
+    if xml_record['invoice_type'] == 'emessa':
+        for term in xml_record['terms']:
+            term['rfe_display_cassa'] = term.get('rfe_nome_cassa') or term.get('rfe_iban_cassa', None)
+    elif xml_record['invoice_type'] == 'ricevuta':
+        for term in xml_record['terms']:
+            term['rfr_display_cassa'] = None
+    return xml_record['terms']
+
+
+def call_with_retries(function, *args, retries = RETRIES, backoff = None):
+    """Calls function(*args), retrying with exponential backoff on TRANSIENT_ERRORS only."""
+    backoff = RETRY_BACKOFF_SECONDS if backoff is None else backoff
+    for attempt in range(retries + 1):
+        try:
+            return function(*args)
+        except TRANSIENT_ERRORS as e:
+            if attempt == retries:
+                raise
+            print(f'WARNING: transient error, retry {attempt + 1} of {retries}: {e}')
+            time.sleep(backoff * 2 ** attempt)
+
+
+def map_concurrently(function, items, max_in_flight = MAX_IN_FLIGHT, retries = RETRIES) -> list:
+    """
+    Same as [function(item) for item in items], with at most max_in_flight calls at the same time.
+    Results are in input order. An exception of one call is returned in place of its result,
+    so that it does not stop the others.
+    """
+    def run(item):
+        try:
+            return call_with_retries(function, item, retries = retries)
+        except Exception as e:
+            return e
+
+    if max_in_flight <= 1 or len(items) <= 1:
+        return [run(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers = min(max_in_flight, len(items))) as executor:
+        # executor.map() yields in input order, regardless of the completion order.
+        return list(executor.map(run, items))
+
+
+def _new_outcomes(xml_records) -> list[dict]:
+    return [{
+        'filename': xml['filename'],
+        'invoice_type': xml['invoice_type'],
+        'outcome': ERROR if xml['status'] == 'error' else None,
+        'error_message': xml['error_message'],
+    } for xml in xml_records]
+
+
+def invoice_key(xml_record) -> tuple:
+    prefix = INVOICE_PREFIXES[xml_record['invoice_type']]
+    return tuple(xml_record['record'].get(prefix + field) for field in INVOICE_KEY_FIELDS)
+
+
+def mark_duplicates(supabase_client, xml_records, user_id, outcomes) -> int:
+    """
+    Sets the outcome of the duplicated xml records to DUPLICATE: the ones repeated in the
+    upload, after the first, and the ones already in the database, found with ONE
+    find_existing_invoices RPC for all the keys.
+    Only the records without an outcome yet are checked.
+    return: number of duplicates found.
+    """
+    seen = set()
+    keys = {table_name: [] for table_name in INVOICE_TABLES.values()}
+    positions = {table_name: [] for table_name in INVOICE_TABLES.values()}
+    duplicates = 0
+
+    for i, xml in enumerate(xml_records):
+        if outcomes[i]['outcome'] is not None or xml['invoice_type'] not in INVOICE_TABLES:
+            continue
+        table_name = INVOICE_TABLES[xml['invoice_type']]
+        key = invoice_key(xml)
+        if (table_name, key) in seen:
+            outcomes[i]['outcome'] = DUPLICATE
+            duplicates += 1
+            continue
+        seen.add((table_name, key))
+        keys[table_name].append(key)
+        positions[table_name].append(i)
+
+    if not seen:
+        return duplicates
+
+    try:
+        result = call_with_retries(lambda: supabase_client.rpc('find_existing_invoices', to_json_payload({
+            'emesse_keys': keys['fatture_emesse'],
+            'ricevute_keys': keys['fatture_ricevute'],
+            'test_user_id': user_id
+        })).execute())
+    except Exception as e:
+        print(f'WARNING: duplicates pre-check skipped: {e}')
+        return duplicates
+
+    for table_name, existing in (result.data or {}).items():
+        for position in existing:
+            outcomes[positions[table_name][position]]['outcome'] = DUPLICATE
+            duplicates += 1
+
+    return duplicates
+
+
+def insert_records_batch(supabase_client, xml_records, user_id, batch_size = BATCH_SIZE,
+                         max_in_flight = MAX_IN_FLIGHT, check_duplicates = True) -> list[dict]:
+    """
+    xml_records: output of extract_xml_records().
+    return: one outcome for each xml record, in the same order, as
+            {'filename', 'invoice_type', 'outcome', 'error_message'}.
+    Records already in error are not sent, their outcome is 'error'.
+    Duplicates found by mark_duplicates() are not sent, their outcome is 'duplicate'.
+    """
+    outcomes = _new_outcomes(xml_records)
+    if check_duplicates:
+        mark_duplicates(supabase_client, xml_records, user_id, outcomes)
+
+    chunks = []
+    for invoice_type, table_name in INVOICE_TABLES.items():
+        positions = [i for i, xml in enumerate(xml_records)
+                     if outcomes[i]['outcome'] is None and xml['invoice_type'] == invoice_type]
+        for start in range(0, len(positions), batch_size):
+            chunks.append((table_name, positions[start:start + batch_size]))
+
+    def insert_chunk(chunk):
+        table_name, positions = chunk
+        payload = [{'record': xml_records[i]['record'], 'terms': prepare_terms(xml_records[i])}
+                   for i in positions]
+        return supabase_client.rpc('insert_records_batch', to_json_payload({
+            'table_name': table_name,
+            'terms_table_name': 'rate_' + table_name,
+            'records': payload,
+            'test_user_id': user_id
+        })).execute()
+
+    results = map_concurrently(insert_chunk, chunks, max_in_flight)
+
+    fallback_positions = []
+    for (table_name, positions), result in zip(chunks, results):
+        if getattr(result, 'code', None) == FUNCTION_NOT_FOUND:
+            fallback_positions += positions
+            continue
+
+        if isinstance(result, Exception) or not result.data or not result.data.get('success'):
+            error_message = f'Error during invoice batch INSERT: {result if isinstance(result, Exception) else result.data}'
+            print(f'ERROR: {error_message}')
+            for i in positions:
+                outcomes[i]['outcome'] = ERROR
+                outcomes[i]['error_message'] += error_message
+            continue
+
+        for item in result.data['results']:
+            i = positions[item['position']]
+            outcomes[i]['outcome'] = item['status']
+            if item['status'] == ERROR:
+                outcomes[i]['error_message'] += f"Error during invoice INSERT: {item['error']}"
+
+    if fallback_positions:
+        print('WARNING: insert_records_batch not found, inserting one invoice at a time')
+        fallback_outcomes = insert_records_concurrently(supabase_client, [xml_records[i] for i in fallback_positions],
+                                                        user_id, max_in_flight, check_duplicates = False)
+        for i, outcome in zip(fallback_positions, fallback_outcomes):
+            outcomes[i] = outcome
+
+    return outcomes
+
+
+def insert_records_concurrently(supabase_client, xml_records, user_id, max_in_flight = MAX_IN_FLIGHT,
+                                check_duplicates = True) -> list[dict]:
+    """
+    Same input and output of insert_records_batch(), but with one insert_record RPC per invoice,
+    for when the batch RPC is not available. Calls are concurrent, see map_concurrently().
+    """
+    outcomes = _new_outcomes(xml_records)
+    if check_duplicates:
+        mark_duplicates(supabase_client, xml_records, user_id, outcomes)
+
+    positions = [i for i, xml in enumerate(xml_records)
+                 if outcomes[i]['outcome'] is None and xml['invoice_type'] in INVOICE_TABLES]
+
+    def insert_one(i):
+        xml = xml_records[i]
+        table_name = INVOICE_TABLES[xml['invoice_type']]
+        return supabase_client.rpc('insert_record', to_json_payload({
+            'table_name': table_name,
+            'record_data': xml['record'],
+            'terms_table_name': 'rate_' + table_name,
+            'terms_data': prepare_terms(xml),
+            'test_user_id': user_id
+        })).execute()
+
+    results = map_concurrently(insert_one, positions, max_in_flight)
+
+    for i, result in zip(positions, results):
+        if isinstance(result, Exception):
+            outcomes[i]['outcome'] = ERROR
+            outcomes[i]['error_message'] += f'Error during invoice INSERT: {result}'
+        elif result.data and result.data.get('success'):
+            outcomes[i]['outcome'] = INSERTED
+        elif result.data and 'duplicate key value violates unique constraint' in result.data.get('error', ''):
+            outcomes[i]['outcome'] = DUPLICATE
+        else:
+            outcomes[i]['outcome'] = ERROR
+            outcomes[i]['error_message'] += f'Error during invoice INSERT for xml_record {result.data}'
+
+    return outcomes
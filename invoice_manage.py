@@ -7,12 +7,32 @@ import streamlit as st
 from dateutil.relativedelta import relativedelta
 from invoice_xml_mapping import XML_FIELD_MAPPING
 from config import technical_fields, uppercase_prefixes
-from utils import setup_page, money_to_string, to_money, fetch_all_records_from_view, extract_prefixed_field_names, \
-    render_field_widget, are_all_required_fields_present, remove_prefix, extract_field_names, fetch_record_from_id, \
+from sql_schema import get_field_names, get_prefixed_field_names
+from db_serialization import to_json_payload
+from terms_delta import diff_terms, rescale_terms
+import terms_buffer
+import record_cache
+import query_cache
+from request_metrics import track_action
+from bulk_terms import render_bulk_terms_expander, render_bulk_cassa_expander
+from payment_schedule import split_document, build_schedule, render_schedule_options
+from utils import setup_page, money_to_string, to_money, fetch_all_records_from_view, \
+    render_field_widget, are_all_required_fields_present, remove_prefix, fetch_record_from_id, \
     fetch_all_records, get_standard_column_config, format_italian_currency, get_df_metric, \
     text_input, selectbox, money_input, integer_input, date_input, checkbox
 import pandas as pd
 
+# Columns of the <table_name>_overview views, in the order of the view, all shown in the table of the invoices.
+OVERVIEW_DISPLAY_COLUMNS = {
+    'fatture_emesse': ['id', 'fe_data_documento', 'fe_numero_fattura', 'v_cliente',
+                       'fe_importo_totale_documento', 'v_incassato', 'v_saldo'],
+    'fatture_ricevute': ['id', 'fr_data_documento', 'fr_numero_fattura', 'v_fornitore',
+                         'fr_importo_totale_documento', 'v_pagato', 'v_saldo'],
+}
+# All shown in the Sommario tab.
+MONTHLY_SUMMARY_DISPLAY_COLUMNS = ['tipo_fattura', 'gennaio', 'febbraio', 'marzo', 'aprile', 'maggio', 'giugno',
+                                   'luglio', 'agosto', 'settembre', 'ottobre', 'novembre', 'dicembre']
+
 def create_monthly_invoices_summary_chart(data_dict, show_amounts=False):
 
     # Extract months and values
@@ -113,178 +133,107 @@ def create_monthly_invoices_summary_chart(data_dict, show_amounts=False):
     return fig
 
 def auto_split_payment_invoice(importo_totale_documento: Decimal, num_installments, start_date,
-                                rate_prefix, interval_days = 30):
-    # Precision 28 is different from decimal places!
-    # I need to keep high precision to be able to handle float conversion
-    # correctly. Then I can use quantize to force decimal places to two.
-
-    if num_installments <= 0:
-        return []
-
-    total_decimal = to_money(importo_totale_documento)
-    amount_per_installment = to_money(total_decimal / num_installments)
-
-    terms = []
-    total_allocated = Decimal('0.00')
-
-    for i in range(num_installments):
-        # Last installment gets the remainder to avoid rounding errors
-        if i == num_installments - 1:
-            installment_amount = total_decimal - total_allocated
-        else:
-            installment_amount = amount_per_installment
-            total_allocated += installment_amount
-        term = {
+                                rate_prefix, interval_days = 30, convention = 'giorni',
+                                day_of_month = None, splits = None):
+    """See payment_schedule.py for the conventions and the rounding."""
+    installments = split_document(importo_totale_documento, num_installments, start_date,
+                                  convention, interval_days, day_of_month, splits)
+    return [{
             'id':None,
-            rate_prefix + 'data_scadenza_pagamento':  datetime.strptime(start_date, '%Y-%m-%d').date() + timedelta(days=interval_days * (i + 1)),
-            rate_prefix + 'importo_pagamento_rata': installment_amount,
+            rate_prefix + 'data_scadenza_pagamento': installment['data_scadenza'],
+            rate_prefix + 'importo_pagamento_rata': installment['importo'],
             rate_prefix + 'display_cassa': '',
-            rate_prefix + 'notes': f'Rata {i + 1} di {num_installments}',
+            rate_prefix + 'notes': installment['notes'],
             rate_prefix + 'data_pagamento_rata': None  # Not paid yet
-        }
-        terms.append(term)
-
-    return terms
+        } for installment in installments]
 
-def save_invoice_terms(edited, terms_key, rate_prefix, importo_totale_movimento,
-                       config, invoice_key, supabase_client, table_name,
-                       backup_terms_key, document_not_nullable_fields, are_terms_updated):
+def stage_invoice_terms(edited, rate_prefix, importo_totale_movimento,
+                        config, invoice_key, table_name, document_id, label,
+                        backup_terms_key, versions_key, document_not_nullable_fields):
+    """
+    Validates the terms of the editor and puts their changes in the terms buffer
+    (see terms_buffer.py). Called at every rerun, it does not touch the database,
+    the buffer is saved by the Salva button or when the user stops editing.
+    """
     if len(edited) == 0:
-        st.warning('Impossibile salvare una fattura senza scadenze di pagamento. '
+        message = ('Impossibile salvare una fattura senza scadenze di pagamento. '
                    'Inserire delle nuove scadenze o cliccare su Annulla per scartare '
                    'tutte le modifiche apportate')
-    else:
-        try:
+        st.warning(message)
+        delta = diff_terms(st.session_state[backup_terms_key], [])
+        terms_buffer.stage('rate_' + table_name, document_id, invoice_key, delta, [],
+                           errors = [message], label = label)
+        return
 
-            _edited = edited.copy()
-
-            _edited.columns = [rate_prefix + col.replace(' ','_').lower() for col in _edited.columns]
-            _edited = _edited.rename(columns={rate_prefix + 'id': 'id'})
-
-            # _edited = _edited.reset_index('id')
-            # are_all_ids_none = _edited['id'].isna().all()
-            # are_any_ids_none = _edited['id'].isna().any()
-
-            up_to_date_terms = []
-            for k,v in _edited.T.to_dict().items():
-                up_to_date_terms.append(v)
-            terms = up_to_date_terms
-
-            # Verify total configured
-            # TODO; This does not work at first try
-            total_configured = to_money(0)
-            for term in terms:
-                total_configured += to_money(term[rate_prefix + 'importo_pagamento_rata'])
-            total_is_different = importo_totale_movimento != total_configured
-            if total_is_different:
-                # todo: better formatting of money
-                st.warning(f"Differenza di {total_configured - importo_totale_movimento} euro riscontrata tra la somma degli importi delle scadenze configurate e l'importo totale. "
-                           f"Correggere prima di proseguire")
-                return
+    try:
 
-            # Avoid to insert the keys of the movement in
-            # the session state so I don't have to handle the keys in excess
-            # everywhere.
-            # Adding movement keys, if missing, for insert.
-            terms_to_save = []
-
-            # In order to pass all strings and avoid not JSON serializable
-            # objects like dates.
-            for term in terms:
-                new_term = {}
-                for k,v in term.items():
-                    if v is None:
-                        # Otherwise loading the string "None"
-                        new_term[k] = v
-                    else:
-                        new_term[k] = str(v)
-                terms_to_save.append(new_term)
-
-            # Adding invoices keys, if missing, for insert.
-            for term in terms_to_save:
-                for k,v in invoice_key.items():
-                    if k not in term:
-                        term[k] = v
-
-            # Adding other not nullable fields, if missing, for insert.
-            for term in terms_to_save:
-                for k,v in document_not_nullable_fields.items():
-                    if k not in term:
-                        term[k] = v
-
-            # Verify that all required field are present
-            sql_table_fields_names = extract_prefixed_field_names(
-                'sql/02_create_tables.sql',
-                rate_prefix)
-
-            errors = []
-            for term in terms_to_save:
-                errors.append(are_all_required_fields_present(term,
-                                                              sql_table_fields_names,
-                                                              config))
-            if any(errors):
-                for error in errors:
-                    # todo: Better error message
-                    st.warning(f'{' '.join(error)}')
-                return
+        _edited = edited.copy()
 
-            # st.write(terms_to_save)
-            # if not are_all_ids_none:
-            #     for i in range(len(terms_to_save)):
-            #         term = terms_to_save[i]
-            #         # st.write(st.session_state.user.id)
-            #         row_id = term['id']
-            #         result = supabase_client.table('rate_' + table_name).select('*') \
-            #         .eq('id', row_id) \
-            #         .eq('user_id', st.session_state.user.id).execute()
-            #
-            #         nome = result.data[0].get(rate_prefix + 'nome_cassa')
-            #         iban = result.data[0].get(rate_prefix + 'iban_cassa')
-            #         term[rate_prefix + 'nome_cassa'] = nome
-            #         term[rate_prefix + 'iban_cassa'] = iban
-            # st.write(terms_to_save)
-
-
-            for i in range(len(terms_to_save)):
-                term = terms_to_save[i]
-
-                term.pop(rate_prefix + 'x', None)
-
-                row_id = term['id']
-                if row_id:
-                    result = supabase_client.table('rate_' + table_name).select('*') \
-                        .eq('id', row_id) \
-                        .eq('user_id', st.session_state.user.id).execute()
-                    nome = result.data[0].get(rate_prefix + 'nome_cassa')
-                    iban = result.data[0].get(rate_prefix + 'iban_cassa')
-                    term[rate_prefix + 'nome_cassa'] = nome
-                    term[rate_prefix + 'iban_cassa'] = iban
-
-            # st.write(terms_to_save)
-
-            result = supabase_client.rpc('upsert_terms', {
-                'table_name': 'rate_' + table_name,
-                'delete_key': invoice_key,
-                'terms': terms_to_save
-            }).execute()
+        _edited.columns = [rate_prefix + col.replace(' ','_').lower() for col in _edited.columns]
+        _edited = _edited.rename(columns={rate_prefix + 'id': 'id'})
 
-            if result.data.get('success', False):
-                st.success("Modifiche eseguite con successo")
+        up_to_date_terms = []
+        for k,v in _edited.T.to_dict().items():
+            up_to_date_terms.append(v)
+        terms = up_to_date_terms
 
-                # I've tested it quicly, it seems to work.
-                st.session_state[backup_terms_key] = terms
-                st.session_state[are_terms_updated] = True
-                st.rerun()
-            else:
-                st.error(f'Errore nel salvataggio: {result}')
+        errors = []
+
+        # Verify total configured
+        total_configured = to_money(0)
+        for term in terms:
+            total_configured += to_money(term[rate_prefix + 'importo_pagamento_rata'])
+        total_is_different = importo_totale_movimento != total_configured
+        if total_is_different:
+            # todo: better formatting of money
+            errors.append(f"Differenza di {total_configured - importo_totale_movimento} euro riscontrata tra la somma degli importi delle scadenze configurate e l'importo totale. "
+                          f"Correggere prima di proseguire")
+
+        # Avoid to insert the keys of the movement in
+        # the session state so I don't have to handle the keys in excess
+        # everywhere.
+        #
+        # Avoid not JSON serializable objects like dates, and NaN from the data editor.
+        # This is also a copy, so terms are not modified below.
+        terms_to_save = to_json_payload(terms)
+
+        # Adding invoices keys, if missing, for insert.
+        for term in terms_to_save:
+            for k,v in invoice_key.items():
+                if k not in term:
+                    term[k] = v
+
+        # Adding other not nullable fields, if missing, for insert.
+        for term in terms_to_save:
+            for k,v in document_not_nullable_fields.items():
+                if k not in term:
+                    term[k] = v
+
+        # Verify that all required field are present
+        sql_table_fields_names = get_prefixed_field_names(rate_prefix)
+
+        for term in terms_to_save:
+            missing = are_all_required_fields_present(term, sql_table_fields_names, config)
+            if missing:
+                # todo: Better error message
+                errors.append(f'{' '.join(missing)}')
+
+        for error in errors:
+            st.warning(error)
+
+        # Only the changes with respect to the terms loaded in the editor are sent,
+        # so the terms not modified keep their row, id and cassa.
+        delta = diff_terms(st.session_state[backup_terms_key], terms_to_save,
+                           ignored_fields = [rate_prefix + 'x'],
+                           versions = st.session_state.get(versions_key))
+        terms_buffer.stage('rate_' + table_name, document_id, invoice_key, delta, terms,
+                           errors = errors, label = label)
+
+    except Exception as e:
+        st.error(f"Eccezione nella validazione delle scadenze: {str(e)}")
+        st.text("Stack trace:")
+        st.text(traceback.format_exc())
 
-        # todo: fix error management / logging.
-        #  Here is interesting because the above catches db error that are not
-        #  exceptions, the below only exceptions.
-        except Exception as e:
-            st.error(f"Eccezione nel salvataggio: {str(e)}")
-            st.text("Stack trace:")
-            st.text(traceback.format_exc())
 
 @st.dialog("Aggiungi fattura")
 def render_invoice_add_modal(supabase_client, table_name, fields_config, prefix):
@@ -312,7 +261,7 @@ def render_invoice_add_modal(supabase_client, table_name, fields_config, prefix)
         config_items = list(fields_config.items())
         # Here is one of the differences with movimenti, the names in the config are
         # unprefixed.
-        sql_table_fields_names = extract_field_names('sql/02_create_tables.sql', prefix)
+        sql_table_fields_names = get_field_names(prefix)
 
         # TODO: The use of i % 2 will make so that
         #  if I have two tables with uneven number of fields in the config,
@@ -372,12 +321,8 @@ def render_invoice_add_modal(supabase_client, table_name, fields_config, prefix)
                         st.error(error)
                         return
                 else:
-                    processed_data = {}
-                    for name, value in form_data.items():
-                        processed_data[name] = str(value)
-
                     prefixed_processed_data = {}
-                    for k,v in processed_data.items():
+                    for k,v in form_data.items():
                         prefixed_processed_data[prefix + k] = v
 
                     # When using the rpc function, user_id is added automatically.
@@ -396,7 +341,7 @@ def render_invoice_add_modal(supabase_client, table_name, fields_config, prefix)
                             #
                             # factor out?
                             MONTHS_IN_ADVANCE = 1
-                            data_documento_date = datetime.fromisoformat(prefixed_processed_data[prefix + 'data_documento'])
+                            data_documento_date = prefixed_processed_data[prefix + 'data_documento']
                             first_day = datetime(data_documento_date.year, data_documento_date.month, 1)
                             last_day_next_X_months = first_day + relativedelta(months=MONTHS_IN_ADVANCE, days=-1)
                             # terms_due_date = [last_day_next_X_months.date().isoformat()]
@@ -418,13 +363,13 @@ def render_invoice_add_modal(supabase_client, table_name, fields_config, prefix)
                             else:
                                 raise Exception("Uniche tabelle supportate: fatture_emesse, fatture_ricevute.")
 
-                            result = supabase_client.rpc('insert_record', {
+                            result = supabase_client.rpc('insert_record', to_json_payload({
                                 'table_name': table_name,
                                 'record_data': prefixed_processed_data,
                                 'terms_table_name': 'rate_' + table_name,
                                 'terms_data': [term],
                                 'test_user_id': None
-                            }).execute()
+                            })).execute()
 
 
 
@@ -434,6 +379,9 @@ def render_invoice_add_modal(supabase_client, table_name, fields_config, prefix)
                                 st.error(f"Errore nell'inserimento manuale della fattura: {result.error.message}")
                                 return
                             else:
+                                # The rpc gives back the inserted rows, no need to refetch the tables.
+                                record_cache.merge_rows(table_name, [result.data.get('record')])
+                                record_cache.merge_rows('rate_' + table_name, result.data.get('terms'))
                                 st.success("Fattura salvata con successo")
                                 st.rerun()
                         # This exception handling does not show the message to the ui, neither raise
@@ -448,7 +396,7 @@ def render_invoice_add_modal(supabase_client, table_name, fields_config, prefix)
 @st.dialog("Modifica fattura")
 def render_invoice_modify_modal(supabase_client, table_name, fields_config, selected_id, prefix):
 
-    selected_row_parent_data = fetch_record_from_id(supabase_client, table_name, selected_id, st.session_state.user.id)
+    selected_row_parent_data = record_cache.get_record(supabase_client, table_name, selected_id, st.session_state.user.id)
 
     with st.form(f"modify_{table_name}_form",
                  clear_on_submit=False,
@@ -456,7 +404,7 @@ def render_invoice_modify_modal(supabase_client, table_name, fields_config, sele
         form_data = {}
 
         config_items = list(fields_config.items())
-        sql_table_fields_names = extract_field_names('sql/02_create_tables.sql', prefix)
+        sql_table_fields_names = get_field_names(prefix)
 
         col1, col2 = st.columns([1, 1])
 
@@ -628,6 +576,9 @@ def render_invoice_modify_modal(supabase_client, table_name, fields_config, sele
         #             # Only invert the flag after actually rendering a field
         #             column_flag = not column_flag
 
+        rescale = st.checkbox("Se l'importo totale cambia, ricalcola in proporzione gli importi delle scadenze",
+                              value = True)
+
         col3, _col4 = st.columns([1, 1])
 
         with col3:
@@ -642,35 +593,43 @@ def render_invoice_modify_modal(supabase_client, table_name, fields_config, sele
                         st.error(error)
 
                 else:
-                    processed_data = {}
-
                     # From the code above, we know that form_data will hold either a value or None,
                     # and we know that if we pass None, the supabase API will convert to NONE or
                     # default value.
-                    for name, value in form_data.items():
-                        # All string otherwise 'Object of type date is not JSON serializable'
-                        processed_data[name] = str(value)
-
                     prefixed_processed_data = {}
-                    for k,v in processed_data.items():
+                    for k,v in form_data.items():
                         prefixed_processed_data[prefix + k] = v
 
                     prefixed_processed_data['user_id'] = st.session_state.user.id
 
-                    with st.spinner("Salvataggio in corso..."):
-                        # The addition of .eq() with user_id, is for consistency and safety.
-                        # It should not be necessary since ids are unique in the table.
-                        result = supabase_client.table(table_name).update(prefixed_processed_data) \
-                            .eq('user_id', st.session_state.user.id) \
-                            .eq('id', selected_id).execute()
-
-                        has_errored = (hasattr(result, 'error') and result.error)
+                    # The terms of the invoice as it was before the changes.
+                    rate_prefix = 'r' + prefix
+                    terms_delta = None
+                    if rescale and to_money(prefixed_processed_data[prefix + 'importo_totale_documento']) \
+                            != to_money(selected_row_parent_data.get(prefix + 'importo_totale_documento')):
+                        terms = [row for row in record_cache.get_records(supabase_client, 'rate_' + table_name, st.session_state.user.id)
+                                 if all(row[rate_prefix + field] == selected_row_parent_data[prefix + field]
+                                        for field in ['partita_iva_prestatore', 'numero_fattura', 'data_documento'])]
+                        terms_delta = rescale_terms(terms, rate_prefix + 'importo_pagamento_rata',
+                                                    rate_prefix + 'data_scadenza_pagamento',
+                                                    prefixed_processed_data[prefix + 'importo_totale_documento'])
 
-                        if not has_errored:
+                    with st.spinner("Salvataggio in corso..."):
+                        # Invoice and terms in one transaction, only if nobody modified the invoice
+                        # after it was loaded in the page. Key changes reach the terms by ON UPDATE CASCADE.
+                        result = record_cache.save_document_with_terms(supabase_client, table_name, selected_id,
+                                                                       prefixed_processed_data,
+                                                                       selected_row_parent_data.get('updated_at'),
+                                                                       terms_delta)
+
+                        if result.get('success', False):
+                            # The merge of the saved rows bumps the version of the rate table,
+                            # so the terms editor reloads the terms of the selected invoice.
                             st.success("Dati modificati con successo!")
                             st.rerun()
                         else:
-                            st.error(f"Errore modifica dati: {result.error.message}")
+                            st.error(f"Errore modifica dati: {result.get('error')}. "
+                                     "Chiudere e riaprire la finestra per vedere i dati aggiornati.")
                             return
 
             except Exception as e:
@@ -678,38 +637,136 @@ def render_invoice_modify_modal(supabase_client, table_name, fields_config, sele
                 raise
 
 @st.dialog("Rimuovi fattura")
-def render_invoice_delete_modal(supabase_client, table_name, record_id):
+def render_invoice_delete_modal(supabase_client, table_name, record_ids):
 
-    col1, col2 = st.columns([1, 1])
+    if len(record_ids) == 1:
+        st.write("Verrà eliminata la fattura selezionata, con tutte le relative scadenze.")
+    else:
+        st.write(f"Verranno eliminate {len(record_ids)} fatture, con tutte le relative scadenze.")
 
+    col1, col2 = st.columns([1, 1])
     with col1:
         if st.button("Conferma Eliminazione", type="primary",
                      key = table_name + '_delete_modal_button'):
             try:
                 with st.spinner("Eliminazione in corso..."):
 
-                    # Supabase delete always returns empty data, so we check for no exception
-                    result = supabase_client.table(table_name).delete() \
-                        .eq('user_id', st.session_state.user.id) \
-                        .eq('id', record_id).execute()
-
-                    has_errored = (hasattr(result, 'error') and result.error)
-
-                    if not has_errored:
-                        # To delete terms when I delete movements for now I'll use just the
-                        # CASCADE clause. In the future I might use an ad hoc transaction to
-                        # make the system more robust to sql definition errors.
-
-                        st.success("Dati eliminati con successo!")
+                    # One rpc for all the selected records. The terms are deleted by the
+                    # CASCADE clause, the rpc only counts them.
+                    with track_action('delete documents'):
+                        result = supabase_client.rpc('delete_documents', to_json_payload({
+                            'table_name': table_name,
+                            'document_ids': list(record_ids)
+                        })).execute()
+
+                    if result.data.get('success', False):
+                        record_cache.remove_rows(table_name, result.data.get('document_ids'))
+                        # The terms are deleted by the cascade, not returned.
+                        record_cache.invalidate('rate_' + table_name)
+                        st.success(f"Eliminate {result.data.get('documents')} fatture "
+                                   f"e {result.data.get('terms')} scadenze")
                         st.rerun()
 
                     else:
-                        st.error(f"Errore rimozione movimento: {result.error.message}")
+                        st.error(f"Errore rimozione fatture: {result.data.get('error')}")
                         return
 
             except Exception as e:
                 raise Exception(f'Error deleting movement: {e}')
 
+# An invoice is identified by number, date and supplier, same as the document_key of
+# apply_terms_delta: two suppliers can send invoices with the same number and date.
+INVOICE_KEY_FIELDS = ['numero_fattura', 'data_documento', 'partita_iva_prestatore']
+
+def build_bulk_terms_payload(schedule, check_terms, rate_prefix) -> list:
+    """
+    schedule:    build_schedule() output, with the INVOICE_KEY_FIELDS columns.
+    check_terms: DataFrame of the current terms, cassa of the new terms is the one of the
+                 first current term of each invoice.
+    return:      the documents of the upsert_terms_batch rpc, one per invoice.
+    """
+    key_columns = [rate_prefix + field for field in INVOICE_KEY_FIELDS]
+    cassa_columns = [rate_prefix + 'display_cassa', rate_prefix + 'nome_cassa', rate_prefix + 'iban_cassa']
+    current_cassa = {}
+    if not check_terms.empty:
+        first_terms = check_terms.drop_duplicates(key_columns)
+        for term in first_terms.to_dict('records'):
+            key = tuple(term[column] for column in key_columns)
+            current_cassa[key] = {column: term.get(column) for column in cassa_columns}
+
+    payload = []
+    for key, installments in schedule.groupby(INVOICE_KEY_FIELDS, sort=False):
+        document_key = dict(zip(key_columns, key))
+        payload.append({
+            'delete_key': document_key,
+            'terms': [{
+                **document_key,
+                rate_prefix + 'data_scadenza_pagamento': installment['data_scadenza'],
+                rate_prefix + 'importo_pagamento_rata': installment['importo'],
+                rate_prefix + 'notes': installment['notes'],
+                **current_cassa.get(key, {}),
+            } for installment in installments.to_dict('records')]
+        })
+    return payload
+
+def render_bulk_schedule_expander(supabase_client, table_name, prefix, rate_prefix,
+                                  check_invoices, check_terms):
+    """
+    Same as the 'Configurazione Iniziale Rapida' of a single invoice, but for many invoices:
+    all the schedules are computed together by build_schedule() and saved with one
+    upsert_terms_batch rpc, in a single transaction.
+    Cassa of the new terms is the one of the first current term of each invoice.
+    """
+    with st.expander("Ridistribuzione Scadenze Multipla"):
+        if not check_invoices:
+            st.warning('Nessuna fattura disponibile')
+            return
+
+        invoices = {invoice['id']: invoice for invoice in check_invoices}
+        selected_ids = st.multiselect("Fatture", options=list(invoices),
+                                      format_func=lambda x: f"{invoices[x][prefix + 'numero_fattura']} del "
+                                                            f"{invoices[x][prefix + 'data_documento']}",
+                                      key = table_name + '_bulk_selected_invoices')
+        schedule_options = render_schedule_options(table_name + '_bulk')
+
+        if not selected_ids or schedule_options is None:
+            return
+
+        documents = pd.DataFrame({
+            'numero_fattura': [invoices[i][prefix + 'numero_fattura'] for i in selected_ids],
+            'data_documento': [invoices[i][prefix + 'data_documento'] for i in selected_ids],
+            'importo_totale': [invoices[i][prefix + 'importo_totale_documento'] for i in selected_ids],
+            'partita_iva_prestatore': [invoices[i][prefix + 'partita_iva_prestatore'] for i in selected_ids],
+        })
+        schedule = build_schedule(documents, **schedule_options)
+
+        st.write(f"Verranno generate {len(schedule)} scadenze per {len(documents)} fatture.")
+        st.warning("Attenzione: questa operazione sovrascriverà tutte le scadenze delle fatture selezionate.")
+
+        if not st.button("Applica a tutte", type='primary', key = table_name + '_bulk_apply'):
+            return
+
+        payload = build_bulk_terms_payload(schedule, check_terms, rate_prefix)
+
+        try:
+            with track_action('bulk schedule'):
+                result = supabase_client.rpc('upsert_terms_batch', to_json_payload({
+                    'table_name': 'rate_' + table_name,
+                    'documents': payload
+                })).execute()
+
+            if result.data.get('success', False):
+                record_cache.invalidate('rate_' + table_name)
+                st.success(f"Scadenze aggiornate per {result.data.get('documents_count')} fatture")
+                st.rerun()
+            else:
+                st.error(f'Errore nel salvataggio: {result}')
+        except Exception as e:
+            st.error(f"Eccezione nel salvataggio: {str(e)}")
+            st.text("Stack trace:")
+            st.text(traceback.format_exc())
+
+
 def render_invoice_crud_page(supabase_client, user_id,
                                table_name, prefix,
                                rate_prefix,
@@ -728,8 +785,11 @@ def render_invoice_crud_page(supabase_client, user_id,
     """
     terms_key = table_name + '_terms'
     backup_terms_key = table_name + '_backup_terms'
+    # updated_at of the loaded terms, for the optimistic concurrency of apply_terms_delta.
+    versions_key = table_name + '_terms_versions'
     selection_key = table_name + table_name + '_selected_invoice'
-    are_terms_updated = table_name + '_are_terms_updated'
+    # Version of the rate table when the terms were loaded, see query_cache.py.
+    loaded_version_key = table_name + '_terms_loaded_version'
 
 # Selected invoice is only used for knowing when to refetch data
     # from the terms table when the user changes selection.
@@ -751,14 +811,15 @@ def render_invoice_crud_page(supabase_client, user_id,
         st.session_state[backup_terms_key] = None
 
     # This is for rerunning the piece of code that will update the terms that go into the
-    # terms df viewer after having saved them into the database.
-    if are_terms_updated not in st.session_state:
-        st.session_state[are_terms_updated] = False
+    # terms df viewer after having saved them into the database, or after any other write
+    # to the terms table: every write bumps its version.
+    if loaded_version_key not in st.session_state:
+        st.session_state[loaded_version_key] = None
 
 
 
-    check_invoices = fetch_all_records(supabase_client, table_name, user_id)
-    check_terms = pd.DataFrame(fetch_all_records(supabase_client, 'rate_' + table_name, user_id))
+    check_invoices = record_cache.get_records(supabase_client, table_name, user_id)
+    check_terms = pd.DataFrame(record_cache.get_records(supabase_client, 'rate_' + table_name, user_id))
     anomalies = {}
     for invoice in check_invoices:
         number_key = invoice[prefix + 'numero_fattura']
@@ -772,7 +833,8 @@ def render_invoice_crud_page(supabase_client, user_id,
                                      f'totale di {total_i} Euro, mentre le relative scadenze hanno un importo '
                                      f'totale di {total_i_terms} Euro. Assicurarsi di far combaciare gli importi')
 
-    invoices_data = fetch_all_records_from_view(supabase_client, table_name + '_overview')
+    invoices_data = fetch_all_records_from_view(supabase_client, table_name + '_overview',
+                                                OVERVIEW_DISPLAY_COLUMNS[table_name])
 
     if not invoices_data:
         st.warning("Nessuna fattura trovata. Caricare o creare una fattura prima di proseguire.")
@@ -825,7 +887,8 @@ def render_invoice_crud_page(supabase_client, user_id,
         df_vis = df_vis.sort_values(by = ['Data Documento', 'Numero Fattura'])
 
         selection = st.dataframe(df_vis, use_container_width=True,
-                                 selection_mode = 'single-row',
+                                 # Multi row for the bulk delete, the other actions use the first selected row.
+                                 selection_mode = 'multi-row',
                                  on_select='rerun',
                                  hide_index = True,
                                  key = table_name + 'selection_df',
@@ -842,7 +905,9 @@ def render_invoice_crud_page(supabase_client, user_id,
         with col2:
             modify = st.button("Modifica Fattura", key = table_name + '_modify')
             if modify:
-                if selection.selection['rows']:
+                if len(selection.selection['rows']) > 1:
+                    st.warning('Seleziona un solo movimento da modificare')
+                elif selection.selection['rows']:
                     # BAD: Here I'm relying on the fact that the index in the df and
                     # in the movimenti_data state will always be in sync.
                     #
@@ -862,10 +927,9 @@ def render_invoice_crud_page(supabase_client, user_id,
             delete = st.button("Rimuovi Fattura", key = table_name + '_delete')
             if delete:
                 if selection.selection['rows']:
-                    selected_index = selection.selection['rows'][0]
-                    record_id = df_vis.iloc[selected_index].name
+                    record_ids = [df_vis.iloc[selected_index].name for selected_index in selection.selection['rows']]
 
-                    render_invoice_delete_modal(supabase_client, table_name, record_id)
+                    render_invoice_delete_modal(supabase_client, table_name, record_ids)
                 else:
                     st.warning('Seleziona un movimento da eliminare')
 
@@ -882,10 +946,8 @@ def render_invoice_crud_page(supabase_client, user_id,
                 if numero_documento in anomalies:
                     st.warning(anomalies.get(numero_documento))
 
-                result = supabase_client.table(table_name).select(prefix + 'partita_iva_prestatore') \
-                                        .eq('id', record_data.name) \
-                                        .eq('user_id', st.session_state.user.id).execute()
-                piva_prestatore = result.data[0].get(prefix + 'partita_iva_prestatore', None)
+                piva_prestatore = record_cache.get_record(supabase_client, table_name, record_data.name, user_id) \
+                                              .get(prefix + 'partita_iva_prestatore', None)
                 if piva_prestatore is None:
                     st.error('Errore nel reperire la P.IVA prestatore')
                     return
@@ -901,14 +963,14 @@ def render_invoice_crud_page(supabase_client, user_id,
                 }
 
                 if st.session_state[terms_key] is None or st.session_state[selection_key] != numero_documento \
-                        or st.session_state[are_terms_updated] == True or st.session_state.force_update == True:
+                        or st.session_state[loaded_version_key] != query_cache.get_version('rate_' + table_name):
                     try:
-                        result = supabase_client.table('rate_' + table_name).select('*').eq('user_id', user_id) \
-                            .eq(rate_prefix + 'numero_fattura', numero_documento) \
-                            .eq(rate_prefix + 'data_documento', data_documento).execute()
+                        document_rows = [row for row in record_cache.get_records(supabase_client, 'rate_' + table_name, user_id)
+                                         if row[rate_prefix + 'numero_fattura'] == numero_documento
+                                         and row[rate_prefix + 'data_documento'] == str(data_documento)]
 
                         existing_terms = []
-                        for row in result.data:
+                        for row in document_rows:
                             term = {
                                 'id' : row['id'],
                                 rate_prefix + 'data_scadenza_pagamento': datetime.strptime(row[rate_prefix + 'data_scadenza_pagamento'], '%Y-%m-%d').date(),
@@ -918,14 +980,18 @@ def render_invoice_crud_page(supabase_client, user_id,
                                 rate_prefix + 'notes': row[rate_prefix + 'notes'] or '',
                             }
                             existing_terms.append(term)
-                        st.session_state[terms_key] = existing_terms
+
+                        # The changes not saved yet of this document are shown again,
+                        # and compared with the terms of the database.
+                        pending_terms = terms_buffer.get_pending_terms('rate_' + table_name, record_data.name)
+                        st.session_state[terms_key] = pending_terms if pending_terms is not None else existing_terms
                         st.session_state[selection_key] = numero_documento
-                        st.session_state[are_terms_updated] = False
-                        st.session_state.force_update = False
+                        st.session_state[loaded_version_key] = query_cache.get_version('rate_' + table_name)
 
                         # This try should be triggered only on the first loading or when I change selection
                         # so it should be safe to reset the existing terms here.
                         st.session_state[backup_terms_key] = existing_terms
+                        st.session_state[versions_key] = {row['id']: row.get('updated_at') for row in document_rows}
                     except Exception as e:
                         st.error(f"Errore nel caricamento dei termini delle fatture: {str(e)}")
 
@@ -954,7 +1020,7 @@ def render_invoice_crud_page(supabase_client, user_id,
                                                            required_columns = required_columns,
                                                            )
 
-                options = fetch_all_records_from_view(supabase_client, 'casse_options')
+                options = fetch_all_records_from_view(supabase_client, 'casse_options', ['cassa'])
                 cleaned_options = [d.get('cassa') for d in options]
 
                 # # Check for any mismatches
@@ -993,36 +1059,33 @@ def render_invoice_crud_page(supabase_client, user_id,
                                          disabled=["Id"]
                                          )
 
+                stage_invoice_terms(edited, rate_prefix, importo_totale_documento,
+                                    config, document_key, table_name, record_data.name,
+                                    f'Fattura {numero_documento}', backup_terms_key, versions_key,
+                                    document_not_nullable_fields)
 
                 c1, c2, c3 = st.columns([3,3,1], vertical_alignment='top')
 
                 with c1:
                     with st.expander("Configurazione Iniziale Rapida", width=500):
                         st.write("""La configurazione rapida permette di generare automaticamente il
-                                        numero desiderato di scadenze con importo diviso ugualmente.""")
+                                        numero desiderato di scadenze, con importo diviso ugualmente
+                                        o secondo le percentuali indicate.""")
                         st.write("""Attenzione: questa operazione sovrascriverà tutti i campi delle
                                         scadenze attualmente configurate.""")
-                        split_col1, split_col2, split_col3 = st.columns([1, 1, 1],
-                                                                        vertical_alignment='bottom')
-
-                        with split_col1:
-                            num_installments = st.number_input("Numero rate", min_value=1, max_value=12, value=1,
-                                                               key = table_name + '_num_installments')
-
-                        with split_col2:
-                            interval_days = st.number_input("Giorni tra rate", min_value=1, max_value=365, value=30, step=15,
-                                                            key = table_name + '_interval_days')
-
-                        with split_col3:
-                            # TODO; can I put an help message over the button
-                            #  so that I don't have to handle the complexity of a dialog?
-                            if st.button("Applica", key = table_name + '_apply_rapid_config'):
-
-                                up_to_date_terms = auto_split_payment_invoice(
-                                    importo_totale_documento, num_installments, data_documento, rate_prefix, interval_days
-                                )
-                                st.session_state[terms_key] = up_to_date_terms
-                                st.rerun()
+                        schedule_options = render_schedule_options(table_name)
+
+                        # TODO; can I put an help message over the button
+                        #  so that I don't have to handle the complexity of a dialog?
+                        if st.button("Applica", key = table_name + '_apply_rapid_config',
+                                     disabled = schedule_options is None):
+
+                            up_to_date_terms = auto_split_payment_invoice(
+                                importo_totale_documento, start_date = data_documento,
+                                rate_prefix = rate_prefix, **schedule_options
+                            )
+                            st.session_state[terms_key] = up_to_date_terms
+                            st.rerun()
                 with c2:
                     with st.expander("Divisione Automatica Importo", width=500):
 
@@ -1069,10 +1132,9 @@ def render_invoice_crud_page(supabase_client, user_id,
                         cancel = st.button('Annulla', key = table_name + '_cancel_terms', use_container_width=True)
 
                 if save:
-                    save_invoice_terms(edited, terms_key, rate_prefix, importo_totale_documento,
-                                        config, document_key, supabase_client, table_name, backup_terms_key,
-                                       document_not_nullable_fields, are_terms_updated)
+                    terms_buffer.save_pending_changes(supabase_client)
                 if cancel:
+                    terms_buffer.discard('rate_' + table_name, record_data.name)
                     # NOTE IMPORTANT: for some reason, if I do
                     # st.session_state[terms_key] = st.session_state[backup_terms_key],
                     # the rerun() does not trigger the recomputing of the terms_df.
@@ -1084,6 +1146,15 @@ def render_invoice_crud_page(supabase_client, user_id,
             else:
                 st.warning('Seleziona un movimento per gestirne le rate')
 
+            # After the editor, so it counts the changes of this run too.
+            terms_buffer.render_pending_indicator(supabase_client)
+
+        render_bulk_schedule_expander(supabase_client, table_name, prefix, rate_prefix,
+                                      check_invoices, check_terms)
+
+        render_bulk_terms_expander(supabase_client, 'rate_' + table_name, check_terms)
+        render_bulk_cassa_expander(supabase_client, 'rate_' + table_name)
+
 
 
 
@@ -1097,7 +1168,8 @@ def main():
 
         with sommario:
 
-            result = supabase_client.table('monthly_invoice_summary').select('*').execute()
+            result = supabase_client.table('monthly_invoice_summary') \
+                                    .select(','.join(MONTHLY_SUMMARY_DISPLAY_COLUMNS)).execute()
 
             if not result.data:
                 st.warning("Nessun dato disponibile per il periodo selezionato")
@@ -1146,12 +1218,13 @@ def main():
                 )
                 st.dataframe(df_vis, use_container_width=True, column_config=column_config)
 
-                different_year_attivi = supabase_client.table('fatture_emesse').select('*') \
+                # Only the count, no rows are returned.
+                different_year_attivi = supabase_client.table('fatture_emesse').select('id', count = 'exact', head = True) \
                     .or_('fe_data_documento.lt.2025-01-01,fe_data_documento.gt.2025-12-31').execute()
-                different_year_passivi = supabase_client.table('fatture_ricevute').select('*') \
+                different_year_passivi = supabase_client.table('fatture_ricevute').select('id', count = 'exact', head = True) \
                     .or_('fr_data_documento.lt.2025-01-01,fr_data_documento.gt.2025-12-31').execute()
 
-                if any([different_year_attivi.data, different_year_passivi.data]):
+                if any([different_year_attivi.count, different_year_passivi.count]):
                     with st.expander('Avvisi'):
                         st.info("""Sono caricate fatture con data diversa dall'anno 2025.
                          Nel TAB Sommario saranno mostrate solo i dati relativi all'anno corrente.""")
@@ -44,23 +44,14 @@ import pprint
 from dateutil.relativedelta import relativedelta
 from datetime import datetime
 from invoice_xml_processor import process_xml_list
+from sql_schema import get_field_names
 
-def extract_fields_name(sql_file_path = 'sql/02_create_tables.sql', prefix='fe_'):
-    field_names = []
-    with open(sql_file_path, 'r') as f:
-        for line in f:
-            stripped = line.strip()
-            if stripped.startswith(prefix):
-                # Get first word (field name)
-                field_name = stripped.split()[0]
-                # Remove prefix because I have to check against field names in
-                # the xml_fields which has names without prefix.
-                field_name = field_name[len(prefix):]
-                field_names.append(field_name)
-    return field_names
+# The fields that are one per term, a string or a list in the parsed data:
+# they go only in the terms, never in the record.
+TERM_FIELDS = {'data_scadenza_pagamento', 'importo_pagamento_rata', 'iban_cassa', 'nome_cassa'}
 
 def get_logicless_field_in_list(xml_data, field_name:str, len_field:list[str | None]) -> list[str | None]:
-    field = xml_data.pop(field_name, None)
+    field = xml_data.get(field_name, None)
     if field is None:
         field = [None]*len(len_field)
     elif isinstance(field, str):
@@ -77,9 +68,9 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
     results = []
 
     for xml in parsing_results:
-        # Copy because I'll pop() some fields, but I want to keep the
-        # original referenced datat in the result object intact.
-        xml_data = xml['data'].copy()
+        # Not copied: the TERM_FIELDS are only read, and skipped when building
+        # the record, so the original data in the result object stays intact.
+        xml_data = xml['data']
         record_to_insert = {}
         terms_to_insert = []
 
@@ -133,7 +124,7 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
             # TODO; I'm not sure that importo_pagamento_rata is always valued,
             #  and also that data_scadenza_pagamento is the only field needed for
             #  understanding if an invoice has no terms.
-            terms_due_date =  xml_data.pop('data_scadenza_pagamento', None)
+            terms_due_date =  xml_data.get('data_scadenza_pagamento', None)
             if isinstance(terms_due_date, list):
                 assert term_type == 'multiple_payments', f"terms_due_date - term type: expected multiple_payments, got {term_type}"
 
@@ -160,7 +151,7 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
             # terms_amount does not respond to the same types of logic data_scadenza_pagamento:
             # for example data_scadenza_pagamento can be None but importo_pagamento_rata can be valued
             # with a single value. I cannot then do the assert-kind-of-checks that I do above.
-            terms_amount =  xml_data.pop('importo_pagamento_rata')
+            terms_amount =  xml_data['importo_pagamento_rata']
             if isinstance(terms_amount, list):
                 pass
 
@@ -205,9 +196,9 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
             # name is not equal to a field present in the xml file, I can manage it
             # later. The prefix is more for creating unique names that are easy to find
             # and replace in the iteration phase.
-            fields_to_insert = extract_fields_name(prefix='fe_')
+            fields_to_insert = get_field_names('fe_')
             for (sql_field, value) in xml_data.items():
-                if sql_field in fields_to_insert:
+                if sql_field in fields_to_insert and sql_field not in TERM_FIELDS:
                     record_to_insert['fe_' + sql_field] = value
 
             # record_to_insert['user_id'] = st.session_state.user.id should go in the front end logic,
@@ -215,11 +206,11 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
             # It can also be appended automatically with store procedures or triggers, so I don't have to
             # do it manually.
 
-            fields_to_insert = extract_fields_name(prefix='rfe_')
+            fields_to_insert = get_field_names('rfe_')
             for i in range(len(terms_due_date)):
                 term_record = {}
                 for (sql_field, value) in xml_data.items():
-                    if sql_field in fields_to_insert:
+                    if sql_field in fields_to_insert and sql_field not in TERM_FIELDS:
                         term_record['rfe_' + sql_field] = value
                 term_record['rfe_' + 'data_scadenza_pagamento'] = terms_due_date[i]
                 term_record['rfe_' + 'importo_pagamento_rata'] = terms_amount[i]
@@ -230,7 +221,7 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
             results.append(result)
         elif invoice_type == 'ricevuta':
 
-            terms_due_date =  xml_data.pop('data_scadenza_pagamento', None)
+            terms_due_date =  xml_data.get('data_scadenza_pagamento', None)
             if isinstance(terms_due_date, list):
                 assert term_type == 'multiple_payments', f"RICEVUTA terms_due_date - term type: expected multiple_payments, got {term_type}"
 
@@ -253,7 +244,7 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
                 assert False, f"RICEVUTA Branching error for terms_due_date."
 
 
-            terms_amount =  xml_data.pop('importo_pagamento_rata')
+            terms_amount =  xml_data['importo_pagamento_rata']
             if isinstance(terms_amount, list):
                 pass
 
@@ -273,16 +264,16 @@ def extract_xml_records(parsing_results, partita_iva_azienda) -> list[dict]:
 
             assert (len(terms_due_date) == len(terms_amount) == len(terms_iban) == len(terms_cassa)), "RICEVUTA Terms fields' len() does not match."
 
-            fields_to_insert = extract_fields_name(prefix='fr_')
+            fields_to_insert = get_field_names('fr_')
             for (sql_field, value) in xml_data.items():
-                if sql_field in fields_to_insert:
+                if sql_field in fields_to_insert and sql_field not in TERM_FIELDS:
                     record_to_insert['fr_' + sql_field] = value
 
-            fields_to_insert = extract_fields_name(prefix='rfr_')
+            fields_to_insert = get_field_names('rfr_')
             for i in range(len(terms_due_date)):
                 term_record = {}
                 for (sql_field, value) in xml_data.items():
-                    if sql_field in fields_to_insert:
+                    if sql_field in fields_to_insert and sql_field not in TERM_FIELDS:
                         term_record['rfr_' + sql_field] = value
                 term_record['rfr_' + 'data_scadenza_pagamento'] = terms_due_date[i]
                 term_record['rfr_' + 'importo_pagamento_rata'] = terms_amount[i]
@@ -6,7 +6,9 @@ from datetime import datetime, date
 from decimal import Decimal, getcontext
 from invoice_xml_processor import process_xml_list
 from invoice_record_creation import extract_xml_records
-from utils import extract_field_names, render_field_widget
+from sql_schema import get_field_names
+from db_serialization import to_json_payload
+from utils import render_field_widget
 
 
 # def render_add_form(supabase_client, table_name, fields_config, prefix):
@@ -125,36 +127,13 @@ def validate_required_form_data(fields_config, form_data):
 
 def process_form_data(fields_config, form_data):
     """Process and convert form data FOR THE UPLOAD based on field types"""
-    # todo: what formatting to use? because of errors like
-    # Error inserting data: Object of type date is not JSON serializable
-    # maybe I can just upload strings?
-
-    processed_data = {}
-
-    for field_name, value in form_data.items():
-        # if field_name not in fields_config:
-        #     processed_data[field_name] = value
-        #     continue
-        #
-        # field_config = fields_config[field_name]
-        # field_type = field_config.get('data_type', 'string')
-        #
-        # if field_type == 'money' and value is not None:
-        #     processed_data[field_name] = to_decimal(value)
-        # elif field_type == 'date' and value is not None:
-        #     if isinstance(value, date):
-        #         processed_data[field_name] = value
-        #     else:
-        #         processed_data[field_name] = datetime.strptime(str(value), '%Y-%m-%d').date()
-        # else:
-        #     processed_data[field_name] = value
-        processed_data[field_name] = str(value)
-
-    return processed_data
-
-def fetch_all_records(supabase_client, table_name: str, user_id: str):
+    # Dates, Decimals and None are converted by db_serialization, so no
+    # more 'Object of type date is not JSON serializable'.
+    return to_json_payload(form_data)
+
+def fetch_all_records(supabase_client, table_name: str, user_id: str, columns):
     try:
-        result = supabase_client.table(table_name).select('*').eq('user_id', user_id).execute()
+        result = supabase_client.table(table_name).select(','.join(columns)).eq('user_id', user_id).execute()
 
         if result.data:
             df = pd.DataFrame(result.data)
@@ -179,22 +158,7 @@ def update_record_in_database(supabase_client, table_name: str, record_id: str,
         data['updated_at'] = datetime.now().isoformat()
 
         # Convert data types for database
-        processed_data = {}
-        for field_name, value in data.items():
-            # if field_name in FATTURE_EMESSE_FIELDS:
-            #     field_type = get_field_type(FATTURE_EMESSE_FIELDS, field_name)
-            #     if field_type == 'money' and value is not None:
-            #         processed_data[field_name] = float(to_decimal(value))
-            #     elif field_type == 'date' and value is not None:
-            #         if isinstance(value, date):
-            #             processed_data[field_name] = value.isoformat()
-            #         else:
-            #             processed_data[field_name] = str(value)
-            #     else:
-            #         processed_data[field_name] = value
-            # else:
-            #     processed_data[field_name] = value
-            processed_data[field_name] = str(value)
+        processed_data = to_json_payload(data)
 
         result = supabase_client.table(table_name).update(processed_data).eq('id', record_id).execute()
         return result.data is not None
@@ -335,7 +299,7 @@ def render_xml_upload_section(supabase_client, table_name, fields_config, displa
                                     # data['data']['updated_at'] = datetime.now().isoformat()
                                     data['user_id'] = st.session_state.user.id
 
-                                result = supabase_client.table(table_name).insert(data_to_insert).execute()
+                                result = supabase_client.table(table_name).insert(to_json_payload(data_to_insert)).execute()
                                 print("Insert successful:", result.data)
                                 st.success("Fatture salvate con successo nel database!")
 
@@ -399,7 +363,7 @@ def render_modify_form(supabase_client, user_id, table_name, fields_config, data
 
         field_items = list(fields_config.items())
 
-        sql_table_fields_names = extract_field_names('sql/02_create_tables.sql', prefix)
+        sql_table_fields_names = get_field_names(prefix)
 
         cols = st.columns(2)
         for i, (field_name, field_config) in enumerate(field_items):
@@ -442,11 +406,10 @@ def render_modify_form(supabase_client, user_id, table_name, fields_config, data
                     # and we know that if we pass None, the supabase API will convert to NONE or
                     # default value.
                     for name, value in form_data.items():
-                        # All string otherwise 'Object of type date is not JSON serializable'
-                        processed_data[prefix + name] = str(value)
+                        processed_data[prefix + name] = value
 
                     with st.spinner("Salvataggio in corso..."):
-                        result = supabase_client.table(table_name).update(processed_data).eq('id', record_id).execute()
+                        result = supabase_client.table(table_name).update(to_json_payload(processed_data)).eq('id', record_id).execute()
                         if result:
                             st.success("Fattura salvata con successo nel database!")
                             time.sleep(1)
@@ -459,8 +422,8 @@ def render_data_table(supabase_client, user_id, table_name, fields_config, displ
     """Render data table with optional search and return selected record ID"""
     display_name = display_name or table_name.replace('_', ' ').title()
 
-    # Load data from database
-    data_df = fetch_all_records(supabase_client, table_name, user_id)
+    # Load data from database, only the configured fields are shown and searched
+    data_df = fetch_all_records(supabase_client, table_name, user_id, ['id'] + list(fields_config))
 
     if data_df.empty:
         st.info(f"Nessun record trovato per {display_name}")
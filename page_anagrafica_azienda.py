@@ -10,6 +10,18 @@ from anagrafica_utils import get_cleaned_company_identifiers
 from config import uppercase_prefixes, technical_fields
 from invoice_utils import render_field_widget
 from utils import setup_page, fetch_all_records_from_view
+from db_serialization import to_json_payload
+import record_cache
+import query_cache
+
+# Columns of the casse_summary view, all shown in the table of the casse.
+CASSE_SUMMARY_DISPLAY_COLUMNS = ['c_nome_cassa', 'c_iban_cassa', 'c_descrizione_cassa']
+
+def _blank_to_none(value):
+    """The empty or blank text of a widget is stored as NULL."""
+    if isinstance(value, str) and value.strip() == '':
+        return None
+    return value
 
 def render_anagrafica_azienda_form(client, user_id):
 
@@ -92,13 +104,11 @@ def render_add_casse_modal(supabase_client, config, emesse_names, emesse_iban):
                 if error:
                     st.warning(error)
                 else:
-                    for name, value in form_data.copy().items():
-                        form_data[name] = str(value)
-
                     with st.spinner("Salvataggio in corso..."):
                         form_data['user_id'] = st.session_state.user.id
 
-                        result = supabase_client.table('casse').insert(form_data).execute()
+                        result = supabase_client.table('casse').insert(to_json_payload(form_data)).execute()
+                        query_cache.bump_version('casse')
 
                         has_errored = (hasattr(result, 'error') and result.error)
 
@@ -159,52 +169,7 @@ def render_modify_casse_modal(supabase_client, config, selected_db_row, emesse_n
         # Fatture emesse is the only one that can have, if everything is correct,
         # nome_cassa and iban_cassa valued!!
         # All the other should have only rfr_display_cassa valued.
-        emesse_query = supabase_client.table('rate_fatture_emesse').select('id')
-
-        # Handle nome_cassa - use is_ for None values, eq for actual values
-        if selected_row2['c_nome_cassa'] is None:
-            emesse_query = emesse_query.is_('rfe_nome_cassa', None)
-        else:
-            emesse_query = emesse_query.eq('rfe_nome_cassa', selected_row2['c_nome_cassa'])
-        if selected_row2['c_iban_cassa'] is None:
-            emesse_query = emesse_query.is_('rfe_iban_cassa', None)
-        else:
-            emesse_query = emesse_query.eq('rfe_iban_cassa', selected_row2['c_iban_cassa'])
-        emesse_query = emesse_query.eq('user_id', st.session_state.user.id)
-
-        ricevute_query = supabase_client.table('rate_fatture_ricevute').select('id')
-        if selected_row2['c_descrizione_cassa'] is None:
-            ricevute_query = ricevute_query.is_('rfr_nome_cassa', None)
-        else:
-            ricevute_query = ricevute_query.eq('rfr_nome_cassa', selected_row2['c_descrizione_cassa'])
-        # if selected_row2['c_iban_cassa'] is None:
-        #     ricevute_query = ricevute_query.is_('rfr_iban_cassa', None)
-        # else:
-        #     ricevute_query = ricevute_query.eq('rfr_iban_cassa', selected_row2['c_iban_cassa'])
-        ricevute_query = ricevute_query.eq('user_id', st.session_state.user.id)
-
-
-        movimenti_attivi_query = supabase_client.table('rate_movimenti_attivi').select('id')
-        if selected_row2['c_descrizione_cassa'] is None:
-            movimenti_attivi_query = movimenti_attivi_query.is_('rma_nome_cassa', None)
-        else:
-            movimenti_attivi_query = movimenti_attivi_query.eq('rma_nome_cassa', selected_row2['c_descrizione_cassa'])
-        # if selected_row2['c_iban_cassa'] is None:
-        #     movimenti_attivi_query = movimenti_attivi_query.is_('rma_iban_cassa', None)
-        # else:
-        #     movimenti_attivi_query = movimenti_attivi_query.eq('rma_iban_cassa', selected_row2['c_iban_cassa'])
-        movimenti_attivi_query = movimenti_attivi_query.eq('user_id', st.session_state.user.id)
-
-        movimenti_passivi_query = supabase_client.table('rate_movimenti_passivi').select('id')
-        if selected_row2['c_descrizione_cassa'] is None:
-            movimenti_passivi_query = movimenti_passivi_query.is_('rmp_nome_cassa', None)
-        else:
-            movimenti_passivi_query = movimenti_passivi_query.eq('rmp_nome_cassa', selected_row2['c_descrizione_cassa'])
-        # if selected_row2['c_iban_cassa'] is None:
-        #     movimenti_passivi_query = movimenti_passivi_query.is_('rmp_iban_cassa', None)
-        # else:
-        #     movimenti_passivi_query = movimenti_passivi_query.eq('rmp_iban_cassa', selected_row2['c_iban_cassa'])
-        movimenti_passivi_query = movimenti_passivi_query.eq('user_id', st.session_state.user.id)
+        # The terms to update are found with these values by the rename_cassa rpc.
 
 
         is_read_from_emesse = selected_row['c_nome_cassa'] in emesse_names or selected_row['c_iban_cassa'] in emesse_iban
@@ -259,11 +224,7 @@ def render_modify_casse_modal(supabase_client, config, selected_db_row, emesse_n
 
                 if error:
                     st.warning(error)
-                else:
-                    for name, value in form_data.copy().items():
-                        form_data[name] = str(value)
-
-                    form_data['user_id'] = st.session_state.user.id
+                    return
 
                 try:
 
@@ -272,109 +233,32 @@ def render_modify_casse_modal(supabase_client, config, selected_db_row, emesse_n
                         #
                         upsert_data = {
                             'user_id': st.session_state.user.id,
-                            'c_nome_cassa': None if form_data['c_nome_cassa'].strip() == '' else form_data['c_nome_cassa'],
-                            'c_iban_cassa': None if form_data['c_iban_cassa'].strip() == '' else form_data['c_iban_cassa'],
-                            'c_descrizione_cassa': None if form_data['c_descrizione_cassa'].strip() == '' else form_data['c_descrizione_cassa']
+                            'c_nome_cassa': _blank_to_none(form_data['c_nome_cassa']),
+                            'c_iban_cassa': _blank_to_none(form_data['c_iban_cassa']),
+                            'c_descrizione_cassa': _blank_to_none(form_data['c_descrizione_cassa'])
                         }
 
-                        display_value = upsert_data.get('c_descrizione_cassa') or upsert_data.get('c_nome_cassa') or upsert_data.get('c_iban_cassa', None)
-
-                        if is_read_from_emesse:
-
-                            query = supabase_client.table('casse').select('id').eq('user_id', st.session_state.user.id)
-
-                            # Handle c_nome_cassa - check for empty string or use eq
-                            if not upsert_data['c_nome_cassa']:
-                                query = query.is_('c_nome_cassa', None)
-                            else:
-                                query = query.eq('c_nome_cassa', upsert_data['c_nome_cassa'])
-
-                            if not upsert_data['c_iban_cassa']:
-                                query = query.is_('c_iban_cassa', None)
-                            else:
-                                query = query.eq('c_iban_cassa', upsert_data['c_iban_cassa'])
-
-                            # Execute the query
-                            existing_result = query.execute()
-
-                            if existing_result.data:
-                                existing_id = existing_result.data[0]['id']
-                                result = supabase_client.table('casse').update(upsert_data).eq('id', existing_id).execute()
-                            else:
-                                result = supabase_client.table('casse').insert(upsert_data).execute()
-
-
-                            # When you have multiple unique constraints on a table (primary key + your composite unique key),
-                            # you need to tell the database which one to use for conflict resolution.
-                            # result = supabase_client.table('casse').upsert(upsert_data,
-                            #                                                on_conflict='user_id,c_nome_cassa,c_iban_cassa'
-                            #                                                ).execute()
-
-                            # Check if update actually affected any rows
-                            # if len(result.data) == 0:
-                            #     st.error("Nessun record trovato da aggiornare")
-                            #     return
-
-                            emesse_affected_ids = emesse_query.execute().data
-                            ricevute_affected_ids = ricevute_query.execute().data
-                            movimenti_attivi_affected_ids = movimenti_attivi_query.execute().data
-                            movimenti_passivi_affected_ids = movimenti_passivi_query.execute().data
-
-                            for row_id in emesse_affected_ids:
-                                result = supabase_client.table('rate_fatture_emesse').update({'rfe_display_cassa': display_value}) \
-                                .eq('id',row_id.get('id')).execute()
-
-                            for row_id in ricevute_affected_ids:
-                                result = supabase_client.table('rate_fatture_ricevute').update({'rfr_display_cassa': display_value}) \
-                                .eq('id',row_id.get('id')).execute()
-
-                            for row_id in movimenti_attivi_affected_ids:
-                                result = supabase_client.table('rate_movimenti_attivi').update({'rma_display_cassa': display_value}) \
-                                    .eq('id',row_id.get('id')).execute()
-
-                            for row_id in movimenti_passivi_affected_ids:
-                                result = supabase_client.table('rate_movimenti_passivi').update({'rmp_display_cassa': display_value}) \
-                                    .eq('id',row_id.get('id')).execute()
-
-                        else:
-                            # Here I need to use another condition, id, to handle conflict,
-                            # otherwise I get duplication.
-
-                            emesse_affected_ids = emesse_query.execute().data
-                            ricevute_affected_ids = ricevute_query.execute().data
-                            movimenti_attivi_affected_ids = movimenti_attivi_query.execute().data
-                            movimenti_passivi_affected_ids = movimenti_passivi_query.execute().data
-
-                            upsert_data['id'] = upsert_record_id
-                            result = supabase_client.table('casse').upsert(upsert_data,
-                                                                           on_conflict='id'
-                                                                           ).execute()
-
-                            for row_id in emesse_affected_ids:
-                                result = supabase_client.table('rate_fatture_emesse').update({'rfe_display_cassa': display_value}) \
-                                    .eq('id',row_id.get('id')).execute()
-
-                            for row_id in ricevute_affected_ids:
-                                result = supabase_client.table('rate_fatture_ricevute').update({'rfr_display_cassa': display_value}) \
-                                    .eq('id',row_id.get('id')).execute()
-
-                            for row_id in movimenti_attivi_affected_ids:
-                                result = supabase_client.table('rate_movimenti_attivi').update({'rma_display_cassa': display_value}) \
-                                    .eq('id',row_id.get('id')).execute()
-
-                            for row_id in movimenti_passivi_affected_ids:
-                                result = supabase_client.table('rate_movimenti_passivi').update({'rmp_display_cassa': display_value}) \
-                                    .eq('id',row_id.get('id')).execute()
-                        has_errored = (hasattr(result, 'error') and result.error)
-
-                        # todo: I don't know if has_errored works for all types of errors...
-                        if not has_errored:
-                            st.success("Dati aggiornati con successo!")
-
-                            st.session_state.force_update = True
+                        # casse and the display cassa of all the terms that use it are updated
+                        # by the rpc in one transaction, one UPDATE per table.
+                        # For the casse read from the fatture emesse there could be no row in casse yet,
+                        # the rpc finds it by nome and iban, or inserts it.
+                        result = supabase_client.rpc('rename_cassa', to_json_payload({
+                            'cassa_id': None if is_read_from_emesse else upsert_record_id,
+                            'old_cassa': selected_row2,
+                            'new_cassa': upsert_data
+                        })).execute()
+
+                        if result.data.get('success', False):
+                            updated_terms = sum(result.data[table] for table in ['rate_fatture_emesse', 'rate_fatture_ricevute',
+                                                                                 'rate_movimenti_attivi', 'rate_movimenti_passivi'])
+                            st.success(f"Dati aggiornati con successo! Scadenze aggiornate: {updated_terms}")
+
+                            # The rpc returns only the counts of the terms it changed.
+                            record_cache.invalidate('casse', 'rate_fatture_emesse', 'rate_fatture_ricevute',
+                                                    'rate_movimenti_attivi', 'rate_movimenti_passivi')
                             st.rerun()
                         else:
-                            st.error(f"Errore modifica cassa: {result.error.message}")
+                            st.error(f"Errore modifica cassa: {result.data.get('error')}")
                             return
 
                 except Exception as e:
@@ -410,6 +294,7 @@ def render_delete_casse_modal(supabase_client, selected_db_row, emesse_names, em
                         query = query.eq(field, value)
 
                     result = query.eq('user_id', st.session_state.user.id).execute()
+                    query_cache.bump_version('casse')
 
                     has_errored = (hasattr(result, 'error') and result.error)
 
@@ -444,7 +329,7 @@ def render_casse(supabase_client, config):
         if v is not None and v not in emesse_iban:
             emesse_iban.append(v)
 
-    casse_data = fetch_all_records_from_view(supabase_client, 'casse_summary')
+    casse_data = fetch_all_records_from_view(supabase_client, 'casse_summary', CASSE_SUMMARY_DISPLAY_COLUMNS)
 
     if not casse_data:
         st.info("Nessuna cassa letta da fattura. È possibile creare una cassa manualmente.")
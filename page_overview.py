@@ -5,44 +5,28 @@ from datetime import date, datetime
 import plotly.graph_objects as go
 from dateutil.relativedelta import relativedelta
 
-from utils import setup_page
+from utils import setup_page, get_user_counters
 
 getcontext().prec = 2
 
 def get_invoices_statistics(supabase_client, user_id):
 
     try:
-        # todo: use count if I don't need the full data.
-        emesse_result = supabase_client.table('fatture_emesse').select('id').eq('user_id', user_id).execute()
-        emesse_invoices = emesse_result.data or []
-        emesse_invoices_count = len(emesse_invoices)
-
-        ricevute_result = supabase_client.table('fatture_ricevute').select('id').eq('user_id', user_id).execute()
-        ricevute_invoices = ricevute_result.data or []
-        ricevute_invoices_count = len(ricevute_invoices)
-
-        total_invoices_count = emesse_invoices_count + ricevute_invoices_count
-
-        emesse_with_terms_result = supabase_client.table('rate_fatture_emesse').select('DISTINCT invoice_id').eq('user_id', user_id).execute()
-        emesse_with_terms = emesse_with_terms_result.data or []
-        emesse_with_terms_count = len(emesse_with_terms)
-
-        ricevute_with_terms_result = supabase_client.table('rate_fatture_ricevute').select('DISTINCT invoice_id').eq('user_id', user_id).execute()
-        ricevute_with_terms = ricevute_with_terms_result.data or []
-        ricevute_with_terms_count = len(ricevute_with_terms)
+        counters = get_user_counters(supabase_client, user_id)
 
-        invoices_without_terms_count = total_invoices_count - emesse_with_terms_count - ricevute_with_terms_count
+        total_invoices_count = counters['fatture_emesse_count'] + counters['fatture_ricevute_count']
+        invoices_with_terms_count = counters['fatture_emesse_with_terms_count'] + counters['fatture_ricevute_with_terms_count']
 
         return {
             'total_invoices_count': total_invoices_count,
-            'invoices_without_terms_count': invoices_without_terms_count,
+            'invoices_without_terms_count': total_invoices_count - invoices_with_terms_count,
         }
 
     except Exception as e:
         st.error(f"Errore nel caricamento dell'overview: {str(e)}")
         return {
             'total_invoices_count': 0,
-            'invoices_without_terms': 0,
+            'invoices_without_terms_count': 0,
         }
 
 def get_monthly_terms_projection(supabase_client, user_id, months_ahead = 12):
@@ -0,0 +1,209 @@
+"""
+Installments schedule engine, for one or many documents at once.
+
+It replaces the per-row loops in auto_split_payment_invoice() (invoice_manage.py) and
+auto_split_payment_movement() (altri_movimenti_utils.py), that only supported a fixed
+number of days between terms.
+
+Due dates conventions:
+- 'giorni':       data documento + interval_days * i, as before (30, 60, 90 giorni data fattura).
+- 'fine_mese':    DFFM, data fattura fine mese. Last day of the month,
+                  interval_days // 30 * i months after the document month (30/60/90 DFFM).
+- 'giorno_fisso': same months as 'fine_mese', but on day_of_month, or on the last day of
+                  the month if the month is shorter.
+
+Amounts:
+All computations are done on integer cents, so there are no float errors.
+- equal split:   every installment is to_money(totale / n), ROUND_HALF_UP,
+                 and the last one gets the remainder, same as before.
+- custom splits: a list of weights, for example [30, 70] or [1, 1, 2]. Every installment
+                 is the rounded share of the total, and the last one gets the remainder.
+The sum of the installments is always exactly equal to the total.
+
+Input of build_schedule() is a DataFrame with one row per document, output is a DataFrame with
+one row per installment, so hundreds of documents are processed with numpy operations only.
+"""
+
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+import streamlit as st
+from utils import to_money
+
+CONVENTIONS = {
+    'giorni': 'Giorni data documento',
+    'fine_mese': 'Fine mese (DFFM)',
+    'giorno_fisso': 'Giorno fisso del mese',
+}
+
+
+def _round_half_up_div(numerator, denominator):
+    """Integer division rounded half away from zero, same as Decimal ROUND_HALF_UP."""
+    sign = np.sign(numerator)
+    return sign * ((np.abs(numerator) * 2 + denominator) // (2 * denominator))
+
+
+def split_amounts(totals_cents, num_installments, splits = None):
+    """
+    totals_cents: int64 array of the document totals, in cents.
+    return: int64 matrix (documents x installments) of the installments amounts, in cents.
+    """
+    totals_cents = np.asarray(totals_cents, dtype=np.int64)
+
+    if splits is None:
+        weights = np.ones(num_installments, dtype=np.int64)
+    else:
+        # Weights can be percentages with decimals, I scale them to integers
+        # so that the rounding is done only once, on the amounts.
+        weights = np.rint(np.asarray(splits, dtype=float) * 10000).astype(np.int64)
+        if len(weights) != num_installments:
+            raise ValueError(f'Attese {num_installments} percentuali, trovate {len(weights)}.')
+        if (weights <= 0).any():
+            raise ValueError('Le percentuali devono essere maggiori di zero.')
+
+    amounts = _round_half_up_div(totals_cents[:, None] * weights[None, :], weights.sum())
+    # Last installment gets the remainder to avoid rounding errors
+    amounts[:, -1] = totals_cents - amounts[:, :-1].sum(axis=1)
+    return amounts
+
+
+def due_dates(start_dates, num_installments, convention = 'giorni', interval_days = 30, day_of_month = None):
+    """
+    start_dates: datetime64[D] array of the document dates.
+    return: datetime64[D] matrix (documents x installments) of the due dates.
+    """
+    start_dates = np.asarray(start_dates, dtype='datetime64[D]')
+    steps = np.arange(1, num_installments + 1)
+
+    if convention == 'giorni':
+        return start_dates[:, None] + (steps * interval_days).astype('timedelta64[D]')
+
+    # The monthly conventions count whole months, 30 days each.
+    if interval_days % 30 != 0:
+        raise ValueError('Per le scadenze mensili i giorni tra rate devono essere multipli di 30.')
+    interval_months = int(interval_days) // 30
+    months = start_dates.astype('datetime64[M]')[:, None] + (steps * interval_months).astype('timedelta64[M]')
+    first_day = months.astype('datetime64[D]')
+    last_day = (months + np.timedelta64(1, 'M')).astype('datetime64[D]') - np.timedelta64(1, 'D')
+
+    if convention == 'fine_mese':
+        return last_day
+    if convention == 'giorno_fisso':
+        if day_of_month is None or not 1 <= day_of_month <= 31:
+            raise ValueError('Giorno del mese non valido.')
+        return np.minimum(first_day + np.timedelta64(day_of_month - 1, 'D'), last_day)
+
+    raise ValueError(f'Convenzione {convention} non supportata.')
+
+
+def build_schedule(documents: pd.DataFrame, num_installments, convention = 'giorni',
+                   interval_days = 30, day_of_month = None, splits = None) -> pd.DataFrame:
+    """
+    documents: one row per document, with columns
+               - importo_totale: money as Decimal, float or string
+               - data_documento: date or ISO string
+               any other column (ids, document keys...) is repeated in each installment row.
+    return: one row per installment with the documents columns plus
+            rata (1..n), data_scadenza (date), importo (Decimal with 2 decimal places), notes.
+    """
+    if splits is not None:
+        num_installments = len(splits)
+    if num_installments <= 0 or documents.empty:
+        return pd.DataFrame(columns=list(documents.columns) + ['rata', 'data_scadenza', 'importo', 'notes'])
+
+    totals_cents = np.array([int(to_money(x) * 100) for x in documents['importo_totale']], dtype=np.int64)
+    start_dates = pd.to_datetime(documents['data_documento']).to_numpy().astype('datetime64[D]')
+
+    amounts = split_amounts(totals_cents, num_installments, splits)
+    dates = due_dates(start_dates, num_installments, convention, interval_days, day_of_month)
+
+    schedule = documents.loc[documents.index.repeat(num_installments)].reset_index(drop=True)
+    schedule['rata'] = np.tile(np.arange(1, num_installments + 1), len(documents))
+    schedule['data_scadenza'] = dates.ravel().astype(object)
+    schedule['importo'] = [Decimal(int(cents)).scaleb(-2) for cents in amounts.ravel()]
+    schedule['notes'] = [f'Rata {i} di {num_installments}' for i in schedule['rata']]
+    return schedule
+
+
+def split_document(importo_totale, num_installments, start_date, convention = 'giorni',
+                   interval_days = 30, day_of_month = None, splits = None) -> list[dict]:
+    """Single document version of build_schedule(), used by the terms editors."""
+    documents = pd.DataFrame({'importo_totale': [importo_totale], 'data_documento': [start_date]})
+    schedule = build_schedule(documents, num_installments, convention, interval_days, day_of_month, splits)
+    return schedule[['rata', 'data_scadenza', 'importo', 'notes']].to_dict('records')
+
+
+def rescale_amounts(amounts, new_total) -> list[Decimal]:
+    """
+    Installments of a document whose total was modified, in the same order: the new total
+    is split with the current amounts as weights, so the schedule keeps its shape, and the
+    last one gets the remainder. If some amount is zero, the new total is split in equal parts.
+    """
+    cents = np.array([int(to_money(amount) * 100) for amount in amounts], dtype=np.int64)
+    if len(cents) == 0:
+        return []
+
+    total_cents = int(to_money(new_total) * 100)
+    weights = np.abs(cents) if (cents != 0).all() else np.ones(len(cents), dtype=np.int64)
+    # Not split_amounts(), its weights are scaled for the percentages and would overflow with cents.
+    new_cents = _round_half_up_div(total_cents * weights, weights.sum())
+    new_cents[-1] = total_cents - new_cents[:-1].sum()
+    return [Decimal(int(c)).scaleb(-2) for c in new_cents]
+
+
+def parse_splits(text: str) -> list[float] | None:
+    """'30/70', '30; 70' or '33,3 / 66,7' -> list of floats, empty string -> None."""
+    text = text.strip()
+    if not text:
+        return None
+    return [float(x.replace(',', '.')) for x in text.replace('/', ' ').replace(';', ' ').split()]
+
+
+def render_schedule_options(key_prefix):
+    """
+    Widgets of the quick configuration, shared by the invoice and the movement terms editors.
+    return: the build_schedule() keyword arguments, or None if the options are not valid.
+    """
+    col1, col2, col3 = st.columns([1, 1, 1], vertical_alignment='bottom')
+    with col1:
+        num_installments = st.number_input("Numero rate", min_value=1, max_value=12, value=1,
+                                           key = key_prefix + '_num_installments')
+    with col2:
+        convention = st.selectbox("Scadenza", options=list(CONVENTIONS), format_func=CONVENTIONS.get,
+                                  key = key_prefix + '_convention')
+    with col3:
+        interval_days = st.number_input("Giorni tra rate", min_value=1, max_value=365, value=30, step=15,
+                                        key = key_prefix + '_interval_days')
+
+    day_of_month = None
+    if convention == 'giorno_fisso':
+        day_of_month = st.number_input("Giorno del mese", min_value=1, max_value=31, value=10,
+                                       key = key_prefix + '_day_of_month')
+
+    if convention != 'giorni' and interval_days % 30 != 0:
+        st.warning(f'Con la scadenza "{CONVENTIONS[convention]}" i giorni tra rate devono essere '
+                   f'multipli di 30, un mese ogni 30 giorni.')
+        return None
+
+    splits_text = st.text_input("Percentuali rate (opzionale)", placeholder='30/70',
+                                help="Lasciare vuoto per dividere l'importo in parti uguali.",
+                                key = key_prefix + '_splits')
+    try:
+        splits = parse_splits(splits_text)
+    except ValueError:
+        st.warning('Percentuali non valide, usare ad esempio 30/70.')
+        return None
+    if splits is not None and len(splits) != num_installments:
+        st.warning(f'Inserire {num_installments} percentuali, una per rata.')
+        return None
+    if splits is not None and min(splits) <= 0:
+        st.warning('Le percentuali devono essere maggiori di zero.')
+        return None
+
+    return {
+        'num_installments': num_installments,
+        'convention': convention,
+        'interval_days': interval_days,
+        'day_of_month': day_of_month,
+        'splits': splits,
+    }
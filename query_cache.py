@@ -0,0 +1,106 @@
+"""
+Per session cache of the reads of the fetch helpers of utils.py: fetch_all_records(),
+fetch_all_records_from_view() and fetch_record_from_id().
+
+The rows are kept in the session state, keyed by (table or view, user, filters), and
+reused until TTL_SECONDS passed or the version of one of the tables read changed.
+A view depends on the versions of its VIEW_TABLES. The writes call bump_version(),
+usually through record_cache.py, and the terms editors reload their terms when the
+version of the rate table changes.
+
+On a miss the rows stored in shared_cache.py by another session of the same user are
+used, if they have the same versions. hit_rates() are shown in the request_metrics.py panel.
+"""
+
+import time
+import streamlit as st
+import shared_cache
+
+CACHE_KEY = 'query_cache'
+TTL_SECONDS = 120
+
+RATE_TABLES = ['rate_fatture_emesse', 'rate_fatture_ricevute', 'rate_movimenti_attivi', 'rate_movimenti_passivi']
+
+# The tables read by every view, see sql/02_create_tables.sql. Tables not here depend only on themselves.
+VIEW_TABLES = {
+    'fatture_emesse_overview': ['fatture_emesse', 'rate_fatture_emesse'],
+    'fatture_ricevute_overview': ['fatture_ricevute', 'rate_fatture_ricevute'],
+    'movimenti_attivi_overview': ['movimenti_attivi', 'rate_movimenti_attivi'],
+    'movimenti_passivi_overview': ['movimenti_passivi', 'rate_movimenti_passivi'],
+    'casse_summary': RATE_TABLES + ['casse'],
+    'casse_options': RATE_TABLES + ['casse'],
+}
+
+
+def _get_cache() -> dict:
+    if CACHE_KEY not in st.session_state:
+        st.session_state[CACHE_KEY] = {'entries': {}, 'stats': {}}
+    return st.session_state[CACHE_KEY]
+
+
+def _session_user_id():
+    user = st.session_state.get('user')
+    return user.id if user else None
+
+
+def get_version(table_name, user_id = None) -> int:
+    """user_id: the user of the session if not given."""
+    return shared_cache.get_version(user_id or _session_user_id(), table_name)
+
+
+def bump_version(*table_names, user_id = None):
+    """
+    Marks as stale all the cached reads of the tables, and of the views that read them,
+    in all the sessions of the user. user_id: the user of the session if not given.
+    """
+    shared_cache.bump_version(user_id or _session_user_id(), *table_names)
+
+
+def count(name, outcome):
+    """outcome: 'hits', 'shared_hits' or 'misses'."""
+    stats = _get_cache()['stats'].setdefault(name, {'hits': 0, 'shared_hits': 0, 'misses': 0})
+    stats[outcome] += 1
+
+
+def get(name, user_id, filters, fetch, ttl = TTL_SECONDS):
+    """
+    name:    table or view read.
+    filters: hashable, e.g. (('id', record_id),), the user is already in the key.
+    fetch:   called without arguments on a miss, returns the rows.
+    return:  the rows, from the cache if they are still valid.
+    """
+    cache = _get_cache()
+    key = (name, user_id, filters)
+    versions = tuple(get_version(table_name, user_id) for table_name in VIEW_TABLES.get(name, [name]))
+
+    entry = cache['entries'].get(key)
+    if entry is not None and entry['versions'] == versions and time.time() - entry['fetched_at'] < ttl:
+        count(name, 'hits')
+        return entry['rows']
+
+    # Without a user the key could match the rows of someone else, so they are never shared.
+    shared = shared_cache.get(user_id, name, filters, versions, ttl) if user_id else None
+    if shared is not None:
+        count(name, 'shared_hits')
+        # The shared rows keep their own fetched_at, they are not made younger by the copy.
+        rows, fetched_at = shared
+    else:
+        count(name, 'misses')
+        rows, fetched_at = fetch(), time.time()
+        if user_id:
+            shared_cache.put(user_id, name, filters, versions, rows)
+
+    cache['entries'][key] = {'rows': rows, 'versions': versions, 'fetched_at': fetched_at}
+    return rows
+
+
+def clear():
+    """Drops all the cached reads, the versions are kept."""
+    _get_cache()['entries'].clear()
+
+
+def hit_rates() -> dict:
+    """return: {name: {'hits', 'shared_hits', 'misses', 'rate'}}, rate of the reads not done by the database."""
+    return {name: {**stats, 'rate': (stats['hits'] + stats['shared_hits']) /
+                                    (stats['hits'] + stats['shared_hits'] + stats['misses'])}
+            for name, stats in _get_cache()['stats'].items()}
@@ -0,0 +1,179 @@
+"""
+Per user cache of whole tables, in the session state, with the rows keyed by id.
+
+The writes ask the changed rows back (return=representation of PostgREST, or the 'rows'
+of the rpc results) and merge them here with merge_rows() / merge_rpc_result(), so the
+next run does not fetch the table again. Writes that don't return their rows, like the
+ON DELETE/UPDATE CASCADE of the terms, invalidate() the table.
+
+Every change bumps the version of the table in query_cache.py. A cached table is fetched
+again when its version was bumped by someone else, after query_cache.TTL_SECONDS, or,
+for the invoice tables, when the upload jobs of the user change (see ingestion_queue.py).
+
+save_document_with_terms() updates a document only if its updated_at is still the one read.
+"""
+
+import logging
+import sqlite3
+import time
+import streamlit as st
+import query_cache
+from utils import fetch_all_records, ALL_COLUMNS
+from db_serialization import to_json_payload
+from ingestion_queue import list_jobs, UPLOAD_TABLES
+from request_metrics import track_action
+
+CACHE_KEY = 'record_cache'
+
+
+
+def _get_cache(user_id) -> dict:
+    cache = st.session_state.get(CACHE_KEY)
+    if cache is None or cache['user_id'] != user_id:
+        cache = {'user_id': user_id, 'tables': {}, 'upload_marker': None}
+        st.session_state[CACHE_KEY] = cache
+    return cache
+
+
+def _upload_marker(user_id):
+    try:
+        jobs = list_jobs(user_id, limit = 1)
+    except sqlite3.Error as e:
+        # Without the queue there are no uploads to wait for, the TTL still refreshes the tables.
+        logging.exception(f'record_cache: cannot read the upload jobs - error: {e} - user_id: {user_id}')
+        return None
+    if not jobs:
+        return None
+    return jobs[0]['id'], jobs[0]['status'], jobs[0]['processed_files']
+
+
+def get_records(supabase_client, table_name, user_id) -> list:
+    """Same as fetch_all_records(), but served from the cache after the first call."""
+    cache = _get_cache(user_id)
+
+    if table_name in UPLOAD_TABLES:
+        marker = _upload_marker(user_id)
+        if marker != cache['upload_marker']:
+            invalidate(*UPLOAD_TABLES)
+            cache['upload_marker'] = marker
+
+    entry = cache['tables'].get(table_name)
+    if entry is not None and entry['version'] == query_cache.get_version(table_name, user_id) \
+            and time.time() - entry['loaded_at'] < query_cache.TTL_SECONDS:
+        query_cache.count(table_name, 'hits')
+    else:
+        # The miss is counted by fetch_all_records().
+        # Whole rows: they are edited in the modify dialogs, and merged with the rows
+        # returned by the writes, that are whole too.
+        rows = fetch_all_records(supabase_client, table_name, user_id, ALL_COLUMNS)
+        entry = {'rows': {row['id']: row for row in rows},
+                 'version': query_cache.get_version(table_name, user_id),
+                 'loaded_at': time.time()}
+        cache['tables'][table_name] = entry
+
+    return list(entry['rows'].values())
+
+
+def get_record(supabase_client, table_name, record_id, user_id) -> dict:
+    """
+    Same as fetch_record_from_id(), but from the cache. The modify dialogs use it, so the
+    updated_at they send to save_document_with_terms() is the one of the data shown in the page.
+    """
+    for row in get_records(supabase_client, table_name, user_id):
+        if row['id'] == record_id:
+            return row
+    return {}
+
+
+def _written(table_name):
+    """
+    Bumps the version of the table after a write, return: its cached entry, still valid
+    since the change is applied to it, None if the table was never read or was changed
+    by another session or upload worker after the read: then the entry is dropped, the
+    write alone would not bring it up to date.
+    """
+    cache = st.session_state.get(CACHE_KEY)
+    user_id = cache['user_id'] if cache else None
+    entry = cache['tables'].get(table_name) if cache else None
+    current = entry is not None and entry['version'] == query_cache.get_version(table_name, user_id)
+    query_cache.bump_version(table_name, user_id = user_id)
+    if entry is None:
+        return None
+    if not current:
+        cache['tables'].pop(table_name)
+        return None
+    entry['version'] = query_cache.get_version(table_name, user_id)
+    return entry
+
+
+def merge_rows(table_name, rows):
+    """Adds or replaces the rows, as returned by the database, of a cached table."""
+    entry = _written(table_name)
+    if entry is None:
+        # Never read, it will be fetched whole at the first read anyway.
+        return
+    user_id = st.session_state[CACHE_KEY]['user_id']
+    for row in rows or []:
+        if row.get('user_id') != user_id:
+            logging.warning(f'record_cache: row of another user ignored, table: {table_name}')
+            continue
+        entry['rows'][row['id']] = row
+
+
+def remove_rows(table_name, ids):
+    entry = _written(table_name)
+    if entry is None:
+        return
+    for row_id in ids or []:
+        entry['rows'].pop(row_id, None)
+
+
+def invalidate(*table_names):
+    """For the writes that don't return the changed rows, the tables are fetched again at the next read."""
+    cache = st.session_state.get(CACHE_KEY)
+    query_cache.bump_version(*table_names, user_id = cache['user_id'] if cache else None)
+    if cache is None:
+        return
+    for table_name in table_names:
+        cache['tables'].pop(table_name, None)
+
+
+def merge_rpc_result(result: dict):
+    """
+    Merges the rows returned by the terms rpcs: apply_terms_delta, apply_terms_deltas,
+    bulk_update_terms and assign_cassa_bulk. Does nothing if the rpc failed.
+    """
+    if not result or not result.get('success', False):
+        return
+    for document_result in result.get('results', [result]):
+        table_name = document_result.get('table_name')
+        merge_rows(table_name, document_result.get('rows'))
+        remove_rows(table_name, document_result.get('deleted_ids'))
+
+
+def save_document_with_terms(supabase_client, table_name, document_id, document_data,
+                             expected_updated_at, terms_delta = None) -> dict:
+    """
+    Wrapper of the save_document_with_terms rpc: the document and its terms in one
+    transaction, only if the document was not modified after expected_updated_at.
+    The fresh rows returned are merged in the cache.
+    terms_delta: {'inserted', 'updated', 'deleted'}, see terms_delta.py. None for no changes.
+    return: the rpc result.
+    """
+    with track_action('save document'):
+        result = supabase_client.rpc('save_document_with_terms', to_json_payload({
+            'table_name': table_name,
+            'document_id': document_id,
+            'document_data': document_data,
+            'expected_updated_at': expected_updated_at,
+            **(terms_delta or {}),
+        })).execute()
+
+    if result.data.get('success', False):
+        merge_rows(table_name, [result.data.get('document')])
+        merge_rows('rate_' + table_name, result.data.get('terms'))
+        remove_rows('rate_' + table_name, result.data.get('deleted_ids'))
+    else:
+        # Whatever happened, the cached rows may not be the ones of the database anymore.
+        invalidate(table_name, 'rate_' + table_name)
+    return result.data
@@ -0,0 +1,268 @@
+"""
+Counts the postgrest requests (tables and rpcs) of the supabase client: number, bytes and latency,
+per Streamlit run and per named action (e.g. 'save terms', 'upload batch').
+
+create_instrumented_client() gives the postgrest client an httpx client whose event hooks
+add every request to the current run (start_run() / finish_run() in streamlit_app.py) and to the
+open track_action() blocks of the thread. Runs and actions over RUN_BUDGET or
+ACTION_BUDGETS are logged as warnings.
+
+The panel with the numbers, and the hit rates of query_cache.py, is shown only with:
+SHOW_REQUEST_METRICS=1 LOG_LEVEL=INFO streamlit run streamlit_app.py
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import httpx
+import streamlit as st
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_TIMEOUT
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from supabase import Client
+import query_cache
+import shared_cache
+
+METRICS_KEY = 'request_metrics'
+
+# Max requests. More than these only logs a warning, it does not stop anything.
+RUN_BUDGET = 8
+ACTION_BUDGETS = {
+    'save terms': 1,
+    'save document': 1,
+    'assign cassa': 1,
+    'count cassa terms': 1,
+    'bulk update terms': 1,
+    'bulk schedule': 1,
+    'delete documents': 1,
+    'upload batch': 2,
+}
+
+_START = 'request_metrics_start'
+_local = threading.local()
+
+
+@dataclass
+class RequestStats:
+    requests: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    seconds: float = 0.0
+    errors: int = 0
+    # 'POST rpc/apply_terms_deltas' -> number of requests
+    endpoints: dict = field(default_factory=dict)
+
+    def add(self, endpoint, bytes_sent, bytes_received, seconds, is_error):
+        self.requests += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.seconds += seconds
+        self.errors += int(is_error)
+        self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.seconds += other.seconds
+        self.errors += other.errors
+        for endpoint, count in other.endpoints.items():
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + count
+
+    def summary(self) -> str:
+        return (f'{self.requests} requests, {self.bytes_sent / 1024:.1f} KB sent, '
+                f'{self.bytes_received / 1024:.1f} KB received, {self.seconds * 1000:.0f} ms'
+                + (f', {self.errors} errors' if self.errors else ''))
+
+
+def _endpoint(request: httpx.Request) -> str:
+    # '/rest/v1/rpc/apply_terms_deltas' -> 'rpc/apply_terms_deltas', the query string is left out.
+    path = request.url.path
+    if path.startswith('/rest/v1/'):
+        path = path[len('/rest/v1/'):]
+    return f'{request.method} {path}'
+
+
+def _session_metrics():
+    """return: the metrics of the session, None outside of a script thread (the upload workers)."""
+    if get_script_run_ctx(suppress_warning = True) is None:
+        return None
+    if METRICS_KEY not in st.session_state:
+        st.session_state[METRICS_KEY] = {'run': None, 'run_logged': True, 'actions': {}}
+    return st.session_state[METRICS_KEY]
+
+
+def _action_stack() -> list:
+    if not hasattr(_local, 'actions'):
+        _local.actions = []
+    return _local.actions
+
+
+def _collectors() -> list:
+    collectors = [stats for _, stats in _action_stack()]
+    metrics = _session_metrics()
+    if metrics is not None and metrics['run'] is not None:
+        collectors.append(metrics['run'])
+    return collectors
+
+
+def _on_request(request: httpx.Request):
+    request.extensions[_START] = time.perf_counter()
+
+
+def _on_response(response: httpx.Response):
+    # Reading it here is what httpx suggests for the response hooks, the body is kept
+    # and the caller gets it as usual.
+    response.read()
+    request = response.request
+    seconds = time.perf_counter() - request.extensions.get(_START, time.perf_counter())
+    try:
+        bytes_sent = len(request.content)
+    except httpx.RequestNotRead:
+        # Streamed uploads, not used by postgrest.
+        bytes_sent = 0
+    for stats in _collectors():
+        stats.add(_endpoint(request), bytes_sent, len(response.content), seconds, response.is_error)
+
+
+def instrumented_http_client(transport = None) -> httpx.Client:
+    """
+    Same settings of the client that postgrest creates when none is given, plus the hooks.
+    transport: for the tests, an httpx.MockTransport.
+    """
+    return httpx.Client(timeout = DEFAULT_POSTGREST_CLIENT_TIMEOUT,
+                        follow_redirects = True,
+                        http2 = True,
+                        transport = transport,
+                        event_hooks = {'request': [_on_request], 'response': [_on_response]})
+
+
+class InstrumentedClient(Client):
+    """
+    Client whose postgrest requests go through postgrest_http_client. It is given only to
+    postgrest: postgrest (1.x, pinned by supabase 2.16) sets its base url and headers,
+    the Authorization too, on the httpx client it gets, so a client shared with auth,
+    storage and functions would send their requests with the postgrest url and headers.
+    Those keep their own clients, and their requests are not counted.
+    """
+
+    postgrest_http_client = None
+
+    @property
+    def postgrest(self):
+        # Created again, with the new Authorization, at every sign in, sign out and token refresh.
+        if self._postgrest is None:
+            self._postgrest = self._init_postgrest_client(rest_url = str(self.rest_url),
+                                                          headers = self.options.headers,
+                                                          schema = self.options.schema,
+                                                          http_client = self.postgrest_http_client)
+        return self._postgrest
+
+
+def create_instrumented_client(url, key, options = None, transport = None):
+    """
+    create_client() whose postgrest requests are counted, see the module docstring.
+    transport: for the tests, an httpx.MockTransport of the postgrest requests.
+    """
+    client = InstrumentedClient.create(url, key, options)
+    client.postgrest_http_client = instrumented_http_client(transport)
+    return client
+
+
+def _check_budget(name, stats, budget):
+    if budget is not None and stats.requests > budget:
+        logging.warning(f'request_metrics: {name} over budget, {stats.requests} requests, budget {budget}')
+
+
+def _log_run(metrics):
+    if metrics['run'] is None or metrics['run_logged']:
+        return
+    logging.info(f"request_metrics: run: {metrics['run'].summary()}")
+    _check_budget('run', metrics['run'], RUN_BUDGET)
+    metrics['run_logged'] = True
+
+
+def start_run():
+    """Called at the top of every Streamlit run, logs the previous run if it was not."""
+    metrics = _session_metrics()
+    if metrics is None:
+        return
+    _log_run(metrics)
+    metrics['run'] = RequestStats()
+    metrics['run_logged'] = False
+
+
+def finish_run():
+    """Called at the end of a run that was not interrupted."""
+    metrics = _session_metrics()
+    if metrics is not None:
+        _log_run(metrics)
+
+
+@contextmanager
+def track_action(name):
+    """
+    with track_action('save terms'):
+        ...
+    Counts the requests made inside the block, also when it ends with an exception,
+    like the ones of st.rerun() and st.stop(). Actions can be nested.
+    """
+    stats = RequestStats()
+    stack = _action_stack()
+    stack.append((name, stats))
+    try:
+        yield stats
+    finally:
+        # The actions of a thread always end in reverse order.
+        stack.pop()
+        logging.info(f'request_metrics: action {name!r}: {stats.summary()}')
+        _check_budget(f'action {name!r}', stats, ACTION_BUDGETS.get(name))
+
+        metrics = _session_metrics()
+        if metrics is not None:
+            total = metrics['actions'].setdefault(name, {'count': 0, 'total': RequestStats(), 'last': None})
+            total['count'] += 1
+            total['total'].merge(stats)
+            total['last'] = stats
+
+
+def is_panel_enabled() -> bool:
+    return os.getenv('SHOW_REQUEST_METRICS', '0') == '1'
+
+
+def render_metrics_panel():
+    """Developer only panel in the sidebar, see is_panel_enabled()."""
+    metrics = _session_metrics()
+    if not is_panel_enabled() or metrics is None or metrics['run'] is None:
+        return
+
+    with st.sidebar.expander('Richieste al database'):
+        run = metrics['run']
+        st.caption(f'Questa esecuzione (budget {RUN_BUDGET}): {run.summary()}')
+        st.dataframe([{'Endpoint': endpoint, 'Richieste': count}
+                      for endpoint, count in sorted(run.endpoints.items())],
+                     hide_index = True, use_container_width = True)
+
+        if metrics['actions']:
+            st.dataframe([{'Azione': name,
+                           'Esecuzioni': action['count'],
+                           'Richieste (ultima)': action['last'].requests,
+                           'Budget': ACTION_BUDGETS.get(name),
+                           'KB ricevuti (ultima)': round(action['last'].bytes_received / 1024, 1),
+                           'ms (ultima)': round(action['last'].seconds * 1000)}
+                          for name, action in metrics['actions'].items()],
+                         hide_index = True, use_container_width = True)
+
+        hit_rates = query_cache.hit_rates()
+        if hit_rates:
+            entries, size = shared_cache.backend.size()
+            st.caption(f'Cache delle letture (TTL {query_cache.TTL_SECONDS}s), '
+                       f'condivisa: {entries} letture, {size / 1024 / 1024:.1f} MB')
+            st.dataframe([{'Tabella': name, 'Hit': stats['hits'], 'Hit condivisi': stats['shared_hits'],
+                           'Miss': stats['misses'],
+                           'Hit rate': f"{stats['rate']:.0%}"}
+                          for name, stats in sorted(hit_rates.items())],
+                         hide_index = True, use_container_width = True)
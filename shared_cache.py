@@ -0,0 +1,209 @@
+"""
+Process wide cache of the query results, shared by all the sessions of the same user.
+
+The results are stored once per (user, table or view, filters), stamped with the data
+versions of the tables they read: a session that misses its own cache (query_cache.py)
+takes the rows from here if the stamp is still the current one. The versions are per
+user and shared too, so a write in one tab makes stale the reads of all the tabs.
+
+Backends, chosen at import:
+- MemoryBackend (default): LRU in the memory of the process, at most SHARED_CACHE_MAX_MB.
+- SqliteBackend, with SHARED_CACHE_DB=/path/to/file.sqlite3: the same LRU in a SQLite file,
+  shared by the processes of the same host. A Redis deployment only needs another backend
+  class with get/put/get_version/bump_version.
+
+The rows are stored as json text, so every session decodes its own copy.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SHARED_CACHE_DB = os.environ.get('SHARED_CACHE_DB')
+MAX_BYTES = int(os.environ.get('SHARED_CACHE_MAX_MB', '256')) * 1024 * 1024
+
+
+class MemoryBackend:
+
+    def __init__(self, max_bytes = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (versions, fetched_at, text), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._versions = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, versions, fetched_at, text):
+        if len(text) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[2])
+            self._entries[key] = (versions, fetched_at, text)
+            self._bytes += len(text)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last = False)
+                self._bytes -= len(evicted[2])
+
+    def get_version(self, user_id, table_name):
+        return self._versions.get((user_id, table_name), 0)
+
+    def bump_version(self, user_id, table_names):
+        with self._lock:
+            for table_name in table_names:
+                self._versions[(user_id, table_name)] = self._versions.get((user_id, table_name), 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._versions.clear()
+
+    def size(self):
+        return len(self._entries), self._bytes
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    versions TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    text TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used_idx ON entries (last_used);
+
+CREATE TABLE IF NOT EXISTS versions (
+    user_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (user_id, table_name)
+);
+"""
+
+
+class SqliteBackend:
+    """Same as MemoryBackend, one short lived connection per call, like ingestion_queue.py."""
+
+    def __init__(self, db_path, max_bytes = MAX_BYTES):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._run(lambda connection: connection.executescript(SCHEMA))
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout = 30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def _run(self, function):
+        connection = self._connect()
+        try:
+            with connection:
+                return function(connection)
+        finally:
+            connection.close()
+
+    def get(self, key):
+        def get(connection):
+            row = connection.execute('SELECT versions, fetched_at, text FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+            return tuple(json.loads(row[0])), row[1], row[2]
+        return self._run(get)
+
+    def put(self, key, versions, fetched_at, text):
+        if len(text) > self.max_bytes:
+            return
+
+        def put(connection):
+            connection.execute('INSERT OR REPLACE INTO entries (key, versions, fetched_at, text, bytes, last_used) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, json.dumps(versions), fetched_at, text, len(text), time.time()))
+            total = connection.execute('SELECT coalesce(sum(bytes), 0) FROM entries').fetchone()[0]
+            while total > self.max_bytes:
+                evicted = connection.execute('SELECT key, bytes FROM entries ORDER BY last_used LIMIT 1').fetchone()
+                connection.execute('DELETE FROM entries WHERE key = ?', (evicted[0],))
+                total -= evicted[1]
+        self._run(put)
+
+    def get_version(self, user_id, table_name):
+        row = self._run(lambda connection: connection.execute(
+            'SELECT version FROM versions WHERE user_id = ? AND table_name = ?',
+            (user_id, table_name)).fetchone())
+        return row[0] if row else 0
+
+    def bump_version(self, user_id, table_names):
+        self._run(lambda connection: connection.executemany(
+            'INSERT INTO versions (user_id, table_name, version) VALUES (?, ?, 1) '
+            'ON CONFLICT (user_id, table_name) DO UPDATE SET version = version + 1',
+            [(user_id, table_name) for table_name in table_names]))
+
+    def clear(self):
+        def clear(connection):
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM versions')
+        self._run(clear)
+
+    def size(self):
+        return self._run(lambda connection: connection.execute(
+            'SELECT count(*), coalesce(sum(bytes), 0) FROM entries').fetchone())
+
+
+backend = SqliteBackend(SHARED_CACHE_DB) if SHARED_CACHE_DB else MemoryBackend()
+
+
+def _key(user_id, name, filters):
+    return json.dumps([str(user_id), name, filters], default = str)
+
+
+def get(user_id, name, filters, versions, ttl):
+    """
+    return: (rows, fetched_at) stored by any session of the user,
+            None if missing, stale or expired.
+    """
+    try:
+        entry = backend.get(_key(user_id, name, filters))
+    except Exception as e:
+        # The shared cache is only an optimization, the caller reads from the database.
+        logging.exception(f'shared_cache: get failed - error: {e} - name: {name}')
+        return None
+    if entry is None:
+        return None
+    entry_versions, fetched_at, text = entry
+    if tuple(entry_versions) != tuple(versions) or time.time() - fetched_at >= ttl:
+        return None
+    return json.loads(text), fetched_at
+
+
+def put(user_id, name, filters, versions, rows):
+    try:
+        backend.put(_key(user_id, name, filters), list(versions), time.time(), json.dumps(rows))
+    except Exception as e:
+        logging.exception(f'shared_cache: put failed - error: {e} - name: {name}')
+
+
+def get_version(user_id, table_name) -> int:
+    # str: the session has the user id of the auth client, the workers the one saved in the jobs db.
+    return backend.get_version(str(user_id), table_name)
+
+
+def bump_version(user_id, *table_names):
+    backend.bump_version(str(user_id), table_names)
+
+
+def clear():
+    backend.clear()
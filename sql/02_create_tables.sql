@@ -486,6 +486,222 @@ CREATE TRIGGER set_payment_terms_created_at
 
 
 
+-- Per-user counters of invoices and terms, kept up to date by the triggers below,
+-- so that the upload quota and the overview KPIs are a single row lookup by primary key,
+-- instead of downloading or counting all the rows at every render.
+--
+-- Only the triggers write here, the users can only read their own row.
+CREATE TABLE public.user_counters (
+    user_id uuid NOT NULL,
+    fatture_emesse_count integer NOT NULL DEFAULT 0,
+    fatture_emesse_total numeric NOT NULL DEFAULT 0,
+    fatture_emesse_with_terms_count integer NOT NULL DEFAULT 0,
+    rate_fatture_emesse_count integer NOT NULL DEFAULT 0,
+    rate_fatture_emesse_unpaid_count integer NOT NULL DEFAULT 0,
+    rate_fatture_emesse_unpaid_total numeric NOT NULL DEFAULT 0,
+    fatture_ricevute_count integer NOT NULL DEFAULT 0,
+    fatture_ricevute_total numeric NOT NULL DEFAULT 0,
+    fatture_ricevute_with_terms_count integer NOT NULL DEFAULT 0,
+    rate_fatture_ricevute_count integer NOT NULL DEFAULT 0,
+    rate_fatture_ricevute_unpaid_count integer NOT NULL DEFAULT 0,
+    rate_fatture_ricevute_unpaid_total numeric NOT NULL DEFAULT 0,
+    updated_at timestamp with time zone DEFAULT now(),
+    CONSTRAINT user_counters_pkey PRIMARY KEY (user_id)
+);
+
+ALTER TABLE public.user_counters ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can read only their own counters" ON public.user_counters as permissive
+FOR SELECT USING (auth.uid() = user_id);
+
+-- Used by the counters triggers to find the remaining terms of an invoice,
+-- and by the ON DELETE CASCADE from the invoices.
+CREATE INDEX rate_fatture_emesse_invoice_key_idx
+    ON public.rate_fatture_emesse (user_id, rfe_partita_iva_prestatore, rfe_numero_fattura, rfe_data_documento);
+CREATE INDEX rate_fatture_ricevute_invoice_key_idx
+    ON public.rate_fatture_ricevute (user_id, rfr_partita_iva_prestatore, rfr_numero_fattura, rfr_data_documento);
+-- Same for the ON DELETE CASCADE of the movimenti, used by delete_documents.
+CREATE INDEX rate_movimenti_attivi_movement_key_idx
+    ON public.rate_movimenti_attivi (user_id, rma_numero, rma_data);
+CREATE INDEX rate_movimenti_passivi_movement_key_idx
+    ON public.rate_movimenti_passivi (user_id, rmp_numero, rmp_data);
+
+-- The triggers are FOR EACH STATEMENT with transition tables, so a set based insert of
+-- hundreds of rows updates the counters once, with one row per user.
+-- Rows are counted +1 from new_rows and -1 from old_rows, so the same code works
+-- for INSERT, UPDATE and DELETE.
+--
+-- Returns the SELECT of the changed rows for operation, the TG_OP of the trigger:
+-- TG_OP is defined only inside the trigger function itself, so it is passed.
+CREATE OR REPLACE FUNCTION counters_changes_query(operation TEXT, columns TEXT) RETURNS TEXT AS $$
+BEGIN
+    RETURN CASE operation
+        WHEN 'INSERT' THEN format('SELECT 1 AS sign, %s FROM new_rows', columns)
+        WHEN 'DELETE' THEN format('SELECT -1 AS sign, %s FROM old_rows', columns)
+        ELSE format('SELECT 1 AS sign, %1$s FROM new_rows UNION ALL SELECT -1 AS sign, %1$s FROM old_rows', columns)
+    END;
+END;
+$$ LANGUAGE plpgsql;
+
+-- TG_ARGV[0]: table prefix, for example 'fe_'.
+CREATE OR REPLACE FUNCTION count_invoices() RETURNS TRIGGER AS $$
+DECLARE
+    prefix TEXT := TG_ARGV[0];
+BEGIN
+    EXECUTE format('
+        WITH changes AS (%1$s)
+        INSERT INTO public.user_counters AS c (user_id, %2$I, %3$I)
+        SELECT user_id, sum(sign), sum(sign * amount) FROM changes GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET %2$I = c.%2$I + excluded.%2$I,
+            %3$I = c.%3$I + excluded.%3$I,
+            updated_at = now()',
+        counters_changes_query(TG_OP, format('user_id, %I AS amount', prefix || 'importo_totale_documento')),
+        TG_TABLE_NAME || '_count',
+        TG_TABLE_NAME || '_total'
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- TG_ARGV[0]: terms table prefix, for example 'rfe_'.
+-- An invoice is counted in *_with_terms_count when it goes from 0 to at least 1 term,
+-- and removed when its last term is removed: for every invoice key touched by the statement,
+-- terms before = terms now - delta of the statement.
+CREATE OR REPLACE FUNCTION count_invoice_terms() RETURNS TRIGGER AS $$
+DECLARE
+    prefix TEXT := TG_ARGV[0];
+    invoices_table TEXT := substr(TG_TABLE_NAME, length('rate_') + 1);
+BEGIN
+    EXECUTE format('
+        WITH changes AS (%1$s),
+        per_invoice AS (
+            SELECT user_id, piva, numero, data, sum(sign) AS delta
+            FROM changes GROUP BY user_id, piva, numero, data
+        ),
+        with_terms AS (
+            SELECT p.user_id, sum((n.terms_now > 0)::INTEGER - ((n.terms_now - p.delta) > 0)::INTEGER) AS delta
+            FROM per_invoice p,
+                 LATERAL (SELECT count(*) AS terms_now FROM public.%2$I t
+                          WHERE t.user_id = p.user_id AND t.%3$I = p.piva
+                            AND t.%4$I = p.numero AND t.%5$I = p.data) n
+            GROUP BY p.user_id
+        ),
+        totals AS (
+            SELECT user_id,
+                   sum(sign) AS terms_delta,
+                   coalesce(sum(sign) FILTER (WHERE paid IS NULL), 0) AS unpaid_delta,
+                   coalesce(sum(sign * amount) FILTER (WHERE paid IS NULL), 0) AS unpaid_total_delta
+            FROM changes GROUP BY user_id
+        )
+        INSERT INTO public.user_counters AS c (user_id, %6$I, %7$I, %8$I, %9$I)
+        SELECT totals.user_id, terms_delta, unpaid_delta, unpaid_total_delta, coalesce(with_terms.delta, 0)
+        FROM totals LEFT JOIN with_terms USING (user_id)
+        ON CONFLICT (user_id) DO UPDATE
+        SET %6$I = c.%6$I + excluded.%6$I,
+            %7$I = c.%7$I + excluded.%7$I,
+            %8$I = c.%8$I + excluded.%8$I,
+            %9$I = c.%9$I + excluded.%9$I,
+            updated_at = now()',
+        counters_changes_query(TG_OP, format('user_id, %I AS piva, %I AS numero, %I AS data, %I AS amount, %I AS paid',
+                                             prefix || 'partita_iva_prestatore', prefix || 'numero_fattura',
+                                             prefix || 'data_documento', prefix || 'importo_pagamento_rata',
+                                             prefix || 'data_pagamento_rata')),
+        TG_TABLE_NAME,
+        prefix || 'partita_iva_prestatore',
+        prefix || 'numero_fattura',
+        prefix || 'data_documento',
+        TG_TABLE_NAME || '_count',
+        TG_TABLE_NAME || '_unpaid_count',
+        TG_TABLE_NAME || '_unpaid_total',
+        invoices_table || '_with_terms_count'
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- A trigger with transition tables can have only one event, so three triggers per table.
+CREATE TRIGGER count_invoices_insert AFTER INSERT ON public.fatture_emesse
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoices('fe_');
+CREATE TRIGGER count_invoices_update AFTER UPDATE ON public.fatture_emesse
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoices('fe_');
+CREATE TRIGGER count_invoices_delete AFTER DELETE ON public.fatture_emesse
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoices('fe_');
+
+CREATE TRIGGER count_invoices_insert AFTER INSERT ON public.fatture_ricevute
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoices('fr_');
+CREATE TRIGGER count_invoices_update AFTER UPDATE ON public.fatture_ricevute
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoices('fr_');
+CREATE TRIGGER count_invoices_delete AFTER DELETE ON public.fatture_ricevute
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoices('fr_');
+
+CREATE TRIGGER count_invoice_terms_insert AFTER INSERT ON public.rate_fatture_emesse
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoice_terms('rfe_');
+CREATE TRIGGER count_invoice_terms_update AFTER UPDATE ON public.rate_fatture_emesse
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoice_terms('rfe_');
+CREATE TRIGGER count_invoice_terms_delete AFTER DELETE ON public.rate_fatture_emesse
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoice_terms('rfe_');
+
+CREATE TRIGGER count_invoice_terms_insert AFTER INSERT ON public.rate_fatture_ricevute
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoice_terms('rfr_');
+CREATE TRIGGER count_invoice_terms_update AFTER UPDATE ON public.rate_fatture_ricevute
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoice_terms('rfr_');
+CREATE TRIGGER count_invoice_terms_delete AFTER DELETE ON public.rate_fatture_ricevute
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION count_invoice_terms('rfr_');
+
+-- Recomputes all the counters from the tables, for the first deploy of user_counters
+-- or if the counters are ever suspected to be wrong:
+-- SELECT refresh_user_counters();
+CREATE OR REPLACE FUNCTION refresh_user_counters() RETURNS VOID AS $$
+BEGIN
+    DELETE FROM public.user_counters;
+
+    INSERT INTO public.user_counters (user_id)
+    SELECT user_id FROM public.fatture_emesse
+    UNION SELECT user_id FROM public.fatture_ricevute;
+
+    UPDATE public.user_counters c SET
+        fatture_emesse_count = s.n, fatture_emesse_total = s.total
+    FROM (SELECT user_id, count(*) AS n, coalesce(sum(fe_importo_totale_documento), 0) AS total
+          FROM public.fatture_emesse GROUP BY user_id) s
+    WHERE c.user_id = s.user_id;
+
+    UPDATE public.user_counters c SET
+        fatture_ricevute_count = s.n, fatture_ricevute_total = s.total
+    FROM (SELECT user_id, count(*) AS n, coalesce(sum(fr_importo_totale_documento), 0) AS total
+          FROM public.fatture_ricevute GROUP BY user_id) s
+    WHERE c.user_id = s.user_id;
+
+    UPDATE public.user_counters c SET
+        rate_fatture_emesse_count = s.n,
+        rate_fatture_emesse_unpaid_count = s.unpaid,
+        rate_fatture_emesse_unpaid_total = s.unpaid_total,
+        fatture_emesse_with_terms_count = s.invoices
+    FROM (SELECT user_id, count(*) AS n,
+                 count(*) FILTER (WHERE rfe_data_pagamento_rata IS NULL) AS unpaid,
+                 coalesce(sum(rfe_importo_pagamento_rata) FILTER (WHERE rfe_data_pagamento_rata IS NULL), 0) AS unpaid_total,
+                 count(DISTINCT (rfe_partita_iva_prestatore, rfe_numero_fattura, rfe_data_documento)) AS invoices
+          FROM public.rate_fatture_emesse GROUP BY user_id) s
+    WHERE c.user_id = s.user_id;
+
+    UPDATE public.user_counters c SET
+        rate_fatture_ricevute_count = s.n,
+        rate_fatture_ricevute_unpaid_count = s.unpaid,
+        rate_fatture_ricevute_unpaid_total = s.unpaid_total,
+        fatture_ricevute_with_terms_count = s.invoices
+    FROM (SELECT user_id, count(*) AS n,
+                 count(*) FILTER (WHERE rfr_data_pagamento_rata IS NULL) AS unpaid,
+                 coalesce(sum(rfr_importo_pagamento_rata) FILTER (WHERE rfr_data_pagamento_rata IS NULL), 0) AS unpaid_total,
+                 count(DISTINCT (rfr_partita_iva_prestatore, rfr_numero_fattura, rfr_data_documento)) AS invoices
+          FROM public.rate_fatture_ricevute GROUP BY user_id) s
+    WHERE c.user_id = s.user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT refresh_user_counters();
+
+
+
 -- Function to manage the insertion of both invoices and
 -- terms in a single transactions, since Postgres functions
 -- are wrapped in a single transaction by default.
@@ -596,6 +812,10 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql SECURITY INVOKER;
 
+-- Set based: the record and the terms are cleaned with jsonb operators instead of
+-- looping over jsonb_each, and all the terms are inserted with ONE statement
+-- with jsonb_populate_recordset, instead of calling insert_record once per term.
+-- So the dynamic SQL is built and planned twice per call, regardless of the number of terms.
 CREATE OR REPLACE FUNCTION insert_record(
     table_name TEXT,
     record_data JSONB,
@@ -605,14 +825,17 @@ CREATE OR REPLACE FUNCTION insert_record(
 ) RETURNS JSONB AS $$
 DECLARE
     sql_query TEXT;
+    terms_query TEXT;
     record_id UUID;
+    inserted_record JSONB;
+    inserted_terms JSONB := '[]'::JSONB;
     current_user_id UUID;
-    cleaned_data JSONB := '{}'::JSONB;
-    key TEXT;
-    value JSONB;
+    cleaned_data JSONB;
+    cleaned_terms JSONB;
+    excluded_keys TEXT[] := ARRAY['id', 'created_at', 'updated_at', 'user_id'];
+    excluded_term_keys TEXT[] := ARRAY['id', 'created_at', 'updated_at', 'user_id'];
     insertable_columns TEXT;
-    term JSONB;
-    term_result JSONB;
+    terms_columns TEXT;
 BEGIN
     -- This is for testing the function without an authenticated user.
     IF test_user_id IS NULL THEN
@@ -630,55 +853,62 @@ BEGIN
                );
     END IF;
 
-    -- Clean data: remove auto-generated fields
-    FOR key, value IN SELECT * FROM jsonb_each(record_data)
-        LOOP
-            IF key NOT IN ('id', 'created_at', 'updated_at', 'user_id') AND value != 'null'::JSONB THEN
-                cleaned_data := cleaned_data || jsonb_build_object(key, value);
-            END IF;
-        END LOOP;
-
-    cleaned_data := cleaned_data || jsonb_build_object('user_id', current_user_id);
+    -- Clean data: remove nulls and auto-generated fields
+    cleaned_data := (jsonb_strip_nulls(record_data) - excluded_keys)
+                        || jsonb_build_object('user_id', current_user_id);
 
     -- Get only the columns we're actually providing data for
     -- using j.key because, if not,  'column reference "key" is ambiguous',
     SELECT string_agg(quote_ident(j.key), ', ' ORDER BY j.key) INTO insertable_columns
     FROM jsonb_each_text(cleaned_data) j;
 
-    -- Build INSERT that only specifies the columns we have data for
+    -- Build INSERT that only specifies the columns we have data for.
+    -- The inserted row is returned, so the client can add it to its cache without refetching.
     sql_query := format('
-            INSERT INTO %I (%s)
+            INSERT INTO %I AS r (%s)
             SELECT %s FROM jsonb_populate_record(NULL::%I, $1)
-            RETURNING id',
+            RETURNING r.id, to_jsonb(r)',
                         table_name,
                         insertable_columns,
                         insertable_columns,
                         table_name
                  );
 
-    EXECUTE sql_query USING cleaned_data INTO record_id;
+    EXECUTE sql_query USING cleaned_data INTO record_id, inserted_record;
 
     -- Handle terms.
     IF terms_table_name IS NOT NULL AND terms_data IS NOT NULL AND array_length(terms_data, 1) > 0 THEN
-        FOR i IN 1..array_length(terms_data, 1) LOOP
-                term := terms_data[i];
-
-                -- Business logic: if it is a received invoice, I remove the cassa name and iban info from
-                -- the term since I will fill that field with MY OWN cassa and iban.
-                if table_name = 'fatture_ricevute' THEN
-                    term := (term - 'user_id' - 'id' - 'created_at' - 'updated_at' - 'rfr_iban_cassa' - 'rfr_nome_cassa') ||
-                            jsonb_build_object('user_id', current_user_id);
-                else
-                    term := (term - 'user_id' - 'id' - 'created_at' - 'updated_at') ||
-                            jsonb_build_object('user_id', current_user_id);
-                end if;
-
---                PERFORM insert_record(terms_table_name, term, NULL, NULL, test_user_id);
-                term_result := insert_record(terms_table_name, term, NULL, NULL, test_user_id);
-                IF term_result->>'success' = 'false' THEN
-                    RAISE EXCEPTION 'Error inserting term: %', term_result;
-                END IF;
-            END LOOP;
+
+        -- Business logic: if it is a received invoice, I remove the cassa name and iban info from
+        -- the term since I will fill that field with MY OWN cassa and iban.
+        IF table_name = 'fatture_ricevute' THEN
+            excluded_term_keys := excluded_term_keys || ARRAY['rfr_iban_cassa', 'rfr_nome_cassa'];
+        END IF;
+
+        SELECT jsonb_agg((jsonb_strip_nulls(t.term) - excluded_term_keys)
+                             || jsonb_build_object('user_id', current_user_id))
+        INTO cleaned_terms
+        FROM unnest(terms_data) AS t(term);
+
+        -- Union of the keys of all the terms, the missing ones will be NULL.
+        SELECT string_agg(quote_ident(k.key), ', ' ORDER BY k.key) INTO terms_columns
+        FROM (SELECT DISTINCT jsonb_object_keys(t.term) AS key
+              FROM jsonb_array_elements(cleaned_terms) AS t(term)) k;
+
+        terms_query := format('
+            WITH inserted AS (
+                INSERT INTO %I (%s)
+                SELECT %s FROM jsonb_populate_recordset(NULL::%I, $1)
+                RETURNING *
+            )
+            SELECT coalesce(jsonb_agg(to_jsonb(inserted)), ''[]''::JSONB) FROM inserted',
+                              terms_table_name,
+                              terms_columns,
+                              terms_columns,
+                              terms_table_name
+                       );
+
+        EXECUTE terms_query USING cleaned_terms INTO inserted_terms;
     END IF;
 
     RETURN jsonb_build_object(
@@ -687,6 +917,8 @@ BEGIN
         -- 'error', SQLERRM,
         -- 'error_detail', SQLSTATE,
             'table_name', table_name,
+            'record', inserted_record,
+            'terms', inserted_terms,
             'original_record_data', record_data,
             'current_user_id', current_user_id,
             'test_user_id', test_user_id,
@@ -708,6 +940,247 @@ EXCEPTION WHEN OTHERS THEN
 END;
 $$ LANGUAGE plpgsql SECURITY INVOKER;
 
+-- Duplicate pre-check for the xml upload: all the invoice keys of a batch in one call,
+-- so that the invoices already present are not sent to the insert at all.
+--
+-- emesse_keys and ricevute_keys are JSON arrays of [partita_iva_prestatore, numero_fattura, data_documento],
+-- same columns and order of the unique constraints, so the lookups use their indexes.
+-- Returns the 0 based positions of the keys already present:
+-- {"fatture_emesse": [...], "fatture_ricevute": [...]}
+CREATE OR REPLACE FUNCTION find_existing_invoices(
+    emesse_keys JSONB,
+    ricevute_keys JSONB,
+    test_user_id TEXT DEFAULT NULL
+) RETURNS JSONB AS $$
+DECLARE
+    current_user_id UUID;
+BEGIN
+    -- This is for testing the function without an authenticated user.
+    IF test_user_id IS NULL THEN
+        current_user_id := auth.uid();
+    ELSE
+        current_user_id := test_user_id::UUID;
+    END IF;
+
+    RETURN jsonb_build_object(
+        'fatture_emesse', (
+            SELECT coalesce(jsonb_agg(k.ord - 1 ORDER BY k.ord), '[]'::JSONB)
+            FROM jsonb_array_elements(coalesce(emesse_keys, '[]'::JSONB)) WITH ORDINALITY AS k(invoice_key, ord)
+            WHERE EXISTS (
+                SELECT 1 FROM fatture_emesse f
+                WHERE f.user_id = current_user_id
+                  AND f.fe_partita_iva_prestatore = k.invoice_key->>0
+                  AND f.fe_numero_fattura = k.invoice_key->>1
+                  AND f.fe_data_documento = (k.invoice_key->>2)::DATE)
+        ),
+        'fatture_ricevute', (
+            SELECT coalesce(jsonb_agg(k.ord - 1 ORDER BY k.ord), '[]'::JSONB)
+            FROM jsonb_array_elements(coalesce(ricevute_keys, '[]'::JSONB)) WITH ORDINALITY AS k(invoice_key, ord)
+            WHERE EXISTS (
+                SELECT 1 FROM fatture_ricevute f
+                WHERE f.user_id = current_user_id
+                  AND f.fr_partita_iva_prestatore = k.invoice_key->>0
+                  AND f.fr_numero_fattura = k.invoice_key->>1
+                  AND f.fr_data_documento = (k.invoice_key->>2)::DATE)
+        )
+    );
+END;
+$$ LANGUAGE plpgsql STABLE SECURITY INVOKER;
+
+-- Bulk version of insert_record for the xml upload, one round trip for the whole batch.
+--
+-- records is a JSON array of {"record": {...}, "terms": [{...}, ...]}, same record_data
+-- and terms_data of insert_record.
+-- Returns one result for each element of records, in the same order:
+-- {"position": 0 based index in records, "status": "inserted" | "duplicate" | "error", "error": ...}
+--
+-- First I try to insert all the invoices and all the terms set based, with two statements
+-- in the same query. Duplicates, also inside the batch, are skipped with ON CONFLICT DO NOTHING.
+-- If that fails, for example for a NOT NULL column missing in one invoice, I fall back
+-- to insert_record one invoice at a time, so that one bad invoice does not abort the batch.
+--
+-- Only for fatture_emesse and fatture_ricevute, since I need the invoice key columns
+-- to match the terms with the inserted invoices.
+CREATE OR REPLACE FUNCTION insert_records_batch(
+    table_name TEXT,
+    terms_table_name TEXT,
+    records JSONB,
+    test_user_id TEXT DEFAULT NULL
+) RETURNS JSONB AS $$
+DECLARE
+    current_user_id UUID;
+    prefix TEXT;
+    excluded_keys TEXT[] := ARRAY['id', 'created_at', 'updated_at', 'user_id'];
+    excluded_term_keys TEXT[] := ARRAY['id', 'created_at', 'updated_at', 'user_id'];
+    input JSONB;
+    record_columns TEXT;
+    term_columns TEXT;
+    terms_query TEXT := '';
+    sql_query TEXT;
+    inserted_positions INTEGER[];
+    set_based_error TEXT;
+    item JSONB;
+    item_position INTEGER;
+    item_result JSONB;
+    results JSONB := '[]'::JSONB;
+BEGIN
+    -- This is for testing the function without an authenticated user.
+    IF test_user_id IS NULL THEN
+        current_user_id := auth.uid();
+    ELSE
+        current_user_id := test_user_id::UUID;
+    END IF;
+
+    IF current_user_id IS NULL THEN
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', 'User not authenticated - auth.uid() returned NULL'
+               );
+    END IF;
+
+    IF table_name = 'fatture_emesse' THEN
+        prefix := 'fe_';
+    ELSIF table_name = 'fatture_ricevute' THEN
+        prefix := 'fr_';
+        -- Same business logic of insert_record: the cassa of a received invoice
+        -- will be MY OWN cassa, so I don't keep the one in the xml.
+        excluded_term_keys := excluded_term_keys || ARRAY['rfr_iban_cassa', 'rfr_nome_cassa'];
+    ELSE
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', format('insert_records_batch does not support table %s', table_name)
+               );
+    END IF;
+
+    IF records IS NULL OR jsonb_array_length(records) = 0 THEN
+        RETURN jsonb_build_object('success', true, 'table_name', table_name, 'results', '[]'::JSONB);
+    END IF;
+
+    -- Same cleaning of insert_record: no nulls and no auto-generated fields.
+    SELECT jsonb_agg(jsonb_build_object(
+               'position', t.ord - 1,
+               'record', (jsonb_strip_nulls(t.element->'record') - excluded_keys)
+                             || jsonb_build_object('user_id', current_user_id),
+               'terms', (SELECT coalesce(jsonb_agg((jsonb_strip_nulls(term) - excluded_term_keys)
+                                                   || jsonb_build_object('user_id', current_user_id)), '[]'::JSONB)
+                         FROM jsonb_array_elements(coalesce(t.element->'terms', '[]'::JSONB)) term)
+           ) ORDER BY t.ord)
+    INTO input
+    FROM jsonb_array_elements(records) WITH ORDINALITY AS t(element, ord);
+
+    SELECT string_agg(quote_ident(k), ', ' ORDER BY k) INTO record_columns
+    FROM (SELECT DISTINCT jsonb_object_keys(i->'record') AS k FROM jsonb_array_elements(input) i) keys;
+
+    SELECT string_agg(quote_ident(k), ', ' ORDER BY k) INTO term_columns
+    FROM (SELECT DISTINCT jsonb_object_keys(term) AS k
+          FROM jsonb_array_elements(input) i, jsonb_array_elements(i->'terms') term) keys;
+
+    -- With no terms at all there is nothing to insert in the terms table.
+    IF term_columns IS NOT NULL THEN
+        terms_query := format(',
+            inserted_terms AS (
+                INSERT INTO %1$I (%2$s)
+                SELECT %2$s FROM inserted_input, jsonb_array_elements(inserted_input.terms) term,
+                                 jsonb_populate_record(NULL::%1$I, term)
+            )',
+            terms_table_name,
+            term_columns
+        );
+    END IF;
+
+    BEGIN
+        -- The invoice key is the same of the unique constraint, RETURNING gives it back
+        -- only for the invoices actually inserted.
+        sql_query := format('
+            WITH input AS (
+                SELECT (i->>''position'')::INTEGER AS position,
+                       jsonb_build_array(i->''record''->>%3$L, i->''record''->>%4$L, (i->''record''->>%5$L)::DATE) AS key,
+                       i->''record'' AS record, i->''terms'' AS terms
+                FROM jsonb_array_elements($1) i
+            ),
+            -- Only the first copy of an invoice inside the batch is inserted, the others are duplicates.
+            first_copies AS (
+                SELECT DISTINCT ON (key) * FROM input ORDER BY key, position
+            ),
+            inserted AS (
+                INSERT INTO %1$I (%2$s)
+                SELECT %2$s FROM first_copies, jsonb_populate_record(NULL::%1$I, first_copies.record)
+                ON CONFLICT DO NOTHING
+                RETURNING jsonb_build_array(%3$I, %4$I, %5$I) AS key
+            ),
+            inserted_input AS (
+                SELECT first_copies.position, first_copies.terms
+                FROM first_copies JOIN inserted ON first_copies.key = inserted.key
+            )%6$s
+            SELECT array_agg(position) FROM inserted_input',
+            table_name,
+            record_columns,
+            prefix || 'partita_iva_prestatore',
+            prefix || 'numero_fattura',
+            prefix || 'data_documento',
+            terms_query
+        );
+
+        EXECUTE sql_query USING input INTO inserted_positions;
+
+        SELECT jsonb_agg(jsonb_build_object(
+                   'position', (i->>'position')::INTEGER,
+                   'status', CASE WHEN (i->>'position')::INTEGER = ANY(coalesce(inserted_positions, ARRAY[]::INTEGER[]))
+                                  THEN 'inserted' ELSE 'duplicate' END,
+                   'error', NULL
+               ) ORDER BY (i->>'position')::INTEGER)
+        INTO results
+        FROM jsonb_array_elements(input) i;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'mode', 'set_based',
+                'results', results
+               );
+
+    EXCEPTION WHEN OTHERS THEN
+        -- Nothing of the set based insert is saved here, I retry one invoice at a time.
+        set_based_error := SQLERRM;
+    END;
+
+    FOR item, item_position IN SELECT t.element, t.ord - 1 FROM jsonb_array_elements(records) WITH ORDINALITY AS t(element, ord)
+        LOOP
+            item_result := insert_record(table_name, item->'record', terms_table_name,
+                                         ARRAY(SELECT jsonb_array_elements(coalesce(item->'terms', '[]'::JSONB))),
+                                         current_user_id::TEXT);
+
+            results := results || jsonb_build_array(jsonb_build_object(
+                    'position', item_position,
+                    'status', CASE
+                                  WHEN item_result->>'success' = 'true' THEN 'inserted'
+                                  -- unique_violation
+                                  WHEN item_result->>'error_detail' = '23505' THEN 'duplicate'
+                                  ELSE 'error'
+                              END,
+                    'error', CASE WHEN item_result->>'success' = 'true' THEN NULL ELSE item_result->>'error' END
+                ));
+        END LOOP;
+
+    RETURN jsonb_build_object(
+            'success', true,
+            'table_name', table_name,
+            'mode', 'per_record',
+            'set_based_error', set_based_error,
+            'results', results
+           );
+
+EXCEPTION WHEN OTHERS THEN
+
+    RETURN jsonb_build_object(
+            'success', false,
+            'error', SQLERRM,
+            'error_detail', SQLSTATE,
+            'table_name', table_name
+           );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
 -- Use for testing, while impersonating.
 -- SELECT upsert_terms(
 --                'rate_movimenti_attivi',
@@ -717,18 +1190,16 @@ $$ LANGUAGE plpgsql SECURITY INVOKER;
 --                '{"user_id": "test-user", "rma_numero": "2024-001", "rma_data": "2024-01-15", "rma_data_scadenza": "2024-03-15", "rma_importo_pagamento": 850.75, "rma_nome_cassa": "Cassa Contanti", "rma_notes": "Seconda rata pagamento", "rma_data_pagamento": "2024-03-10"}'::JSONB
 -- ]
 --        );
+-- Set based, same as insert_record: one DELETE and one INSERT with jsonb_populate_recordset,
+-- instead of one INSERT per term.
 CREATE OR REPLACE FUNCTION upsert_terms(
        table_name TEXT,
        delete_key JSONB,
        terms JSONB[]
 ) RETURNS JSONB AS $$
 DECLARE
-user_id UUID;
-key TEXT;
-        term JSONB;
-        field JSONB;
-        cleaned_data JSONB[] := ARRAY[]::JSONB[];  -- This creates an empty array;
-        cleaned_term JSONB;
+        user_id UUID;
+        cleaned_data JSONB;
         delete_where_clause TEXT;
         delete_query TEXT;
         insertable_columns TEXT;
@@ -736,60 +1207,49 @@ key TEXT;
 BEGIN
         user_id := auth.uid();
 
-
         -- Remove nulls and auto-generated fields if present.
-        FOREACH term IN ARRAY terms LOOP
-            cleaned_term := '{}'::JSONB;
-FOR key, field IN SELECT * FROM jsonb_each(term)
-                                    LOOP
-    IF key NOT IN ('id', 'created_at', 'updated_at', 'user_id') AND field != 'null'::JSONB THEN
-                        cleaned_term := cleaned_term || jsonb_build_object(key, field);
-END IF;
-END LOOP;
-            cleaned_term := cleaned_term || jsonb_build_object('user_id', user_id);
-            cleaned_data := array_append(cleaned_data, cleaned_term);
-END LOOP;
+        SELECT jsonb_agg((jsonb_strip_nulls(t.term) - ARRAY['id', 'created_at', 'updated_at', 'user_id'])
+                             || jsonb_build_object('user_id', user_id))
+        INTO cleaned_data
+        FROM unnest(terms) AS t(term);
 
         -- Test with:
         -- SELECT string_agg(dk.key || ' = ' || dk.value, ' AND ')
         -- FROM jsonb_each_text('{"rma_numero": "2024-001", "rma_data": "2024-01-15"}') dk;
         delete_key := delete_key || jsonb_build_object('user_id', user_id);
-SELECT string_agg(dk.key || ' = ' || quote_literal(dk.value), ' AND ') INTO delete_where_clause
-FROM jsonb_each_text(delete_key) dk;
+        SELECT string_agg(quote_ident(dk.key) || ' = ' || quote_literal(dk.value), ' AND ') INTO delete_where_clause
+        FROM jsonb_each_text(delete_key) dk;
 
-delete_query := format('
+        delete_query := format('
             DELETE FROM %I
             WHERE %s',
             table_name,
             delete_where_clause
         );
-EXECUTE delete_query;
+        EXECUTE delete_query;
 
-SELECT string_agg(quote_ident(col.key), ', ' ORDER BY col.key) INTO insertable_columns
-FROM jsonb_each_text(cleaned_data[1]) col;
+        IF cleaned_data IS NOT NULL THEN
+            -- Union of the keys of all the terms, the missing ones will be NULL.
+            SELECT string_agg(quote_ident(k.key), ', ' ORDER BY k.key) INTO insertable_columns
+            FROM (SELECT DISTINCT jsonb_object_keys(t.term) AS key
+                  FROM jsonb_array_elements(cleaned_data) AS t(term)) k;
 
-insert_query := format('
-            INSERT INTO %I (%s)
-            SELECT %s FROM jsonb_populate_record(NULL::%I, $1)',
-            table_name,
-            insertable_columns,
-            insertable_columns,
-            table_name);
-
-        IF terms IS NOT NULL AND array_length(cleaned_data, 1) > 0 THEN
-        FOR i IN 1..array_length(cleaned_data, 1) LOOP
-            term := cleaned_data[i];
-EXECUTE insert_query USING term;
-END LOOP;
-END IF;
+            insert_query := format('
+                INSERT INTO %I (%s)
+                SELECT %s FROM jsonb_populate_recordset(NULL::%I, $1)',
+                table_name,
+                insertable_columns,
+                insertable_columns,
+                table_name);
 
-        -- RAISE EXCEPTION 'insert_query: %', insert_query;
+            EXECUTE insert_query USING cleaned_data;
+        END IF;
 
-RETURN jsonb_build_object(
-        'success', true,
-        'table_name', table_name,
-        'original_record_data', terms
-       );
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'original_record_data', terms
+               );
 
 EXCEPTION WHEN OTHERS THEN
 
@@ -805,6 +1265,780 @@ EXCEPTION WHEN OTHERS THEN
 END
 $$ LANGUAGE plpgsql SECURITY INVOKER;
 
+-- Same as upsert_terms, but for many documents in a single call and a single transaction,
+-- used for re-splitting the terms of many documents at once.
+-- If the terms of one document fail, nothing is saved.
+--
+-- documents is a JSON array of {"delete_key": {...}, "terms": [{...}, ...]}
+-- where delete_key and terms are the same as the upsert_terms arguments.
+CREATE OR REPLACE FUNCTION upsert_terms_batch(
+       table_name TEXT,
+       documents JSONB
+) RETURNS JSONB AS $$
+DECLARE
+        document JSONB;
+        document_terms JSONB[];
+        document_result JSONB;
+        documents_count INTEGER := 0;
+BEGIN
+        FOR document IN SELECT * FROM jsonb_array_elements(documents) LOOP
+            SELECT array_agg(t) INTO document_terms
+            FROM jsonb_array_elements(document->'terms') t;
+
+            document_result := upsert_terms(table_name, document->'delete_key', document_terms);
+            IF document_result->>'success' = 'false' THEN
+                RAISE EXCEPTION 'Error upserting terms for %: %', document->'delete_key', document_result->>'error';
+            END IF;
+
+            documents_count := documents_count + 1;
+        END LOOP;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'documents_count', documents_count
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE,
+                'table_name', table_name
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
+
+-- Applies only the changes of the terms editor, instead of deleting and reinserting
+-- all the terms of the document like upsert_terms, so that marking one installment as paid
+-- updates exactly one row, and the ids of the other terms stay the same.
+--
+-- document_key: same as the delete_key of upsert_terms. All the changes are restricted
+--               to the terms of this document.
+-- inserted:     JSON array of new terms, same as the terms of upsert_terms.
+-- updated:      JSON array of {"id": ..., <only the changed fields>}. Fields not present
+--               keep their value, fields present with null are set to NULL.
+--               With "updated_at", the term is updated only if it was not modified after
+--               it was loaded (optimistic concurrency), updated_at itself is never written.
+-- deleted:      JSON array of ids.
+--
+-- Everything is done in one transaction: if a term to update or delete is not found
+-- in the document, for example because it was deleted in another tab, nothing is saved.
+CREATE OR REPLACE FUNCTION apply_terms_delta(
+       table_name TEXT,
+       document_key JSONB,
+       inserted JSONB DEFAULT '[]'::JSONB,
+       updated JSONB DEFAULT '[]'::JSONB,
+       deleted JSONB DEFAULT '[]'::JSONB
+) RETURNS JSONB AS $$
+DECLARE
+        user_id UUID;
+        excluded_keys TEXT[] := ARRAY['id', 'created_at', 'updated_at', 'user_id'];
+        key_clause TEXT;
+        cleaned_inserted JSONB;
+        insertable_columns TEXT;
+        updatable_columns TEXT[];
+        inserted_count INTEGER := 0;
+        updated_count INTEGER := 0;
+        deleted_count INTEGER := 0;
+        updated_rows JSONB := '[]'::JSONB;
+        inserted_rows JSONB := '[]'::JSONB;
+BEGIN
+        user_id := auth.uid();
+        inserted := coalesce(inserted, '[]'::JSONB);
+        updated := coalesce(updated, '[]'::JSONB);
+        deleted := coalesce(deleted, '[]'::JSONB);
+
+        document_key := document_key || jsonb_build_object('user_id', user_id);
+        SELECT string_agg(format('t.%I = %L', dk.key, dk.value), ' AND ') INTO key_clause
+        FROM jsonb_each_text(document_key) dk;
+
+        IF jsonb_array_length(deleted) > 0 THEN
+            EXECUTE format('
+                DELETE FROM %I t
+                WHERE %s AND t.id IN (SELECT d::UUID FROM jsonb_array_elements_text($1) d)',
+                table_name,
+                key_clause
+            ) USING deleted;
+            GET DIAGNOSTICS deleted_count = ROW_COUNT;
+
+            IF deleted_count <> jsonb_array_length(deleted) THEN
+                RAISE EXCEPTION 'Expected to delete % terms, found %', jsonb_array_length(deleted), deleted_count;
+            END IF;
+        END IF;
+
+        IF jsonb_array_length(updated) > 0 THEN
+            -- Union of the changed fields. The document key can not be changed from here.
+            SELECT array_agg(DISTINCT k) INTO updatable_columns
+            FROM jsonb_array_elements(updated) u, jsonb_object_keys(u) k
+            WHERE k <> ALL (excluded_keys) AND NOT document_key ? k;
+
+            IF updatable_columns IS NOT NULL THEN
+                -- jsonb_populate_record(t, patch) keeps the current value of the fields
+                -- that are not in the patch, so every row gets only its own changes.
+                EXECUTE format('
+                    WITH changed AS (
+                        UPDATE %1$I t
+                        SET (%2$s) = (SELECT %3$s FROM jsonb_populate_record(t, u.patch) p)
+                        FROM jsonb_array_elements($1) u(patch)
+                        WHERE %4$s AND t.id = (u.patch->>''id'')::UUID
+                          AND (u.patch->>''updated_at'' IS NULL OR t.updated_at = (u.patch->>''updated_at'')::TIMESTAMPTZ)
+                        RETURNING t.*
+                    )
+                    SELECT count(*), coalesce(jsonb_agg(to_jsonb(changed)), ''[]''::JSONB) FROM changed',
+                    table_name,
+                    (SELECT string_agg(quote_ident(c), ', ') FROM unnest(updatable_columns) c),
+                    (SELECT string_agg('p.' || quote_ident(c), ', ') FROM unnest(updatable_columns) c),
+                    key_clause
+                ) INTO updated_count, updated_rows USING updated;
+
+                IF updated_count <> jsonb_array_length(updated) THEN
+                    RAISE EXCEPTION 'Expected to update % terms, found %: terms deleted or modified in the meantime',
+                        jsonb_array_length(updated), updated_count;
+                END IF;
+            END IF;
+        END IF;
+
+        IF jsonb_array_length(inserted) > 0 THEN
+            -- Same cleaning of upsert_terms, plus the document key.
+            SELECT jsonb_agg((jsonb_strip_nulls(term) - excluded_keys) || document_key)
+            INTO cleaned_inserted
+            FROM jsonb_array_elements(inserted) term;
+
+            SELECT string_agg(quote_ident(k.key), ', ' ORDER BY k.key) INTO insertable_columns
+            FROM (SELECT DISTINCT jsonb_object_keys(t.term) AS key
+                  FROM jsonb_array_elements(cleaned_inserted) AS t(term)) k;
+
+            EXECUTE format('
+                WITH changed AS (
+                    INSERT INTO %1$I (%2$s)
+                    SELECT %2$s FROM jsonb_populate_recordset(NULL::%1$I, $1)
+                    RETURNING *
+                )
+                SELECT count(*), coalesce(jsonb_agg(to_jsonb(changed)), ''[]''::JSONB) FROM changed',
+                table_name,
+                insertable_columns
+            ) INTO inserted_count, inserted_rows USING cleaned_inserted;
+        END IF;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'inserted', inserted_count,
+                'updated', updated_count,
+                'deleted', deleted_count,
+                -- The rows after the change and the deleted ids, for the client cache.
+                'rows', inserted_rows || updated_rows,
+                'deleted_ids', deleted
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE,
+                'table_name', table_name
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
+
+-- Applies the pending changes of the terms of many documents, collected by the write-behind
+-- buffer of the terms editors (terms_buffer.py), with one call.
+--
+-- deltas: JSON array of {"table_name", "document_key", "inserted", "updated", "deleted"},
+--         the apply_terms_delta arguments of every document.
+--
+-- Everything is done in one transaction: if the changes of one document fail, the changes
+-- of the other documents are rolled back too, and 'document' is the position in deltas
+-- of the one that failed.
+CREATE OR REPLACE FUNCTION apply_terms_deltas(
+       deltas JSONB
+) RETURNS JSONB AS $$
+DECLARE
+        delta JSONB;
+        delta_result JSONB;
+        document_index INTEGER := 0;
+        inserted_count INTEGER := 0;
+        updated_count INTEGER := 0;
+        deleted_count INTEGER := 0;
+        results JSONB := '[]'::JSONB;
+BEGIN
+        FOR delta IN SELECT value FROM jsonb_array_elements(coalesce(deltas, '[]'::JSONB)) LOOP
+            delta_result := apply_terms_delta(delta->>'table_name', delta->'document_key',
+                                              delta->'inserted', delta->'updated', delta->'deleted');
+
+            -- apply_terms_delta returns its errors instead of raising them, I raise them here
+            -- so the changes of the documents already applied are rolled back.
+            IF NOT (delta_result->>'success')::BOOLEAN THEN
+                RAISE EXCEPTION '%', delta_result->>'error';
+            END IF;
+
+            inserted_count := inserted_count + (delta_result->>'inserted')::INTEGER;
+            updated_count := updated_count + (delta_result->>'updated')::INTEGER;
+            deleted_count := deleted_count + (delta_result->>'deleted')::INTEGER;
+            results := results || jsonb_build_array(delta_result);
+            document_index := document_index + 1;
+        END LOOP;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'documents', document_index,
+                'inserted', inserted_count,
+                'updated', updated_count,
+                'deleted', deleted_count,
+                'results', results
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE,
+                'document', document_index
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
+
+-- Saves a modified document and the changes of its terms in one transaction, for the
+-- modify dialogs, so the total of the document and its terms are never saved half way.
+--
+-- table_name:          fatture_emesse, fatture_ricevute, movimenti_attivi or movimenti_passivi.
+-- document_data:       the fields to update. If the document key changes, the terms follow
+--                      by the ON UPDATE CASCADE of the rate tables.
+-- expected_updated_at: the updated_at of the document when it was read, the update fails
+--                      if it was modified in the meantime. NULL to skip the check.
+-- inserted, updated, deleted: the terms changes, same as apply_terms_delta, applied to the
+--                      terms of the document AFTER the update, so with the new key.
+--
+-- Returns the fresh rows: 'document', 'terms' (all the terms of the document) and 'deleted_ids'.
+CREATE OR REPLACE FUNCTION save_document_with_terms(
+       table_name TEXT,
+       document_id UUID,
+       document_data JSONB,
+       expected_updated_at TIMESTAMPTZ DEFAULT NULL,
+       inserted JSONB DEFAULT '[]'::JSONB,
+       updated JSONB DEFAULT '[]'::JSONB,
+       deleted JSONB DEFAULT '[]'::JSONB
+) RETURNS JSONB AS $$
+DECLARE
+        current_user_id UUID;
+        excluded_keys TEXT[] := ARRAY['id', 'created_at', 'updated_at', 'user_id'];
+        key_columns TEXT[];
+        term_key_columns TEXT[];
+        updatable_columns TEXT[];
+        document_row JSONB;
+        document_key JSONB;
+        key_clause TEXT;
+        delta_result JSONB;
+        terms_rows JSONB;
+        matching_count INTEGER;
+BEGIN
+        current_user_id := auth.uid();
+        updated := coalesce(updated, '[]'::JSONB);
+
+        CASE table_name
+            WHEN 'fatture_emesse' THEN
+                key_columns := ARRAY['fe_partita_iva_prestatore', 'fe_numero_fattura', 'fe_data_documento'];
+                term_key_columns := ARRAY['rfe_partita_iva_prestatore', 'rfe_numero_fattura', 'rfe_data_documento'];
+            WHEN 'fatture_ricevute' THEN
+                key_columns := ARRAY['fr_partita_iva_prestatore', 'fr_numero_fattura', 'fr_data_documento'];
+                term_key_columns := ARRAY['rfr_partita_iva_prestatore', 'rfr_numero_fattura', 'rfr_data_documento'];
+            WHEN 'movimenti_attivi' THEN
+                key_columns := ARRAY['ma_numero', 'ma_data'];
+                term_key_columns := ARRAY['rma_numero', 'rma_data'];
+            WHEN 'movimenti_passivi' THEN
+                key_columns := ARRAY['mp_numero', 'mp_data'];
+                term_key_columns := ARRAY['rmp_numero', 'rmp_data'];
+            ELSE
+                RAISE EXCEPTION 'save_document_with_terms does not support table %', table_name;
+        END CASE;
+
+        -- The versions of the terms are checked, and the terms locked, before the document update:
+        -- a change of the document key rewrites the updated_at of all its terms, by the cascade.
+        IF jsonb_array_length(updated) > 0 THEN
+            EXECUTE format('
+                SELECT count(*) FROM (
+                    SELECT 1 FROM %I t JOIN jsonb_array_elements($2) u(patch) ON t.id = (u.patch->>''id'')::UUID
+                    WHERE t.user_id = $1
+                      AND (u.patch->>''updated_at'' IS NULL OR t.updated_at = (u.patch->>''updated_at'')::TIMESTAMPTZ)
+                    FOR UPDATE OF t
+                ) s',
+                'rate_' || table_name
+            ) INTO matching_count USING current_user_id, updated;
+
+            IF matching_count <> jsonb_array_length(updated) THEN
+                RAISE EXCEPTION 'Expected to update % terms, found %: terms deleted or modified in the meantime',
+                    jsonb_array_length(updated), matching_count;
+            END IF;
+
+            SELECT jsonb_agg(u - 'updated_at') INTO updated FROM jsonb_array_elements(updated) u;
+        END IF;
+
+        SELECT array_agg(k) INTO updatable_columns
+        FROM jsonb_object_keys(coalesce(document_data, '{}'::JSONB)) k
+        WHERE k <> ALL (excluded_keys);
+
+        IF updatable_columns IS NULL THEN
+            EXECUTE format('SELECT to_jsonb(t) FROM %I t WHERE t.user_id = $1 AND t.id = $2', table_name)
+            INTO document_row USING current_user_id, document_id;
+        ELSE
+            -- Same jsonb_populate_record of apply_terms_delta: the fields not in document_data keep their value.
+            EXECUTE format('
+                UPDATE %1$I t
+                SET (%2$s) = (SELECT %3$s FROM jsonb_populate_record(t, $3) p)
+                WHERE t.user_id = $1 AND t.id = $2 AND ($4 IS NULL OR t.updated_at = $4)
+                RETURNING to_jsonb(t)',
+                table_name,
+                (SELECT string_agg(quote_ident(c), ', ') FROM unnest(updatable_columns) c),
+                (SELECT string_agg('p.' || quote_ident(c), ', ') FROM unnest(updatable_columns) c)
+            ) INTO document_row USING current_user_id, document_id, document_data, expected_updated_at;
+        END IF;
+
+        IF document_row IS NULL THEN
+            RAISE EXCEPTION 'Document % not found, or modified in the meantime', document_id;
+        END IF;
+
+        -- The terms key, from the document as it is now.
+        SELECT jsonb_object_agg(term_key_columns[i], document_row->key_columns[i])
+        INTO document_key
+        FROM generate_subscripts(key_columns, 1) i;
+
+        delta_result := apply_terms_delta('rate_' || table_name, document_key, inserted, updated, deleted);
+        IF NOT (delta_result->>'success')::BOOLEAN THEN
+            RAISE EXCEPTION '%', delta_result->>'error';
+        END IF;
+
+        SELECT string_agg(format('t.%I = %L', dk.key, dk.value), ' AND ') INTO key_clause
+        FROM jsonb_each_text(document_key) dk;
+
+        EXECUTE format('SELECT coalesce(jsonb_agg(to_jsonb(t)), ''[]''::JSONB) FROM %I t WHERE t.user_id = $1 AND %s',
+                       'rate_' || table_name, key_clause)
+        INTO terms_rows USING current_user_id;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'document', document_row,
+                'terms', terms_rows,
+                'deleted_ids', coalesce(deleted, '[]'::JSONB)
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE,
+                'table_name', table_name
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
+
+-- Saves a modified cassa and propagates the new display value to all the terms that use it,
+-- with one UPDATE per table, in one transaction.
+--
+-- cassa_id:  id of the row in casse to update. NULL for the casse read from the fatture emesse,
+--            that are matched by nome and iban, and inserted in casse if missing.
+-- old_cassa: {"c_nome_cassa", "c_iban_cassa", "c_descrizione_cassa"} before the change,
+--            used to find the terms to update:
+--            - rate_fatture_emesse by nome and iban cassa, the only terms that have them from the xml.
+--            - the other rate tables by nome cassa equal to the old description.
+-- new_cassa: same fields, after the change.
+--
+-- Returns the number of rows updated for each table.
+CREATE OR REPLACE FUNCTION rename_cassa(
+       cassa_id UUID,
+       old_cassa JSONB,
+       new_cassa JSONB
+) RETURNS JSONB AS $$
+DECLARE
+        current_user_id UUID;
+        new_nome TEXT := nullif(trim(new_cassa->>'c_nome_cassa'), '');
+        new_iban TEXT := nullif(trim(new_cassa->>'c_iban_cassa'), '');
+        new_descrizione TEXT := nullif(trim(new_cassa->>'c_descrizione_cassa'), '');
+        old_nome TEXT := nullif(old_cassa->>'c_nome_cassa', '');
+        old_iban TEXT := nullif(old_cassa->>'c_iban_cassa', '');
+        old_descrizione TEXT := old_cassa->>'c_descrizione_cassa';
+        display_value TEXT;
+        casse_count INTEGER;
+        emesse_count INTEGER;
+        ricevute_count INTEGER;
+        movimenti_attivi_count INTEGER;
+        movimenti_passivi_count INTEGER;
+BEGIN
+        current_user_id := auth.uid();
+        display_value := coalesce(new_descrizione, new_nome, new_iban);
+
+        IF display_value IS NULL THEN
+            RAISE EXCEPTION 'Una cassa deve avere almeno un nome o un IBAN';
+        END IF;
+
+        IF cassa_id IS NOT NULL THEN
+            UPDATE public.casse c
+            SET c_nome_cassa = new_nome, c_iban_cassa = new_iban, c_descrizione_cassa = new_descrizione
+            WHERE c.id = cassa_id AND c.user_id = current_user_id;
+            GET DIAGNOSTICS casse_count = ROW_COUNT;
+
+            IF casse_count = 0 THEN
+                RAISE EXCEPTION 'Cassa % non trovata', cassa_id;
+            END IF;
+        ELSE
+            UPDATE public.casse c
+            SET c_descrizione_cassa = new_descrizione
+            WHERE c.user_id = current_user_id
+              AND c.c_nome_cassa IS NOT DISTINCT FROM new_nome
+              AND c.c_iban_cassa IS NOT DISTINCT FROM new_iban;
+            GET DIAGNOSTICS casse_count = ROW_COUNT;
+
+            IF casse_count = 0 THEN
+                INSERT INTO public.casse (user_id, c_nome_cassa, c_iban_cassa, c_descrizione_cassa)
+                VALUES (current_user_id, new_nome, new_iban, new_descrizione);
+                casse_count := 1;
+            END IF;
+        END IF;
+
+        -- IS DISTINCT FROM on display_cassa: rows already up to date are not rewritten.
+        UPDATE public.rate_fatture_emesse t SET rfe_display_cassa = display_value
+        WHERE t.user_id = current_user_id
+          AND t.rfe_nome_cassa IS NOT DISTINCT FROM old_nome
+          AND t.rfe_iban_cassa IS NOT DISTINCT FROM old_iban
+          AND t.rfe_display_cassa IS DISTINCT FROM display_value;
+        GET DIAGNOSTICS emesse_count = ROW_COUNT;
+
+        UPDATE public.rate_fatture_ricevute t SET rfr_display_cassa = display_value
+        WHERE t.user_id = current_user_id
+          AND t.rfr_nome_cassa IS NOT DISTINCT FROM old_descrizione
+          AND t.rfr_display_cassa IS DISTINCT FROM display_value;
+        GET DIAGNOSTICS ricevute_count = ROW_COUNT;
+
+        UPDATE public.rate_movimenti_attivi t SET rma_display_cassa = display_value
+        WHERE t.user_id = current_user_id
+          AND t.rma_nome_cassa IS NOT DISTINCT FROM old_descrizione
+          AND t.rma_display_cassa IS DISTINCT FROM display_value;
+        GET DIAGNOSTICS movimenti_attivi_count = ROW_COUNT;
+
+        UPDATE public.rate_movimenti_passivi t SET rmp_display_cassa = display_value
+        WHERE t.user_id = current_user_id
+          AND t.rmp_nome_cassa IS NOT DISTINCT FROM old_descrizione
+          AND t.rmp_display_cassa IS DISTINCT FROM display_value;
+        GET DIAGNOSTICS movimenti_passivi_count = ROW_COUNT;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'display_cassa', display_value,
+                'casse', casse_count,
+                'rate_fatture_emesse', emesse_count,
+                'rate_fatture_ricevute', ricevute_count,
+                'rate_movimenti_attivi', movimenti_attivi_count,
+                'rate_movimenti_passivi', movimenti_passivi_count
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
+
+-- Same operation on many terms at once, with one UPDATE, for example to record all the
+-- payments received at the end of the month.
+--
+-- table_name: one of the four rate tables.
+-- term_ids:   ids of the terms to update.
+-- operation:  'mark_paid'   -> payment date = payment_date
+--             'mark_unpaid' -> payment date = NULL
+--             'shift_due'   -> due date + shift_months months + shift_days days
+--
+-- Terms already in the requested state are not rewritten, 'updated' counts only the changed ones.
+CREATE OR REPLACE FUNCTION bulk_update_terms(
+       table_name TEXT,
+       term_ids UUID[],
+       operation TEXT,
+       payment_date DATE DEFAULT NULL,
+       shift_days INTEGER DEFAULT 0,
+       shift_months INTEGER DEFAULT 0
+) RETURNS JSONB AS $$
+DECLARE
+        current_user_id UUID;
+        due_date_column TEXT;
+        payment_date_column TEXT;
+        set_clause TEXT;
+        changed_clause TEXT;
+        updated_count INTEGER;
+        updated_rows JSONB;
+BEGIN
+        current_user_id := auth.uid();
+
+        -- The due and payment dates have different names in the invoices and movimenti terms.
+        CASE table_name
+            WHEN 'rate_fatture_emesse' THEN
+                due_date_column := 'rfe_data_scadenza_pagamento'; payment_date_column := 'rfe_data_pagamento_rata';
+            WHEN 'rate_fatture_ricevute' THEN
+                due_date_column := 'rfr_data_scadenza_pagamento'; payment_date_column := 'rfr_data_pagamento_rata';
+            WHEN 'rate_movimenti_attivi' THEN
+                due_date_column := 'rma_data_scadenza'; payment_date_column := 'rma_data_pagamento';
+            WHEN 'rate_movimenti_passivi' THEN
+                due_date_column := 'rmp_data_scadenza'; payment_date_column := 'rmp_data_pagamento';
+            ELSE
+                RAISE EXCEPTION 'bulk_update_terms does not support table %', table_name;
+        END CASE;
+
+        IF operation = 'mark_paid' THEN
+            IF payment_date IS NULL THEN
+                RAISE EXCEPTION 'payment_date is required for mark_paid';
+            END IF;
+            set_clause := format('%I = $3', payment_date_column);
+            changed_clause := format('%I IS DISTINCT FROM $3', payment_date_column);
+        ELSIF operation = 'mark_unpaid' THEN
+            set_clause := format('%I = NULL', payment_date_column);
+            changed_clause := format('%I IS NOT NULL', payment_date_column);
+        ELSIF operation = 'shift_due' THEN
+            set_clause := format('%1$I = (%1$I + make_interval(months => $4, days => $5))::DATE', due_date_column);
+            changed_clause := '($4 <> 0 OR $5 <> 0)';
+        ELSE
+            RAISE EXCEPTION 'Unknown operation %', operation;
+        END IF;
+
+        EXECUTE format('
+            WITH changed AS (
+                UPDATE %I SET %s
+                WHERE user_id = $1 AND id = ANY($2) AND %s
+                RETURNING *
+            )
+            SELECT count(*), coalesce(jsonb_agg(to_jsonb(changed)), ''[]''::JSONB) FROM changed',
+            table_name,
+            set_clause,
+            changed_clause
+        ) INTO updated_count, updated_rows
+          USING current_user_id, term_ids, payment_date, coalesce(shift_months, 0), coalesce(shift_days, 0);
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'operation', operation,
+                'updated', updated_count,
+                'rows', updated_rows
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE,
+                'table_name', table_name
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
+
+-- Deletes many documents at once with one DELETE, the terms are deleted by the
+-- ON DELETE CASCADE of the rate tables foreign keys.
+--
+-- table_name:   fatture_emesse, fatture_ricevute, movimenti_attivi or movimenti_passivi.
+-- document_ids: ids of the documents to delete.
+--
+-- Returns the number of documents and of terms deleted. The terms are counted in the same
+-- statement of the DELETE, that still sees them, since the cascade happens after.
+CREATE OR REPLACE FUNCTION delete_documents(
+       table_name TEXT,
+       document_ids UUID[]
+) RETURNS JSONB AS $$
+DECLARE
+        current_user_id UUID;
+        key_columns TEXT[];
+        term_key_columns TEXT[];
+        join_clause TEXT;
+        documents_count INTEGER;
+        terms_count INTEGER;
+        deleted_ids JSONB;
+BEGIN
+        current_user_id := auth.uid();
+
+        CASE table_name
+            WHEN 'fatture_emesse' THEN
+                key_columns := ARRAY['fe_partita_iva_prestatore', 'fe_numero_fattura', 'fe_data_documento'];
+                term_key_columns := ARRAY['rfe_partita_iva_prestatore', 'rfe_numero_fattura', 'rfe_data_documento'];
+            WHEN 'fatture_ricevute' THEN
+                key_columns := ARRAY['fr_partita_iva_prestatore', 'fr_numero_fattura', 'fr_data_documento'];
+                term_key_columns := ARRAY['rfr_partita_iva_prestatore', 'rfr_numero_fattura', 'rfr_data_documento'];
+            WHEN 'movimenti_attivi' THEN
+                key_columns := ARRAY['ma_numero', 'ma_data'];
+                term_key_columns := ARRAY['rma_numero', 'rma_data'];
+            WHEN 'movimenti_passivi' THEN
+                key_columns := ARRAY['mp_numero', 'mp_data'];
+                term_key_columns := ARRAY['rmp_numero', 'rmp_data'];
+            ELSE
+                RAISE EXCEPTION 'delete_documents does not support table %', table_name;
+        END CASE;
+
+        SELECT string_agg(format('r.%I = d.%I', term_key_columns[i], key_columns[i]), ' AND ')
+        INTO join_clause
+        FROM generate_subscripts(key_columns, 1) i;
+
+        EXECUTE format('
+            WITH deleted AS (
+                DELETE FROM %1$I
+                WHERE user_id = $1 AND id = ANY($2)
+                RETURNING id, user_id, %2$s
+            )
+            SELECT (SELECT count(*) FROM deleted),
+                   (SELECT count(*) FROM %3$I r JOIN deleted d ON r.user_id = d.user_id AND %4$s),
+                   (SELECT coalesce(jsonb_agg(id), ''[]''::JSONB) FROM deleted)',
+            table_name,
+            (SELECT string_agg(quote_ident(c), ', ') FROM unnest(key_columns) c),
+            'rate_' || table_name,
+            join_clause
+        ) INTO documents_count, terms_count, deleted_ids USING current_user_id, document_ids;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'documents', documents_count,
+                'terms', terms_count,
+                'document_ids', deleted_ids
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE,
+                'table_name', table_name
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
+
+-- Sets the display cassa of all the terms of a table that match a filter, with one UPDATE.
+-- For example the terms of the received invoices, whose rfr_display_cassa is NULL after the upload.
+--
+-- table_name:      rate_fatture_emesse, rate_fatture_ricevute, rate_movimenti_attivi or rate_movimenti_passivi.
+-- display_cassa:   the cassa to set, a value of the casse_options view.
+-- counterparty:    part of the name or of the partita iva of the counterparty of the document,
+--                  case insensitive. NULL for all the counterparties.
+-- due_from/due_to: due date range of the terms, NULL for no limit.
+-- only_unassigned: only the terms without a cassa.
+-- preview:         when true nothing is updated, 'matched' is the number of terms the same
+--                  call would change, to show it before applying.
+--
+-- Terms that already have display_cassa are never counted nor rewritten.
+CREATE OR REPLACE FUNCTION assign_cassa_bulk(
+       table_name TEXT,
+       display_cassa TEXT,
+       counterparty TEXT DEFAULT NULL,
+       due_from DATE DEFAULT NULL,
+       due_to DATE DEFAULT NULL,
+       only_unassigned BOOLEAN DEFAULT true,
+       preview BOOLEAN DEFAULT false
+) RETURNS JSONB AS $$
+DECLARE
+        current_user_id UUID;
+        document_table TEXT;
+        key_columns TEXT[];
+        term_key_columns TEXT[];
+        counterparty_expression TEXT;
+        due_date_column TEXT;
+        cassa_column TEXT;
+        join_clause TEXT;
+        where_clause TEXT;
+        matched_count INTEGER;
+        updated_rows JSONB := '[]'::JSONB;
+BEGIN
+        current_user_id := auth.uid();
+
+        IF display_cassa IS NULL OR display_cassa = '' THEN
+            RAISE EXCEPTION 'display_cassa is required';
+        END IF;
+
+        CASE table_name
+            WHEN 'rate_fatture_emesse' THEN
+                document_table := 'fatture_emesse';
+                key_columns := ARRAY['fe_partita_iva_prestatore', 'fe_numero_fattura', 'fe_data_documento'];
+                term_key_columns := ARRAY['rfe_partita_iva_prestatore', 'rfe_numero_fattura', 'rfe_data_documento'];
+                counterparty_expression := 'concat_ws('' '', d.fe_denominazione_committente, d.fe_nome_committente,
+                                                     d.fe_cognome_committente, d.fe_partita_iva_committente)';
+                due_date_column := 'rfe_data_scadenza_pagamento'; cassa_column := 'rfe_display_cassa';
+            WHEN 'rate_fatture_ricevute' THEN
+                document_table := 'fatture_ricevute';
+                key_columns := ARRAY['fr_partita_iva_prestatore', 'fr_numero_fattura', 'fr_data_documento'];
+                term_key_columns := ARRAY['rfr_partita_iva_prestatore', 'rfr_numero_fattura', 'rfr_data_documento'];
+                counterparty_expression := 'concat_ws('' '', d.fr_denominazione_prestatore, d.fr_partita_iva_prestatore)';
+                due_date_column := 'rfr_data_scadenza_pagamento'; cassa_column := 'rfr_display_cassa';
+            WHEN 'rate_movimenti_attivi' THEN
+                document_table := 'movimenti_attivi';
+                key_columns := ARRAY['ma_numero', 'ma_data'];
+                term_key_columns := ARRAY['rma_numero', 'rma_data'];
+                counterparty_expression := 'd.ma_cliente';
+                due_date_column := 'rma_data_scadenza'; cassa_column := 'rma_display_cassa';
+            WHEN 'rate_movimenti_passivi' THEN
+                document_table := 'movimenti_passivi';
+                key_columns := ARRAY['mp_numero', 'mp_data'];
+                term_key_columns := ARRAY['rmp_numero', 'rmp_data'];
+                counterparty_expression := 'd.mp_fornitore';
+                due_date_column := 'rmp_data_scadenza'; cassa_column := 'rmp_display_cassa';
+            ELSE
+                RAISE EXCEPTION 'assign_cassa_bulk does not support table %', table_name;
+        END CASE;
+
+        SELECT string_agg(format('r.%I = d.%I', term_key_columns[i], key_columns[i]), ' AND ')
+        INTO join_clause
+        FROM generate_subscripts(key_columns, 1) i;
+
+        -- Same filter for the preview and the update, so the count shown is the count applied.
+        where_clause := format('
+            r.user_id = $1 AND d.user_id = r.user_id AND %1$s
+            AND r.%2$I IS DISTINCT FROM $2
+            AND ($3 IS NULL OR %3$s ILIKE ''%%'' || $3 || ''%%'')
+            AND ($4 IS NULL OR r.%4$I >= $4)
+            AND ($5 IS NULL OR r.%4$I <= $5)
+            AND (NOT $6 OR r.%2$I IS NULL OR r.%2$I = '''')',
+            join_clause, cassa_column, counterparty_expression, due_date_column);
+
+        IF preview THEN
+            EXECUTE format('SELECT count(*) FROM %I r, %I d WHERE %s', table_name, document_table, where_clause)
+            INTO matched_count
+            USING current_user_id, display_cassa, nullif(counterparty, ''), due_from, due_to, coalesce(only_unassigned, true);
+        ELSE
+            EXECUTE format('
+                WITH changed AS (UPDATE %I r SET %I = $2 FROM %I d WHERE %s RETURNING r.*)
+                SELECT count(*), coalesce(jsonb_agg(to_jsonb(changed)), ''[]''::JSONB) FROM changed',
+                table_name, cassa_column, document_table, where_clause)
+            INTO matched_count, updated_rows
+            USING current_user_id, display_cassa, nullif(counterparty, ''), due_from, due_to, coalesce(only_unassigned, true);
+        END IF;
+
+        RETURN jsonb_build_object(
+                'success', true,
+                'table_name', table_name,
+                'preview', preview,
+                'matched', matched_count,
+                'rows', updated_rows
+               );
+
+EXCEPTION WHEN OTHERS THEN
+
+        RETURN jsonb_build_object(
+                'success', false,
+                'error', SQLERRM,
+                'error_detail', SQLSTATE,
+                'table_name', table_name
+               );
+END;
+$$ LANGUAGE plpgsql SECURITY INVOKER;
+
 
 
 DROP VIEW IF EXISTS cashflow_next_12_months;
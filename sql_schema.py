@@ -0,0 +1,66 @@
+"""
+Registry of the prefixed column names defined in sql/02_create_tables.sql, parsed once
+at import and kept in frozensets, so that the 'field in fields' checks are O(1).
+
+SQL LOGIC DEPENDENCY
+All the business columns of a table must start with the table prefix (fe_, rfe_, fr_, ...),
+one column per line. Only the lines inside the CREATE TABLE blocks are considered,
+so lines in views like 'rfe_data_scadenza_pagamento,' are not picked up.
+
+NOTE: no grep or tmp files, same reasons as in invoice_record_creation.py.
+"""
+
+import os
+
+SQL_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', '02_create_tables.sql')
+
+TABLE_PREFIXES = ('fe_', 'rfe_', 'fr_', 'rfr_', 'ma_', 'mp_', 'rma_', 'rmp_', 'c_', 'ud_')
+
+
+def parse_table_columns(sql_file_path = SQL_SCHEMA_PATH, prefixes = TABLE_PREFIXES) -> dict[str, tuple[str, ...]]:
+    """
+    Returns prefix -> prefixed column names, in declaration order.
+    Only the first word of each line inside a CREATE TABLE ( ... ); block is considered.
+    """
+    columns = {prefix: [] for prefix in prefixes}
+    in_create_table = False
+
+    with open(sql_file_path, 'r') as f:
+        for line in f:
+            stripped = line.strip()
+
+            if not in_create_table:
+                if stripped.upper().startswith('CREATE TABLE'):
+                    in_create_table = True
+                continue
+
+            if stripped.startswith(');'):
+                in_create_table = False
+                continue
+
+            if not stripped or stripped.startswith('--'):
+                continue
+
+            field_name = stripped.split()[0].rstrip(',')
+            for prefix in prefixes:
+                if field_name.startswith(prefix) and field_name not in columns[prefix]:
+                    columns[prefix].append(field_name)
+
+    return {prefix: tuple(names) for prefix, names in columns.items()}
+
+
+ORDERED_PREFIXED_FIELDS = parse_table_columns()
+
+PREFIXED_FIELDS = {prefix: frozenset(names) for prefix, names in ORDERED_PREFIXED_FIELDS.items()}
+
+# Without prefix because most of the time I have to check against field names in
+# the xml_fields or in the invoice configs, which have names without prefix.
+FIELDS = {prefix: frozenset(name[len(prefix):] for name in names)
+          for prefix, names in ORDERED_PREFIXED_FIELDS.items()}
+
+
+def get_field_names(prefix = 'fe_') -> frozenset[str]:
+    return FIELDS.get(prefix, frozenset())
+
+def get_prefixed_field_names(prefix = 'fe_') -> frozenset[str]:
+    return PREFIXED_FIELDS.get(prefix, frozenset())
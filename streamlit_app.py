@@ -3,8 +3,8 @@ import logging
 import os
 
 from PIL import Image
-from supabase import create_client
 from auth_utils import show_login_and_render_form
+from request_metrics import create_instrumented_client, start_run, finish_run, render_metrics_panel
 
 def setup_logging():
     log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
@@ -34,7 +34,8 @@ def init_supabase():
     if 'supabase_client' not in st.session_state:
         url = st.secrets["SUPABASE_URL"]
         key = st.secrets["SUPABASE_ANON_KEY"]
-        st.session_state.supabase_client = create_client(url, key)
+        # Same client, but its requests are counted, see request_metrics.py.
+        st.session_state.supabase_client = create_instrumented_client(url, key)
 
     return st.session_state.supabase_client
 
@@ -44,6 +45,7 @@ def main():
     st.set_page_config(page_title="Kruscotto", page_icon=im, layout="wide")
 
     supabase_client = init_supabase()
+    start_run()
 
     # This should be redundant.
     # if 'client' not in st.session_state:
@@ -61,10 +63,6 @@ def main():
         show_login_and_render_form(supabase_client)
     else:
 
-        # Hack. Find a better placement
-        if 'force_update' not in st.session_state:
-            st.session_state.force_update = False
-
         overview = st.Page("page_overview.py", title="Sommario Fatture", icon=":material/search:")
 
         upload = st.Page("invoice_uploader.py", title="Carica Fatture", icon=":material/upload:")
@@ -91,6 +89,10 @@ def main():
             position = 'top'
         )
         pg.run()
+        # Not reached when the page ends with st.rerun() or st.stop(), then the next
+        # start_run() logs the run.
+        finish_run()
+        render_metrics_panel()
 
 if __name__ == "__main__":
     main()
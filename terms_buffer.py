@@ -0,0 +1,180 @@
+"""
+Write-behind buffer of the changes made in the terms editors, shared by the invoices
+and the movimenti pages.
+
+Every rerun of an editor validates its terms locally and stages their delta
+(see terms_delta.py) here, in the session state, one entry per document. All the pending
+documents are saved with ONE apply_terms_deltas rpc, in one transaction, when the user
+clicks Salva or after IDLE_FLUSH_SECONDS without changes.
+
+Entries that didn't pass the validation are kept with their errors, so the user can
+fix them, but they block the flush: I don't want to save half of the changes.
+"""
+
+import time
+import traceback
+import streamlit as st
+from db_serialization import to_json_payload
+from terms_delta import is_empty
+import record_cache
+from request_metrics import track_action
+
+BUFFER_KEY = 'terms_buffer'
+IDLE_FLUSH_SECONDS = 30
+INDICATOR_REFRESH_SECONDS = 5
+
+
+def get_buffer() -> dict:
+    if BUFFER_KEY not in st.session_state:
+        st.session_state[BUFFER_KEY] = {}
+    return st.session_state[BUFFER_KEY]
+
+
+def _entry_key(terms_table_name, document_id):
+    return f'{terms_table_name}:{document_id}'
+
+
+def stage(terms_table_name, document_id, document_key, delta, terms, errors = (), label = ''):
+    """
+    Stores the pending changes of one document, replacing the previous ones.
+    document_key: the apply_terms_delta document_key.
+    terms:        the terms of the editor, to show them again when the document is selected.
+    errors:       messages of the local validation, the entry is not saved while there are any.
+    """
+    buffer = get_buffer()
+    entry_key = _entry_key(terms_table_name, document_id)
+    if is_empty(delta):
+        buffer.pop(entry_key, None)
+        return
+
+    delta = to_json_payload(delta)
+    previous = buffer.get(entry_key)
+    # Reruns without changes, like the ones of other widgets, don't reset the idle timer.
+    changed_at = previous['changed_at'] if previous and previous['delta'] == delta else time.time()
+    buffer[entry_key] = {
+        'table_name': terms_table_name,
+        'document_key': document_key,
+        'delta': delta,
+        'terms': terms,
+        'errors': list(errors),
+        'label': label,
+        'changed_at': changed_at,
+    }
+
+
+def discard(terms_table_name, document_id):
+    get_buffer().pop(_entry_key(terms_table_name, document_id), None)
+
+
+def get_pending_terms(terms_table_name, document_id):
+    """return: the terms not saved yet of the document, None if there are none."""
+    entry = get_buffer().get(_entry_key(terms_table_name, document_id))
+    return entry['terms'] if entry else None
+
+
+def count_changes(buffer) -> int:
+    """Number of terms inserted, updated or deleted in all the entries."""
+    return sum(len(entry['delta']['inserted']) + len(entry['delta']['updated']) + len(entry['delta']['deleted'])
+               for entry in buffer.values())
+
+
+def build_batch(buffer) -> list:
+    """return: the apply_terms_deltas argument, in the order the entries were staged."""
+    return [{'table_name': entry['table_name'],
+             'document_key': entry['document_key'],
+             **entry['delta']} for entry in buffer.values()]
+
+
+def is_idle(buffer, now = None) -> bool:
+    if not buffer:
+        return False
+    now = time.time() if now is None else now
+    return now - max(entry['changed_at'] for entry in buffer.values()) >= IDLE_FLUSH_SECONDS
+
+
+def flush(supabase_client) -> dict:
+    """
+    Saves all the pending entries with one rpc, and empties the buffer if it worked.
+    return: the apply_terms_deltas result, or a failure without calling it when some
+            entry has validation errors.
+    """
+    buffer = get_buffer()
+    invalid = [entry['label'] for entry in buffer.values() if entry['errors']]
+    if invalid:
+        return {'success': False, 'error': f"Correggere prima di salvare: {', '.join(invalid)}"}
+    if not buffer:
+        return {'success': True, 'documents': 0}
+
+    batch = build_batch(buffer)
+    with track_action('save terms'):
+        result = supabase_client.rpc('apply_terms_deltas', to_json_payload({'deltas': batch})).execute()
+    if result.data.get('success', False):
+        buffer.clear()
+        # Also bumps the versions of the saved tables, so the terms editors reload them.
+        record_cache.merge_rpc_result(result.data)
+    elif result.data.get('document') is not None and result.data['document'] < len(batch):
+        result.data['label'] = list(buffer.values())[result.data['document']]['label']
+    return result.data
+
+
+def save_pending_changes(supabase_client):
+    """The Salva button of the terms editors: saves the changes of all the documents."""
+    try:
+        if not get_buffer():
+            st.info('Nessuna modifica da salvare')
+            return
+
+        result = flush(supabase_client)
+        if result.get('success', False):
+            st.success("Modifiche eseguite con successo")
+            st.rerun()
+        else:
+            st.error(f'Errore nel salvataggio: {result}')
+
+    # todo: fix error management / logging.
+    #  Here is interesting because the above catches db error that are not
+    #  exceptions, the below only exceptions.
+    except Exception as e:
+        st.error(f"Eccezione nel salvataggio: {str(e)}")
+        st.text("Stack trace:")
+        st.text(traceback.format_exc())
+
+
+def auto_save(supabase_client):
+    """
+    The save of render_pending_indicator(). When it fails, with a database error or an
+    exception, it is retried after another idle interval, not at every refresh.
+    """
+    try:
+        result = flush(supabase_client)
+        if result.get('success', False):
+            st.rerun()
+        st.error(f'Errore nel salvataggio automatico: {result}')
+    except Exception as e:
+        st.error(f"Eccezione nel salvataggio automatico: {str(e)}")
+        st.text("Stack trace:")
+        st.text(traceback.format_exc())
+
+    for entry in get_buffer().values():
+        entry['changed_at'] = time.time()
+
+
+@st.fragment(run_every = INDICATOR_REFRESH_SECONDS)
+def render_pending_indicator(supabase_client):
+    """
+    'N modifiche in sospeso', refreshed on its own so that it can save the buffer
+    when the user stops editing, without waiting for another interaction.
+    """
+    buffer = get_buffer()
+    if not buffer:
+        return
+
+    invalid = [entry['label'] for entry in buffer.values() if entry['errors']]
+    message = f'{count_changes(buffer)} modifiche in sospeso su {len(buffer)} documenti'
+    if invalid:
+        st.warning(f"{message}, da correggere: {', '.join(invalid)}")
+        return
+    st.caption(message)
+
+    if is_idle(buffer):
+        auto_save(supabase_client)
@@ -0,0 +1,98 @@
+"""
+Diff between the terms loaded in the editor and the edited terms, as the arguments of
+the apply_terms_delta RPC (see sql/02_create_tables.sql):
+- edited term with an id of the backup -> updated, with only the fields that changed.
+- edited term without id               -> inserted, whole.
+- backup id missing from the edited    -> deleted.
+
+With versions ({id: updated_at} of the loaded terms) every update carries the updated_at
+that was read, so the RPC refuses to overwrite a term modified in the meantime.
+
+Values are compared after to_json_payload() and _normalize(), because the backup has dates
+and Decimal while the data editor gives back floats, Timestamps and None:
+None and '' -> None, numbers -> Decimal, '2024-01-31T00:00:00' -> '2024-01-31'.
+"""
+
+import re
+from decimal import Decimal
+from db_serialization import to_json_payload
+from payment_schedule import rescale_amounts
+
+NUMERIC_STRING = re.compile(r'^-?\d+(\.\d+)?$')
+
+
+def _normalize(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    if isinstance(value, str):
+        if NUMERIC_STRING.match(value):
+            return Decimal(value)
+        if value.endswith('T00:00:00'):
+            return value[:-len('T00:00:00')]
+    return value
+
+
+def diff_terms(backup_terms, edited_terms, ignored_fields = (), versions = None) -> dict:
+    """
+    backup_terms: terms as loaded from the database, each with its 'id'.
+    edited_terms: terms of the editor, 'id' None (or NaN) for the new rows.
+    ignored_fields: fields never sent, for example the editor-only columns.
+    versions: {id: updated_at} of the backup terms, optional.
+    return: {'inserted': [...], 'updated': [...], 'deleted': [...]}, json serializable,
+            the apply_terms_delta arguments.
+    """
+    ignored_fields = set(ignored_fields)
+    backup_by_id = {term['id']: term for term in to_json_payload(backup_terms or []) if term.get('id')}
+    edited_terms = to_json_payload(edited_terms)
+
+    inserted, updated = [], []
+    edited_ids = set()
+    for term in edited_terms:
+        term = {k: v for k, v in term.items() if k not in ignored_fields}
+        term_id = term.get('id')
+
+        if not term_id:
+            term.pop('id', None)
+            inserted.append(term)
+            continue
+
+        edited_ids.add(term_id)
+        backup = backup_by_id.get(term_id)
+        if backup is None:
+            # Not in the backup, so I don't know what changed: I send all the fields,
+            # the RPC fails if the term is not in the document anymore.
+            updated.append(term)
+            continue
+
+        changes = {k: v for k, v in term.items()
+                   if k != 'id' and k in backup and _normalize(v) != _normalize(backup[k])}
+        if changes:
+            if versions and versions.get(term_id):
+                changes['updated_at'] = versions[term_id]
+            updated.append({'id': term_id, **changes})
+
+    deleted = [term_id for term_id in backup_by_id if term_id not in edited_ids]
+
+    return {'inserted': inserted, 'updated': updated, 'deleted': deleted}
+
+
+def is_empty(delta) -> bool:
+    return not (delta['inserted'] or delta['updated'] or delta['deleted'])
+
+
+def rescale_terms(terms, amount_field, due_date_field, new_total) -> dict:
+    """
+    terms: rows of the rate table of one document, with 'id' and 'updated_at'.
+    return: the delta that rescales the amounts to new_total (see rescale_amounts()),
+            sorted by due date so the last term gets the rounding remainder.
+    """
+    terms = sorted(terms, key=lambda term: str(term[due_date_field]))
+    amounts = rescale_amounts([term[amount_field] for term in terms], new_total)
+    updated = [{'id': term['id'], amount_field: str(amount), 'updated_at': term.get('updated_at')}
+               for term, amount in zip(terms, amounts)
+               if _normalize(term[amount_field]) != _normalize(amount)]
+    return {'inserted': [], 'updated': updated, 'deleted': []}
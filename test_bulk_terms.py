@@ -0,0 +1,20 @@
+from datetime import date
+import pandas as pd
+from bulk_terms import filter_terms
+
+
+def test_filter_terms_by_payment_and_due_date():
+    terms = pd.DataFrame([
+        {'id': 'a', 'rma_numero': '2', 'rma_data': '2024-01-01', 'rma_data_scadenza': '2024-02-29',
+         'rma_data_pagamento': None, 'rma_importo_pagamento': 10, 'rma_display_cassa': None},
+        {'id': 'b', 'rma_numero': '1', 'rma_data': '2024-01-01', 'rma_data_scadenza': '2024-01-31',
+         'rma_data_pagamento': None, 'rma_importo_pagamento': 10, 'rma_display_cassa': None},
+        {'id': 'c', 'rma_numero': '3', 'rma_data': '2024-01-01', 'rma_data_scadenza': '2024-01-31',
+         'rma_data_pagamento': '2024-01-31', 'rma_importo_pagamento': 10, 'rma_display_cassa': None},
+        {'id': 'd', 'rma_numero': '4', 'rma_data': '2024-01-01', 'rma_data_scadenza': '2024-03-31',
+         'rma_data_pagamento': None, 'rma_importo_pagamento': 10, 'rma_display_cassa': None},
+    ])
+
+    assert list(filter_terms(terms, 'rate_movimenti_attivi')['id']) == ['b', 'c', 'a', 'd']
+    assert list(filter_terms(terms, 'rate_movimenti_attivi', only_unpaid=True,
+                             due_from=date(2024, 1, 1), due_to=date(2024, 2, 29))['id']) == ['b', 'a']
@@ -0,0 +1,136 @@
+"""
+Static check of the columns selected by the pages: every column of a select() or of the
+columns argument of the fetch helpers of utils.py must be read somewhere in the same module,
+otherwise it is only payload. Nothing is run, the modules are parsed with ast.
+
+A column is read when its name, or its name without the prefix of the table
+(fe_numero_fattura -> numero_fattura, for the prefix + 'numero_fattura' lookups),
+is a string of the module that is not a projection or the column of a filter.
+
+The *_DISPLAY_COLUMNS are shown whole in a table, so they are read by definition.
+"""
+
+import ast
+import warnings
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+# Not part of the app: tests, experiments and local scripts.
+SKIPPED_PREFIXES = ('test_', 'scratch_', 'streamlit_test_', 'tool_', 'local_')
+# The only module allowed to read whole rows, see record_cache.get_records().
+ALL_COLUMNS_ALLOWED = {'record_cache.py'}
+
+FETCH_HELPERS = {'fetch_all_records', 'fetch_all_records_from_view', 'fetch_record_from_id'}
+FILTER_METHODS = {'eq', 'neq', 'lt', 'lte', 'gt', 'gte', 'in_', 'is_', 'like', 'ilike', 'or_', 'order'}
+TABLE_PREFIXES = ('fe_', 'fr_', 'ma_', 'mp_', 'rfe_', 'rfr_', 'rma_', 'rmp_', 'c_', 'ud_', 'v_')
+
+
+def app_modules():
+    return sorted(path for path in ROOT.glob('*.py') if not path.name.startswith(SKIPPED_PREFIXES))
+
+
+def _strings(node):
+    return [n for n in ast.walk(node) if isinstance(n, ast.Constant) and isinstance(n.value, str)]
+
+
+def _method_name(call):
+    return call.func.attr if isinstance(call.func, ast.Attribute) else getattr(call.func, 'id', None)
+
+
+def _module_assignments(tree):
+    """return: {name: value node} of the module level assignments."""
+    return {target.id: node.value
+            for node in tree.body if isinstance(node, ast.Assign)
+            for target in node.targets if isinstance(target, ast.Name)}
+
+
+class Projections:
+
+    def __init__(self, tree):
+        self.columns = []       # (column, line)
+        self.nodes = set()      # id() of the string nodes that are projections or filters
+        self.all_columns = []   # lines selecting '*'
+
+        for name, value in _module_assignments(tree).items():
+            if name.endswith('_COLUMNS') and name != 'ALL_COLUMNS':
+                self._add(value, read = name.endswith('_DISPLAY_COLUMNS'))
+
+        for call in (n for n in ast.walk(tree) if isinstance(n, ast.Call)):
+            name = _method_name(call)
+            if name == 'select':
+                self._select(call)
+            elif name in FETCH_HELPERS and call.args:
+                self._add(call.args[-1])
+            elif name in FILTER_METHODS and call.args:
+                self.nodes.update(id(n) for n in _strings(call.args[0]))
+
+    def _add(self, node, read = False):
+        if isinstance(node, ast.Name):
+            # The *_COLUMNS are checked where they are defined, the other names are the
+            # columns returned by a helper, e.g. USER_COUNTERS_FIELDS of get_user_counters().
+            if node.id == 'ALL_COLUMNS':
+                self.all_columns.append(node.lineno)
+            return
+        for string in _strings(node):
+            self.nodes.add(id(string))
+            for column in string.value.split(','):
+                column = column.strip()
+                if column == '*':
+                    self.all_columns.append(string.lineno)
+                elif column and not read:
+                    self.columns.append((column, string.lineno))
+
+    def _select(self, call):
+        if any(keyword.arg == 'head' for keyword in call.keywords):
+            # Only the count, no rows.
+            self.nodes.update(id(n) for arg in call.args for n in _strings(arg))
+            return
+        for arg in call.args:
+            # ','.join(NAME) -> NAME
+            if isinstance(arg, ast.Call) and _method_name(arg) == 'join' and arg.args:
+                arg = arg.args[0]
+            self._add(arg)
+
+
+def _unprefixed(column):
+    for prefix in TABLE_PREFIXES:
+        if column.startswith(prefix):
+            return column[len(prefix):]
+    return column
+
+
+def check_module(path):
+    """return: the errors of the module, as strings."""
+    with warnings.catch_warnings():
+        # The invalid escapes of some regexes, not our business here.
+        warnings.simplefilter('ignore', SyntaxWarning)
+        tree = ast.parse(path.read_text(encoding = 'utf-8'))
+    projections = Projections(tree)
+    read = {n.value for n in _strings(tree) if id(n) not in projections.nodes}
+
+    errors = []
+    if path.name not in ALL_COLUMNS_ALLOWED:
+        errors += [f"{path.name}:{line}: selects '*'" for line in projections.all_columns]
+    errors += [f'{path.name}:{line}: selects {column}, never read'
+               for column, line in projections.columns
+               if column not in read and _unprefixed(column) not in read]
+    return errors
+
+
+def test_pages_select_only_the_columns_they_read():
+    errors = [error for path in app_modules() for error in check_module(path)]
+
+    assert not errors, '\n'.join(errors)
+
+
+def test_check_finds_unread_and_all_columns(tmp_path):
+    page = tmp_path / 'page.py'
+    page.write_text(
+        "rows = client.table('fatture_emesse').select('fe_numero_fattura', 'fe_data_documento')"
+        ".eq('fe_data_documento', today).execute()\n"
+        "numbers = [row['fe_numero_fattura'] for row in rows.data]\n"
+        "everything = client.table('casse').select('*').execute()\n"
+        "count = client.table('casse').select('id', count = 'exact', head = True).execute()\n")
+
+    assert check_module(page) == ["page.py:3: selects '*'",
+                                  'page.py:1: selects fe_data_documento, never read']
@@ -0,0 +1,42 @@
+import pytest
+import numpy as np
+import pandas as pd
+from datetime import date, datetime
+from decimal import Decimal
+from db_serialization import to_json_payload
+
+
+# @formatter:off
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (date(2025, 3, 31), '2025-03-31'),
+        (datetime(2025, 3, 31, 10, 30), '2025-03-31T10:30:00'),
+        (pd.Timestamp('2025-03-31'), '2025-03-31T00:00:00'),
+        (Decimal('155.670'), '155.670'),                    # trailing zeros are kept
+        (None, None),
+        (float('nan'), None),
+        (np.float64('nan'), None),
+        (pd.NaT, None),
+        (pd.NA, None),
+        (np.int64(3), 3),
+        (np.float64(2.5), 2.5),
+        (np.bool_(True), True),
+        ('None', 'None'),
+    ]
+# @formatter:on
+)
+def test_to_json_payload_values(value, expected):
+    assert to_json_payload({'field': value}) == {'field': expected}
+
+def test_to_json_payload_nested_terms():
+    payload = {
+        'table_name': 'rate_fatture_emesse',
+        'terms': [{'rfe_data_scadenza_pagamento': date(2025, 4, 30), 'rfe_importo_pagamento_rata': Decimal('10.00'),
+                   'rfe_data_pagamento_rata': np.nan}],
+    }
+    assert to_json_payload(payload) == {
+        'table_name': 'rate_fatture_emesse',
+        'terms': [{'rfe_data_scadenza_pagamento': '2025-04-30', 'rfe_importo_pagamento_rata': '10.00',
+                   'rfe_data_pagamento_rata': None}],
+    }
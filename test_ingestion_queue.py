@@ -0,0 +1,73 @@
+import glob
+import os
+import ingestion_queue
+from ingestion_queue import enqueue_job, get_job, get_job_files, process_job, init_db, connect
+
+
+class _RpcClient:
+    """Only what insert_records_batch() uses of the supabase client: every invoice is inserted."""
+
+    def __init__(self, name = None, params = None):
+        self.name, self.params = name, params
+
+    def rpc(self, name, params):
+        # A new request for each call, since the chunks are sent concurrently.
+        return _RpcClient(name, params)
+
+    def execute(self):
+        if self.name == 'find_existing_invoices':
+            self.data = {'fatture_emesse': [], 'fatture_ricevute': []}
+        else:
+            self.data = {'success': True, 'results': [{'position': i, 'status': 'inserted', 'error': None}
+                                                      for i in range(len(self.params['records']))]}
+        return self
+
+
+def test_job_stores_per_file_outcomes(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    monkeypatch.setattr(ingestion_queue, 'FILES_PER_STEP', 3)
+    init_db(db_path)
+
+    xml_files = sorted(glob.glob(os.path.join('pytest_fixtures/test_document_date_assignment_when_empty_duedate', '*.xml')))
+    files = [(os.path.basename(f), open(f, 'rb').read()) for f in xml_files] + [('broken.xml', b'<FatturaElettronica')]
+    job_id = enqueue_job('user', '12345678900', files, db_path)
+
+    connection = connect(db_path)
+    job = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    process_job(job, _RpcClient(), connection)
+
+    job = get_job(job_id, db_path)
+    assert job['processed_files'] == len(files)
+    assert job['outcomes'] == {'inserted': len(xml_files), 'error': 1}
+    assert [f['filename'] for f in get_job_files(job_id, outcomes=['error'], db_path=db_path)] == ['broken.xml']
+    # The content is dropped once the file is processed.
+    assert connection.execute('SELECT count(content) FROM job_files').fetchone()[0] == 0
+
+
+def test_same_files_resume_the_batch(tmp_path):
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    init_db(db_path)
+    files = [('a.xml', b'a'), ('b.xml', b'b'), ('c.xml', b'c')]
+    job_id = enqueue_job('user', '12345678900', files, db_path)
+
+    # Same batch still queued, in any order.
+    assert enqueue_job('user', '12345678900', files[::-1], db_path) == job_id
+
+    # Interrupted after the first file, and one file in error.
+    connection = connect(db_path)
+    connection.execute("UPDATE job_files SET outcome = 'inserted', content = NULL WHERE position = 0")
+    connection.execute("UPDATE job_files SET outcome = 'error', content = NULL WHERE position = 1")
+    connection.execute("UPDATE jobs SET status = 'failed', processed_files = 2")
+    connection.commit()
+
+    assert enqueue_job('user', '12345678900', files, db_path) == job_id
+    job = get_job(job_id, db_path)
+    assert job['status'] == 'queued' and job['processed_files'] == 1
+    rows = connection.execute('SELECT filename, outcome, content FROM job_files ORDER BY position').fetchall()
+    assert [tuple(row) for row in rows] == [('a.xml', 'inserted', None), ('b.xml', None, b'b'), ('c.xml', None, b'c')]
+
+    # Completed without errors: a new upload of the same files is a new job.
+    connection.execute("UPDATE job_files SET outcome = 'inserted', content = NULL")
+    connection.execute("UPDATE jobs SET status = 'done'")
+    connection.commit()
+    assert enqueue_job('user', '12345678900', files, db_path) != job_id
@@ -0,0 +1,76 @@
+import random
+import time
+import httpx
+import pytest
+from invoice_batch_insert import map_concurrently, mark_duplicates, _new_outcomes, DUPLICATE
+
+
+def test_map_concurrently_keeps_input_order_and_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr('invoice_batch_insert.RETRY_BACKOFF_SECONDS', 0)
+    attempts = {}
+
+    def call(item):
+        attempts[item] = attempts.get(item, 0) + 1
+        time.sleep(random.uniform(0, 0.01))
+        if item % 5 == 0 and attempts[item] == 1:
+            raise httpx.ConnectError('connection reset')
+        if item == 7:
+            raise ValueError('not transient')
+        return item * 10
+
+    results = map_concurrently(call, list(range(20)), max_in_flight=4, retries=2)
+
+    assert [r for i, r in enumerate(results) if i != 7] == [i * 10 for i in range(20) if i != 7]
+    assert isinstance(results[7], ValueError)
+    assert attempts[5] == 2 and attempts[7] == 1
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 8])
+def test_map_concurrently_gives_up_after_retries(max_in_flight, monkeypatch):
+    monkeypatch.setattr('invoice_batch_insert.RETRY_BACKOFF_SECONDS', 0)
+
+    def call(item):
+        raise httpx.ReadTimeout('timeout')
+
+    results = map_concurrently(call, [1, 2], max_in_flight=max_in_flight, retries=1)
+    assert all(isinstance(r, httpx.ReadTimeout) for r in results)
+
+
+class _RpcClient:
+    """Only what mark_duplicates() uses of the supabase client."""
+
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def rpc(self, name, params):
+        self.calls.append((name, params))
+        return self
+
+    def execute(self):
+        return self
+
+
+def _xml_record(invoice_type, numero):
+    prefix = {'emessa': 'fe_', 'ricevuta': 'fr_'}[invoice_type]
+    return {'filename': f'{numero}.xml', 'status': 'success', 'error_message': '', 'invoice_type': invoice_type,
+            'record': {prefix + 'partita_iva_prestatore': '12345678900', prefix + 'numero_fattura': numero,
+                       prefix + 'data_documento': '2025-01-31'},
+            'terms': []}
+
+
+def test_mark_duplicates_in_batch_and_in_database():
+    xml_records = [_xml_record('emessa', '1'), _xml_record('emessa', '2'), _xml_record('emessa', '1'),
+                   _xml_record('ricevuta', '1'), _xml_record('ricevuta', '3')]
+    client = _RpcClient({'fatture_emesse': [1], 'fatture_ricevute': [1]})
+    outcomes = _new_outcomes(xml_records)
+
+    assert mark_duplicates(client, xml_records, 'user', outcomes) == 3
+    assert [o['outcome'] for o in outcomes] == [None, DUPLICATE, DUPLICATE, None, DUPLICATE]
+
+    # One call, with the keys of the batch without the in-batch duplicates.
+    assert len(client.calls) == 1
+    name, params = client.calls[0]
+    assert name == 'find_existing_invoices'
+    assert params['emesse_keys'] == [['12345678900', '1', '2025-01-31'], ['12345678900', '2', '2025-01-31']]
+    assert params['ricevute_keys'] == [['12345678900', '1', '2025-01-31'], ['12345678900', '3', '2025-01-31']]
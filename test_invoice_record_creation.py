@@ -1,8 +1,10 @@
+import copy
 import pytest
 import glob
 import os
 from supabase import create_client
-from invoice_record_creation import extract_xml_records
+from invoice_record_creation import extract_xml_records, TERM_FIELDS
+from invoice_batch_builder import build_record_tables, get_prefixed_tables, to_record_payloads, _synthetic_parsing_results
 from invoice_xml_processor import process_xml_list
 import streamlit as st
 
@@ -39,3 +41,41 @@ def test_document_date_assignment_when_empty_duedate():
 
         # NOTE; is this a good way to test this? I'm not testing invoices that were correctly
         # valued from the beginning...
+
+def test_batch_builder_matches_extract_xml_records():
+    partita_iva_azienda = '12345678900'
+    xml_files = sorted(glob.glob(os.path.join('pytest_fixtures/test_document_date_assignment_when_empty_duedate', "*.xml")))
+    parsing_results, error = process_xml_list(xml_files)
+    expected = extract_xml_records(parsing_results, partita_iva_azienda)
+
+    invoices, terms = build_record_tables(parsing_results, partita_iva_azienda)
+    payloads = []
+    for invoice_type in ['emessa', 'ricevuta']:
+        records, prefixed_terms = get_prefixed_tables(invoices, terms, invoice_type)
+        payloads += to_record_payloads(records, prefixed_terms)
+
+    assert len(payloads) == len(xml_files)
+    for payload in payloads:
+        assert payload['record'] == expected[payload['row']]['record']
+        assert payload['terms'] == expected[payload['row']]['terms']
+
+def test_extract_xml_records_leaves_the_parsed_data_intact():
+    partita_iva_azienda = '12345678900'
+    parsing_results = _synthetic_parsing_results(4, partita_iva_azienda)
+    parsed = copy.deepcopy(parsing_results)
+
+    results = extract_xml_records(parsing_results, partita_iva_azienda)
+
+    # No copy of the parsed data, and nothing popped from it.
+    assert parsing_results == parsed
+    assert all(result['data'] is xml['data'] for result, xml in zip(results, parsing_results))
+
+    # 3/2025 is a ricevuta with 3 terms: the term fields go only in the terms.
+    record, terms = results[3]['record'], results[3]['terms']
+    assert not any(column[len('fr_'):] in TERM_FIELDS for column in record)
+    assert record['fr_numero_fattura'] == '3/2025' and record['fr_importo_totale_documento'] == '1200.00'
+    assert [(term['rfr_numero_fattura'], term['rfr_data_scadenza_pagamento'], term['rfr_importo_pagamento_rata'],
+             term['rfr_iban_cassa']) for term in terms] == \
+           [('3/2025', '2025-04-30', '400.00', 'IT60X0542811101000000123456'),
+            ('3/2025', '2025-05-30', '400.00', 'IT60X0542811101000000123456'),
+            ('3/2025', '2025-06-30', '400.00', 'IT60X0542811101000000123456')]
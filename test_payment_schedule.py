@@ -0,0 +1,62 @@
+from datetime import date
+from decimal import Decimal
+import pandas as pd
+import pytest
+from payment_schedule import build_schedule, split_document, parse_splits, rescale_amounts
+from invoice_manage import build_bulk_terms_payload
+
+
+def test_split_document_equal_amounts_sum_to_total():
+    installments = split_document('100.00', 3, '2025-01-31')
+    assert [i['importo'] for i in installments] == [Decimal('33.33'), Decimal('33.33'), Decimal('33.34')]
+    assert [i['data_scadenza'] for i in installments] == [date(2025, 3, 2), date(2025, 4, 1), date(2025, 5, 1)]
+
+
+def test_build_schedule_conventions_and_splits():
+    documents = pd.DataFrame({'importo_totale': ['1000.01', '99.99'],
+                              'data_documento': ['2025-01-15', '2025-11-30']})
+
+    schedule = build_schedule(documents, 2, convention='fine_mese', splits=[30, 70])
+    assert list(schedule['data_scadenza']) == [date(2025, 2, 28), date(2025, 3, 31),
+                                               date(2025, 12, 31), date(2026, 1, 31)]
+    assert schedule.groupby(schedule.index // 2)['importo'].sum().tolist() == [Decimal('1000.01'), Decimal('99.99')]
+
+    schedule = build_schedule(documents, 2, convention='giorno_fisso', day_of_month=31, interval_days=60)
+    assert list(schedule['data_scadenza']) == [date(2025, 3, 31), date(2025, 5, 31),
+                                               date(2026, 1, 31), date(2026, 3, 31)]
+
+    # Not rounded to a whole month.
+    with pytest.raises(ValueError):
+        build_schedule(documents, 2, convention='fine_mese', interval_days=45)
+
+
+def test_parse_splits():
+    assert parse_splits('') is None
+    assert parse_splits('33,3 / 66,7') == [33.3, 66.7]
+
+
+def test_rescale_amounts_keeps_proportions_and_total():
+    assert rescale_amounts(['30.00', '70.00'], '200.00') == [Decimal('60.00'), Decimal('140.00')]
+    assert rescale_amounts([Decimal('33.33')] * 3, '100.00') == [Decimal('33.33'), Decimal('33.33'), Decimal('33.34')]
+    assert rescale_amounts(['0', '100.00'], '10.00') == [Decimal('5.00'), Decimal('5.00')]
+    assert rescale_amounts([], '10.00') == []
+
+
+def test_bulk_terms_payload_keeps_apart_the_suppliers_of_the_same_number_and_date():
+    documents = pd.DataFrame({'numero_fattura': ['1', '1'],
+                              'data_documento': ['2025-01-15', '2025-01-15'],
+                              'importo_totale': ['100.00', '50.00'],
+                              'partita_iva_prestatore': ['11111111111', '22222222222']})
+    check_terms = pd.DataFrame([{'rfr_numero_fattura': '1', 'rfr_data_documento': '2025-01-15',
+                                 'rfr_partita_iva_prestatore': '22222222222', 'rfr_display_cassa': 'Banca B',
+                                 'rfr_nome_cassa': 'Banca B', 'rfr_iban_cassa': None}])
+
+    payload = build_bulk_terms_payload(build_schedule(documents, 2), check_terms, 'rfr_')
+
+    assert [document['delete_key'] for document in payload] == [
+        {'rfr_numero_fattura': '1', 'rfr_data_documento': '2025-01-15', 'rfr_partita_iva_prestatore': '11111111111'},
+        {'rfr_numero_fattura': '1', 'rfr_data_documento': '2025-01-15', 'rfr_partita_iva_prestatore': '22222222222'}]
+    assert [[term['rfr_importo_pagamento_rata'] for term in document['terms']] for document in payload] == \
+           [[Decimal('50.00'), Decimal('50.00')], [Decimal('25.00'), Decimal('25.00')]]
+    assert [{term.get('rfr_display_cassa') for term in document['terms']} for document in payload] == \
+           [{None}, {'Banca B'}]
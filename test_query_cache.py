@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+import streamlit as st
+import query_cache
+import record_cache
+import shared_cache
+
+
+def _fetch(calls, name):
+    def fetch():
+        calls.append(name)
+        return [{'id': len(calls)}]
+    return fetch
+
+
+def _reset():
+    st.session_state.pop(query_cache.CACHE_KEY, None)
+    st.session_state.pop(record_cache.CACHE_KEY, None)
+    shared_cache.clear()
+    st.session_state.user = SimpleNamespace(id = 'u1')
+
+
+def test_hits_until_the_version_changes():
+    _reset()
+    calls = []
+
+    query_cache.get('fatture_emesse', 'u1', (), _fetch(calls, 'fatture_emesse'))
+    rows = query_cache.get('fatture_emesse', 'u1', (), _fetch(calls, 'fatture_emesse'))
+    query_cache.get('fatture_emesse', 'u2', (), _fetch(calls, 'fatture_emesse'))
+    query_cache.bump_version('fatture_emesse')
+    query_cache.get('fatture_emesse', 'u1', (), _fetch(calls, 'fatture_emesse'))
+
+    assert rows == [{'id': 1}]
+    assert calls == ['fatture_emesse'] * 3
+    assert query_cache.hit_rates()['fatture_emesse'] == {'hits': 1, 'shared_hits': 0, 'misses': 3, 'rate': 0.25}
+
+
+def test_sessions_of_the_same_user_share_the_rows():
+    _reset()
+    calls = []
+
+    query_cache.get('casse_options', 'u1', (), _fetch(calls, 'casse'))
+    # Another tab: its own session state, the same process.
+    st.session_state.pop(query_cache.CACHE_KEY)
+    rows = query_cache.get('casse_options', 'u1', (), _fetch(calls, 'casse'))
+    query_cache.get('casse_options', 'u2', (), _fetch(calls, 'casse'))
+    shared_cache.bump_version('u1', 'casse')
+    st.session_state.pop(query_cache.CACHE_KEY)
+    query_cache.get('casse_options', 'u1', (), _fetch(calls, 'casse'))
+
+    assert rows == [{'id': 1}]
+    assert calls == ['casse'] * 3
+    assert query_cache.hit_rates()['casse_options']['misses'] == 1
+
+
+def test_views_depend_on_the_tables_they_read():
+    _reset()
+    calls = []
+
+    query_cache.get('fatture_emesse_overview', 'u1', (), _fetch(calls, 'overview'))
+    query_cache.get('casse_options', 'u1', (), _fetch(calls, 'casse'))
+    query_cache.bump_version('rate_movimenti_attivi')
+    query_cache.get('fatture_emesse_overview', 'u1', (), _fetch(calls, 'overview'))
+    query_cache.get('casse_options', 'u1', (), _fetch(calls, 'casse'))
+    record_cache.merge_rows('rate_fatture_emesse', [])
+    query_cache.get('fatture_emesse_overview', 'u1', (), _fetch(calls, 'overview'))
+
+    assert calls == ['overview', 'casse', 'casse', 'overview']
+
+
+def test_expired_after_the_ttl():
+    _reset()
+    calls = []
+
+    query_cache.get('casse_summary', 'u1', (), _fetch(calls, 'casse'))
+    query_cache.get('casse_summary', 'u1', (), _fetch(calls, 'casse'), ttl = 0)
+
+    assert calls == ['casse', 'casse']
@@ -0,0 +1,91 @@
+import sqlite3
+import streamlit as st
+import record_cache
+import shared_cache
+
+
+def _fake_fetch(calls):
+    def fetch(supabase_client, table_name, user_id, columns):
+        calls.append(table_name)
+        return [{'id': 'a', 'user_id': user_id, 'rfe_data_pagamento_rata': None},
+                {'id': 'b', 'user_id': user_id, 'rfe_data_pagamento_rata': None}]
+    return fetch
+
+
+def test_rows_returned_by_the_rpc_are_merged_without_refetching(monkeypatch):
+    calls = []
+    monkeypatch.setattr('record_cache.fetch_all_records', _fake_fetch(calls))
+    monkeypatch.setattr('record_cache.list_jobs', lambda user_id, limit: [])
+    st.session_state.pop(record_cache.CACHE_KEY, None)
+
+    record_cache.get_records(None, 'rate_fatture_emesse', 'u1')
+    record_cache.merge_rpc_result({'success': True, 'results': [{
+        'table_name': 'rate_fatture_emesse',
+        'rows': [{'id': 'a', 'user_id': 'u1', 'rfe_data_pagamento_rata': '2024-01-31'},
+                 {'id': 'c', 'user_id': 'u1', 'rfe_data_pagamento_rata': None}],
+        'deleted_ids': ['b'],
+    }]})
+    rows = record_cache.get_records(None, 'rate_fatture_emesse', 'u1')
+
+    assert calls == ['rate_fatture_emesse']
+    assert {row['id']: row['rfe_data_pagamento_rata'] for row in rows} == {'a': '2024-01-31', 'c': None}
+
+
+def test_upload_jobs_and_other_users_invalidate_the_cache(monkeypatch):
+    calls = []
+    jobs = []
+    monkeypatch.setattr('record_cache.fetch_all_records', _fake_fetch(calls))
+    monkeypatch.setattr('record_cache.list_jobs', lambda user_id, limit: list(jobs))
+    st.session_state.pop(record_cache.CACHE_KEY, None)
+
+    record_cache.get_records(None, 'fatture_emesse', 'u1')
+    record_cache.get_records(None, 'fatture_emesse', 'u1')
+    jobs.append({'id': 'job', 'status': 'running', 'processed_files': 1})
+    record_cache.get_records(None, 'fatture_emesse', 'u1')
+    record_cache.get_records(None, 'fatture_emesse', 'u2')
+
+    assert calls == ['fatture_emesse'] * 3
+
+
+def test_records_are_read_before_the_upload_queue_is_initialized(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr('record_cache.fetch_all_records', _fake_fetch(calls))
+    # A new db, init_db() is called only by the workers of the uploader page.
+    monkeypatch.setattr('ingestion_queue.QUEUE_DB_PATH', str(tmp_path / 'jobs.sqlite3'))
+    st.session_state.pop(record_cache.CACHE_KEY, None)
+
+    rows = record_cache.get_records(None, 'fatture_emesse', 'u1')
+
+    assert [row['id'] for row in rows] == ['a', 'b']
+    assert record_cache.list_jobs('u1', limit = 1) == []
+
+
+def test_unreadable_upload_queue_is_no_marker(monkeypatch):
+    def list_jobs(user_id, limit):
+        raise sqlite3.OperationalError('unable to open database file')
+    monkeypatch.setattr('record_cache.list_jobs', list_jobs)
+
+    assert record_cache._upload_marker('u1') is None
+
+
+def test_write_after_another_session_wrote_drops_the_entry(monkeypatch):
+    # Two sessions of the same user, with their own session state and one shared backend.
+    calls = []
+    monkeypatch.setattr('record_cache.fetch_all_records', _fake_fetch(calls))
+    monkeypatch.setattr('record_cache.list_jobs', lambda user_id, limit: [])
+    monkeypatch.setattr('shared_cache.backend', shared_cache.MemoryBackend())
+    sessions = [{}, {}]
+    monkeypatch.setattr(record_cache.st, 'session_state', sessions[0])
+    record_cache.get_records(None, 'casse', 'u1')
+    monkeypatch.setattr(record_cache.st, 'session_state', sessions[1])
+    record_cache.get_records(None, 'casse', 'u1')
+
+    record_cache.merge_rows('casse', [{'id': 'c', 'user_id': 'u1'}])
+    monkeypatch.setattr(record_cache.st, 'session_state', sessions[0])
+    record_cache.merge_rows('casse', [{'id': 'd', 'user_id': 'u1'}])
+    rows = record_cache.get_records(None, 'casse', 'u1')
+
+    # The first session does not stamp its old rows as current, it reads the table again.
+    assert calls == ['casse'] * 3
+    assert [row['id'] for row in rows] == ['a', 'b']
+    assert 'casse' in sessions[1][record_cache.CACHE_KEY]['tables']
@@ -0,0 +1,96 @@
+import logging
+import httpx
+import streamlit as st
+from supabase import ClientOptions
+from request_metrics import create_instrumented_client, track_action, ACTION_BUDGETS
+import terms_buffer
+
+
+def _client(handler, options = None):
+    return create_instrumented_client('http://localhost:54321', 'anon-key', options, httpx.MockTransport(handler))
+
+
+def _ok(request):
+    # The selects of postgrest 1.x only accept a list.
+    if '/rpc/' not in request.url.path:
+        return httpx.Response(200, json = [])
+    return httpx.Response(200, json = {'success': True, 'documents': 1, 'results': []})
+
+
+def test_counts_requests_bytes_and_endpoints():
+    responses = []
+    client = _client(lambda request: responses.append(_ok(request)) or responses[-1])
+
+    with track_action('open invoice') as stats:
+        client.table('fatture_emesse').select('*').eq('user_id', 'u').execute()
+        client.rpc('apply_terms_deltas', {'deltas': []}).execute()
+
+    assert stats.requests == 2
+    assert stats.endpoints == {'GET fatture_emesse': 1, 'POST rpc/apply_terms_deltas': 1}
+    assert stats.bytes_sent == len(b'{"deltas":[]}')
+    assert stats.bytes_received == sum(len(response.content) for response in responses)
+    assert stats.errors == 0
+
+
+def test_nested_actions_and_errors():
+    client = _client(lambda request: httpx.Response(400, json = {'message': 'bad request'}))
+
+    with track_action('outer') as outer:
+        with track_action('inner') as inner:
+            try:
+                client.rpc('delete_documents', {}).execute()
+            except Exception:
+                pass
+        try:
+            client.rpc('delete_documents', {}).execute()
+        except Exception:
+            pass
+
+    assert inner.requests == 1
+    assert outer.requests == 2
+    assert outer.errors == 2
+
+
+def test_over_budget_is_logged(caplog):
+    client = _client(_ok)
+
+    with caplog.at_level(logging.WARNING):
+        with track_action('save terms'):
+            for _ in range(ACTION_BUDGETS['save terms'] + 1):
+                client.rpc('apply_terms_deltas', {'deltas': []}).execute()
+
+    assert "action 'save terms' over budget" in caplog.text
+
+
+def test_flush_of_many_documents_is_one_request():
+    requests = []
+    client = _client(lambda request: requests.append(request) or _ok(request))
+    st.session_state[terms_buffer.BUFFER_KEY] = {}
+    for document_id in (1, 2, 3):
+        terms_buffer.stage('rate_fatture_emesse', document_id, {'rfe_numero_fattura': str(document_id)},
+                           {'inserted': [], 'updated': [], 'deleted': [f'id{document_id}']}, terms = [])
+
+    with track_action('save terms') as stats:
+        assert terms_buffer.flush(client)['success']
+
+    assert stats.requests == len(requests) == 1
+    assert terms_buffer.get_buffer() == {}
+
+
+def test_auth_requests_are_not_sent_with_the_postgrest_client():
+    auth_requests = []
+    auth_http_client = httpx.Client(transport = httpx.MockTransport(
+        lambda request: auth_requests.append(request) or httpx.Response(400, json = {'msg': 'bad request'})))
+    client = _client(_ok, ClientOptions(httpx_client = auth_http_client))
+
+    with track_action('open invoice') as stats:
+        client.table('fatture_emesse').select('id').eq('user_id', 'u').execute()
+        try:
+            client.auth.sign_in_with_password({'email': 'user@example.com', 'password': 'password'})
+        except Exception:
+            pass
+
+    assert stats.endpoints == {'GET fatture_emesse': 1}
+    assert [request.url.path for request in auth_requests] == ['/auth/v1/token']
+    assert 'accept-profile' not in auth_requests[0].headers
+    assert client.postgrest.session is not auth_http_client
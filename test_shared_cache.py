@@ -0,0 +1,52 @@
+import json
+import pytest
+import shared_cache
+from shared_cache import MemoryBackend, SqliteBackend
+
+
+@pytest.fixture(params = ['memory', 'sqlite'])
+def backend(request, tmp_path):
+    text = json.dumps([{'id': 1}])
+    # Room for two entries.
+    max_bytes = 2 * len(text) + 1
+    if request.param == 'memory':
+        return MemoryBackend(max_bytes)
+    return SqliteBackend(str(tmp_path / 'shared_cache.sqlite3'), max_bytes)
+
+
+def test_least_recently_used_is_evicted(backend):
+    text = json.dumps([{'id': 1}])
+    backend.put('a', [0], 1.0, text)
+    backend.put('b', [0], 1.0, text)
+    backend.get('a')
+    backend.put('c', [0], 1.0, text)
+
+    assert backend.get('a') is not None
+    assert backend.get('b') is None
+    assert backend.get('c') is not None
+    assert backend.size()[0] == 2
+
+
+def test_too_big_is_not_stored(backend):
+    backend.put('a', [0], 1.0, 'x' * (backend.max_bytes + 1))
+
+    assert backend.get('a') is None
+
+
+def test_versions_per_user(backend):
+    backend.bump_version('u1', ['casse', 'casse'])
+    backend.bump_version('u2', ['casse'])
+
+    assert backend.get_version('u1', 'casse') == 2
+    assert backend.get_version('u2', 'casse') == 1
+    assert backend.get_version('u1', 'fatture_emesse') == 0
+
+
+def test_stale_stamp_and_ttl_are_misses(monkeypatch):
+    monkeypatch.setattr(shared_cache, 'backend', MemoryBackend())
+    shared_cache.put('u1', 'casse_options', [], (0, 1), [{'id': 1}])
+
+    assert shared_cache.get('u1', 'casse_options', [], (0, 1), ttl = 60)[0] == [{'id': 1}]
+    assert shared_cache.get('u1', 'casse_options', [], (0, 2), ttl = 60) is None
+    assert shared_cache.get('u1', 'casse_options', [], (0, 1), ttl = 0) is None
+    assert shared_cache.get('u2', 'casse_options', [], (0, 1), ttl = 60) is None
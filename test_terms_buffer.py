@@ -0,0 +1,62 @@
+import httpx
+import streamlit as st
+from terms_buffer import count_changes, build_batch, is_idle, auto_save, get_buffer, BUFFER_KEY, IDLE_FLUSH_SECONDS
+
+
+def _buffer():
+    return {
+        'rate_fatture_emesse:1': {
+            'table_name': 'rate_fatture_emesse',
+            'document_key': {'rfe_numero_fattura': 'F1', 'rfe_data_documento': '2024-01-01'},
+            'delta': {'inserted': [{'rfe_importo_pagamento_rata': '50.00'}],
+                      'updated': [{'id': 'a', 'rfe_importo_pagamento_rata': '50.00'}],
+                      'deleted': []},
+            'terms': [], 'errors': [], 'label': 'Fattura F1', 'changed_at': 100.0,
+        },
+        'rate_movimenti_attivi:2': {
+            'table_name': 'rate_movimenti_attivi',
+            'document_key': {'rma_numero': 'M1', 'rma_data': '2024-01-01'},
+            'delta': {'inserted': [], 'updated': [], 'deleted': ['b']},
+            'terms': [], 'errors': [], 'label': 'Movimento M1', 'changed_at': 110.0,
+        },
+    }
+
+
+def test_count_changes_of_all_documents():
+    assert count_changes(_buffer()) == 3
+    assert count_changes({}) == 0
+
+
+def test_build_batch_keeps_table_and_document_key():
+    batch = build_batch(_buffer())
+
+    assert [delta['table_name'] for delta in batch] == ['rate_fatture_emesse', 'rate_movimenti_attivi']
+    assert batch[1] == {'table_name': 'rate_movimenti_attivi',
+                        'document_key': {'rma_numero': 'M1', 'rma_data': '2024-01-01'},
+                        'inserted': [], 'updated': [], 'deleted': ['b']}
+
+
+def test_idle_from_the_last_change():
+    buffer = _buffer()
+
+    assert not is_idle(buffer, now = 110.0 + IDLE_FLUSH_SECONDS - 1)
+    assert is_idle(buffer, now = 110.0 + IDLE_FLUSH_SECONDS)
+    assert not is_idle({}, now = 1e12)
+
+
+class _FailingClient:
+    def rpc(self, name, params):
+        return self
+
+    def execute(self):
+        raise httpx.ConnectError('connection refused')
+
+
+def test_failed_auto_save_is_postponed():
+    st.session_state[BUFFER_KEY] = _buffer()
+
+    auto_save(_FailingClient())
+
+    buffer = get_buffer()
+    assert len(buffer) == 2
+    assert not is_idle(buffer)
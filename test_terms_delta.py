@@ -0,0 +1,69 @@
+from datetime import date
+from decimal import Decimal
+import pandas as pd
+from terms_delta import diff_terms, is_empty, rescale_terms
+
+
+def _backup():
+    return [
+        {'id': 'a', 'rfe_data_scadenza_pagamento': date(2024, 1, 31), 'rfe_data_pagamento_rata': None,
+         'rfe_importo_pagamento_rata': Decimal('100.00'), 'rfe_display_cassa': '', 'rfe_notes': 'Rata 1 di 2'},
+        {'id': 'b', 'rfe_data_scadenza_pagamento': date(2024, 2, 29), 'rfe_data_pagamento_rata': None,
+         'rfe_importo_pagamento_rata': Decimal('100.00'), 'rfe_display_cassa': '', 'rfe_notes': 'Rata 2 di 2'},
+    ]
+
+
+def test_marking_one_term_paid_updates_only_that_field():
+    # As it comes back from the data editor, plus the invoice keys added for the insert.
+    edited = [
+        {'id': 'a', 'rfe_data_scadenza_pagamento': pd.Timestamp('2024-01-31'), 'rfe_data_pagamento_rata': date(2024, 1, 30),
+         'rfe_importo_pagamento_rata': 100.0, 'rfe_display_cassa': None, 'rfe_notes': 'Rata 1 di 2',
+         'rfe_numero_fattura': 'F1', 'rfe_x': False},
+        {'id': 'b', 'rfe_data_scadenza_pagamento': date(2024, 2, 29), 'rfe_data_pagamento_rata': None,
+         'rfe_importo_pagamento_rata': 100.0, 'rfe_display_cassa': '', 'rfe_notes': 'Rata 2 di 2',
+         'rfe_numero_fattura': 'F1', 'rfe_x': False},
+    ]
+
+    delta = diff_terms(_backup(), edited, ignored_fields=['rfe_x'])
+
+    assert delta == {'inserted': [], 'updated': [{'id': 'a', 'rfe_data_pagamento_rata': '2024-01-30'}], 'deleted': []}
+
+
+def test_new_and_removed_terms():
+    edited = [
+        {'id': 'a', 'rfe_data_scadenza_pagamento': date(2024, 1, 31), 'rfe_data_pagamento_rata': None,
+         'rfe_importo_pagamento_rata': 50.0, 'rfe_display_cassa': '', 'rfe_notes': 'Rata 1 di 2'},
+        {'id': float('nan'), 'rfe_data_scadenza_pagamento': date(2024, 3, 31), 'rfe_data_pagamento_rata': None,
+         'rfe_importo_pagamento_rata': 150.0, 'rfe_display_cassa': '', 'rfe_notes': ''},
+    ]
+
+    delta = diff_terms(_backup(), edited)
+
+    assert delta['updated'] == [{'id': 'a', 'rfe_importo_pagamento_rata': 50.0}]
+    assert delta['deleted'] == ['b']
+    assert len(delta['inserted']) == 1 and 'id' not in delta['inserted'][0]
+    assert is_empty(diff_terms(_backup(), _backup()))
+
+
+def test_updated_terms_carry_the_loaded_version():
+    edited = _backup()
+    edited[0]['rfe_data_pagamento_rata'] = date(2024, 1, 30)
+
+    delta = diff_terms(_backup(), edited, versions={'a': '2024-01-01T10:00:00.123456+00:00',
+                                                    'b': '2024-01-01T10:00:00.123456+00:00'})
+
+    assert delta['updated'] == [{'id': 'a', 'rfe_data_pagamento_rata': '2024-01-30',
+                                 'updated_at': '2024-01-01T10:00:00.123456+00:00'}]
+
+
+def test_rescale_terms_updates_only_the_changed_amounts():
+    terms = [
+        {'id': 'b', 'rma_data_scadenza': '2024-02-29', 'rma_importo_pagamento': 50, 'updated_at': 't2'},
+        {'id': 'a', 'rma_data_scadenza': '2024-01-31', 'rma_importo_pagamento': 50, 'updated_at': 't1'},
+    ]
+
+    assert rescale_terms(terms, 'rma_importo_pagamento', 'rma_data_scadenza', '100.01') == {
+        'inserted': [],
+        'updated': [{'id': 'a', 'rma_importo_pagamento': '50.01', 'updated_at': 't1'}],
+        'deleted': [],
+    }
@@ -7,6 +7,7 @@ from decimal import Decimal, ROUND_HALF_UP, getcontext
 from datetime import datetime, date
 import pandas as pd
 from PIL import Image
+import query_cache
 
 def str_to_usdate(date_str):
     """
@@ -67,9 +68,30 @@ def get_df_metric(label, amount):
 #
 #         st.markdown(styled_df.to_html(), unsafe_allow_html=True)
 
-def fetch_all_records(supabase_client, table_name: str, user_id: str):
+# For the few reads that really need whole rows, like record_cache.py. Everybody else
+# declares the columns it reads, so payloads and json decoding stay small.
+ALL_COLUMNS = '*'
+
+def select_clause(columns) -> str:
+    """columns: list of column names, or ALL_COLUMNS."""
+    if columns == ALL_COLUMNS:
+        return ALL_COLUMNS
+    if not columns:
+        raise ValueError('select_clause: no columns')
+    return ','.join(columns)
+
+def fetch_all_records(supabase_client, table_name: str, user_id: str, columns):
+    """
+    columns: the columns read by the caller, see select_clause().
+    Cached for the session, see query_cache.py.
+    """
+    select = select_clause(columns)
+    return query_cache.get(table_name, user_id, (('select', select),),
+                           lambda: _query_all_records(supabase_client, table_name, user_id, select))
+
+def _query_all_records(supabase_client, table_name: str, user_id: str, select: str):
     try:
-        result = supabase_client.table(table_name).select('*').eq('user_id', user_id).execute()
+        result = supabase_client.table(table_name).select(select).eq('user_id', user_id).execute()
 
         if result.data:
             return result.data
@@ -105,7 +127,9 @@ def setup_page(page_title = "", page_icon = "", enable_page_can_render_warning =
     # Todo: if in the page there are tabs, the tabs will be shown even if the
     #  login form is displayed and I return false for the page can render variable.
     try:
-        response = supabase_client.table('user_data').select("*").eq('user_id',user_id).execute()
+        # Only the existence of the row is checked: no rows are returned, only their count.
+        response = supabase_client.table('user_data').select('user_id', count = 'exact', head = True) \
+                                  .eq('user_id',user_id).execute()
     except postgrest.exceptions.APIError as e:
         if 'JWT expired' in e.message:
             st.info('Sessione scaduta, effettuare il login nuovamente')
@@ -117,7 +141,7 @@ def setup_page(page_title = "", page_icon = "", enable_page_can_render_warning =
     if enable_page_can_render_warning:
         # Flag for avoiding rendering the page content in case the anagrafica azienda is not set yet.
         page_can_render = True
-        if len(response.data) < 1:
+        if not response.count:
             page_can_render = False
             st.warning("Prima di usare l'applicazione è necessario impostare l'anagrafica azienda")
             switched = st.button("Imposta Anagrafica Azienda", type='primary')
@@ -128,31 +152,6 @@ def setup_page(page_title = "", page_icon = "", enable_page_can_render_warning =
     else:
         return user_id, supabase_client
 
-def extract_field_names(sql_file_path ='sql/02_create_tables.sql', prefix='fe_'):
-    field_names = []
-    with open(sql_file_path, 'r') as f:
-        for line in f:
-            stripped = line.strip()
-            if stripped.startswith(prefix):
-                # Get first word (field name)
-                field_name = stripped.split()[0]
-                # Remove prefix because I have to check against field names in
-                # the xml_fields which has names without prefix.
-                field_name = field_name[len(prefix):]
-                field_names.append(field_name)
-    return field_names
-
-def extract_prefixed_field_names(sql_file_path = 'sql/02_create_tables.sql', prefix='fe_'):
-    field_names = []
-    with open(sql_file_path, 'r') as f:
-        for line in f:
-            stripped = line.strip()
-            if stripped.startswith(prefix):
-                # Get first word (field name)
-                field_name = stripped.split()[0]
-                field_names.append(field_name)
-    return field_names
-
 def create_monthly_line_chart(df, sales_row_name, purchase_row_name):
     """
     Create a simple line chart from a DataFrame with monthly data.
@@ -239,9 +238,19 @@ def get_standard_column_config(money_columns = None,
 
     return column_config
 
-def fetch_all_records_from_view(supabase_client, view_name: str):
+def fetch_all_records_from_view(supabase_client, view_name: str, columns):
+    """
+    columns: the columns read by the caller, see select_clause().
+    Cached for the session, see query_cache.py. The views filter the user by themselves.
+    """
+    select = select_clause(columns)
+    user = st.session_state.get('user')
+    return query_cache.get(view_name, user.id if user else None, (('select', select),),
+                           lambda: _query_all_records_from_view(supabase_client, view_name, select))
+
+def _query_all_records_from_view(supabase_client, view_name: str, select: str):
     try:
-        result = supabase_client.table(view_name).select('*').execute()
+        result = supabase_client.table(view_name).select(select).execute()
 
         if result.data:
             return result.data
@@ -251,11 +260,20 @@ def fetch_all_records_from_view(supabase_client, view_name: str):
         logging.exception(f"Database error in fetch_all_records_from_view: {e}")
         raise
 
-def fetch_record_from_id(supabase_client, table_name, record_id, user_id):
+def fetch_record_from_id(supabase_client, table_name, record_id, user_id, columns):
+    """
+    columns: the columns read by the caller, see select_clause().
+    Cached for the session, see query_cache.py.
+    """
+    select = select_clause(columns)
+    return query_cache.get(table_name, user_id, (('id', record_id), ('select', select)),
+                           lambda: _query_record_from_id(supabase_client, table_name, record_id, user_id, select))
+
+def _query_record_from_id(supabase_client, table_name, record_id, user_id, select: str):
 
     # todo: better error handling and check for one single row
     try:
-        result = supabase_client.table(table_name).select('*') \
+        result = supabase_client.table(table_name).select(select) \
             .eq('user_id', user_id) \
             .eq('id', record_id).execute()
 
@@ -267,6 +285,31 @@ def fetch_record_from_id(supabase_client, table_name, record_id, user_id):
         logging.exception(f"Database error in fetch_all_records_from_view: {e}")
         raise
 
+USER_COUNTERS_FIELDS = [
+    'fatture_emesse_count', 'fatture_emesse_total', 'fatture_emesse_with_terms_count',
+    'rate_fatture_emesse_count', 'rate_fatture_emesse_unpaid_count', 'rate_fatture_emesse_unpaid_total',
+    'fatture_ricevute_count', 'fatture_ricevute_total', 'fatture_ricevute_with_terms_count',
+    'rate_fatture_ricevute_count', 'rate_fatture_ricevute_unpaid_count', 'rate_fatture_ricevute_unpaid_total',
+]
+
+def get_user_counters(supabase_client, user_id) -> dict:
+    """
+    Invoices and terms counters of the user, kept up to date by triggers in the database,
+    see user_counters in sql/02_create_tables.sql. One row lookup by primary key.
+    A user without invoices has no row yet, all counters are 0.
+    """
+    try:
+        result = supabase_client.table('user_counters').select(','.join(USER_COUNTERS_FIELDS)) \
+            .eq('user_id', user_id).execute()
+
+        counters = {field: 0 for field in USER_COUNTERS_FIELDS}
+        if result.data:
+            counters.update({field: value or 0 for field, value in result.data[0].items()})
+        return counters
+    except Exception as e:
+        logging.exception(f"Database error in get_user_counters - error: {e} - user_id: {user_id}")
+        raise
+
 def money_to_string(amount):
 
     if not isinstance(amount, Decimal):